@@ -40,6 +40,7 @@ from course.models import (
         FlowPageVisit, FlowPageVisitGrade,
         FlowRuleException,
         GradingOpportunity, GradeChange, InstantMessage,
+        CodeRun,
         Exam, ExamTicket)
 from django import forms
 from relate.utils import string_concat
@@ -460,6 +461,7 @@ class FlowSessionAdmin(admin.ModelAdmin):
             "course",
             "start_time",
             "completion_time",
+            "last_activity_time",
             "access_rules_tag",
             "in_progress",
             #"expiration_mode",
@@ -483,6 +485,9 @@ class FlowSessionAdmin(admin.ModelAdmin):
 
     raw_id_fields = ("participation", "user")
 
+    # maintained automatically
+    readonly_fields = ("last_activity_time",)
+
     save_on_top = True
 
     # {{{ permissions
@@ -617,6 +622,14 @@ class FlowPageVisitAdmin(admin.ModelAdmin):
 
     raw_id_fields = ("flow_session", "page_data")
 
+    # maintained automatically
+    readonly_fields = (
+            "normalized_answer",
+            "normalized_answer_digest",
+            "latest_grade",
+            "latest_correctness",
+            )
+
     inlines = (FlowPageVisitGradeInline,)
 
     save_on_top = True
@@ -882,6 +895,49 @@ admin.site.register(InstantMessage, InstantMessageAdmin)
 # }}}
 
 
+# {{{ code runs
+
+class CodeRunAdmin(admin.ModelAdmin):
+    list_filter = ("course", "result", "flow_id")
+    list_display = (
+            "course",
+            "flow_id",
+            "page_id",
+            "time",
+            "result",
+            "exec_host",
+            "exec_time",
+            "retry_count",
+            )
+
+    date_hierarchy = "time"
+
+    search_fields = (
+            "flow_id",
+            "page_id",
+            "exec_host",
+            )
+
+    raw_id_fields = ("participation",)
+
+    # {{{ permissions
+
+    def has_add_permission(self, request):
+        # These are created only automatically.
+        return False
+
+    def get_queryset(self, request):
+        qs = super(CodeRunAdmin, self).get_queryset(request)
+        return _filter_course_linked_obj_for_user(qs, request.user)
+
+    # }}}
+
+
+admin.site.register(CodeRun, CodeRunAdmin)
+
+# }}}
+
+
 # {{{ exam tickets
 
 class ExamAdmin(admin.ModelAdmin):
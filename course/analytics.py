@@ -41,6 +41,7 @@ from course.utils import course_view, render_course_page, PageInstanceCache
 from course.models import (
         FlowSession,
         FlowPageVisit,
+        CodeRun,
         flow_permission)
 
 from course.constants import (
@@ -49,6 +50,13 @@ from course.constants import (
 
 from course.content import get_flow_desc
 
+# {{{ mypy
+
+if False:
+    from typing import Text, Any, Dict, Tuple, Optional  # noqa
+
+# }}}
+
 
 # {{{ flow list
 
@@ -89,6 +97,7 @@ class Histogram(object):
             num_bin_title_formatter=str):
         self.string_weights = {}
         self.num_values = []
+        self.num_value_arrays = []
         self.num_bin_starts = num_bin_starts
         self.num_min_value = num_min_value
         self.num_max_value = num_max_value
@@ -127,63 +136,116 @@ class Histogram(object):
             else:
                 self.num_values.append((value, weight))
 
+    def add_data_points(self, values, weights=None):
+        """Add all numbers in the array *values* at once, with the
+        corresponding *weights* (or a weight of 1 each). NaNs in *values*
+        count as missing data, like *None* in :meth:`add_data_point`.
+        """
+
+        import numpy as np
+
+        values = np.asarray(values, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(len(values), dtype=np.int64)
+        else:
+            weights = np.asarray(weights)
+
+        is_nan = np.isnan(values)
+        is_above = np.zeros(len(values), dtype=bool)
+        is_below = np.zeros(len(values), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            if self.num_max_value is not None:
+                is_above = values > self.num_max_value
+            if self.num_min_value is not None:
+                is_below = values < self.num_min_value
+
+        # Values that are not binned are counted by add_data_point, under
+        # the same labels as single values.
+        for mask in [is_nan, is_above, is_below]:
+            if mask.any():
+                value = values[mask][0].item()
+                self.add_data_point(
+                        None if np.isnan(value) else value,
+                        weights[mask].sum().item())
+
+        in_range = ~(is_nan | is_above | is_below)
+        self.num_value_arrays.append((values[in_range], weights[in_range]))
+
+    def get_num_values_and_weights(self):
+        import numpy as np
+
+        values = [np.array([value for value, _ in self.num_values],
+            dtype=np.float64)]
+        weights = [np.array([weight for _, weight in self.num_values],
+            dtype=np.int64 if all(
+                isinstance(weight, six.integer_types)
+                for _, weight in self.num_values)
+            else np.float64)]
+
+        for value_array, weight_array in self.num_value_arrays:
+            values.append(value_array)
+            weights.append(weight_array)
+
+        return np.concatenate(values), np.concatenate(weights)
+
     def total_weight(self):
+        _, weights = self.get_num_values_and_weights()
         return (
-                sum(weight for val, weight in self.num_values)
+                weights.sum().item()
                 + sum(six.itervalues(self.string_weights)))
 
     def get_bin_info_list(self):
+        import numpy as np
+
+        values, weights = self.get_num_values_and_weights()
+
         min_value = self.num_min_value
         max_value = self.num_max_value
 
         if self.num_bin_starts is not None:
-            num_bin_starts = self.num_bin_starts
+            bin_edges = np.array(
+                    list(self.num_bin_starts)
+                    + [max_value if max_value is not None
+                        else max([self.num_bin_starts[-1]] + list(values))],
+                    dtype=np.float64)
         else:
             if min_value is None:
-                if self.num_values:
-                    min_value, _ = min(self.num_values)
-                else:
-                    min_value = 1
+                min_value = values.min() if len(values) else 1
             if max_value is None:
-                if self.num_values:
-                    max_value, _ = max(self.num_values)
-                else:
-                    max_value = 1
+                max_value = values.max() if len(values) else 1
 
             if self.num_log_bins:
                 min_value = max(min_value, 1e-15)
                 max_value = max(max_value, 1.01*min_value)
 
-                from math import log, exp
-                bin_width = (log(max_value) - log(min_value))/self.num_bin_count
-                num_bin_starts = [
-                        exp(log(min_value)+bin_width*i)
-                        for i in range(self.num_bin_count)]
-                # Rounding error means exp(log(min_value)) may be greater
-                # than min_value, so set start of first bin to min_value
-                num_bin_starts[0] = min_value
+                bin_edges = np.exp(np.linspace(
+                    np.log(min_value), np.log(max_value),
+                    self.num_bin_count + 1))
             else:
-                bin_width = (max_value - min_value)/self.num_bin_count
-                num_bin_starts = [
-                        min_value+bin_width*i
-                        for i in range(self.num_bin_count)]
+                bin_edges = np.linspace(
+                        min_value, max_value, self.num_bin_count + 1)
 
-        bins = [0 for i in range(len(num_bin_starts))]
+            # Rounding error means exp(log(min_value)) may differ from
+            # min_value, so set the outer bin edges exactly.
+            bin_edges[0] = min_value
+            bin_edges[-1] = max_value
 
         temp_string_weights = self.string_weights.copy()
 
         oob = pgettext("Value in histogram", "<out of bounds>")
 
-        from bisect import bisect
-        for value, weight in self.num_values:
-            if ((max_value is not None
-                    and value > max_value)
-                    or value < num_bin_starts[0]):
-                temp_string_weights[oob] = \
-                        temp_string_weights.get(oob, 0) + weight
-            else:
-                bin_nr = bisect(num_bin_starts, value)-1
-                bins[bin_nr] += weight
+        is_oob = values < bin_edges[0]
+        if max_value is not None:
+            is_oob |= values > max_value
+        if is_oob.any():
+            temp_string_weights[oob] = (
+                    temp_string_weights.get(oob, 0)
+                    + weights[is_oob].sum().item())
+
+        bins, _ = np.histogram(
+                values[~is_oob], bins=bin_edges, weights=weights[~is_oob])
+        if not len(values):
+            bins = bins.astype(np.int64)
 
         total_weight = self.total_weight()
 
@@ -195,7 +257,8 @@ class Histogram(object):
                         100*weight/total_weight
                         if total_weight
                         else None))
-                for start, weight in zip(num_bin_starts, bins)]
+                for start, weight in zip(
+                    bin_edges[:-1].tolist(), bins.tolist())]
 
         str_bin_info = [
                 BinInfo(
@@ -207,19 +270,39 @@ class Histogram(object):
         return num_bin_info + str_bin_info
 
     def html(self):
-        bin_info_list = self.get_bin_info_list()
-        max_len = max(len(bin.title) for bin in bin_info_list)
-
-        if max_len < 20:
-            from django.template.loader import render_to_string
-            return render_to_string("course/histogram-wide.html", {
-                "bin_info_list": self.get_bin_info_list(),
-                })
-        else:
-            from django.template.loader import render_to_string
-            return render_to_string("course/histogram.html", {
-                "bin_info_list": self.get_bin_info_list(),
-                })
+        return render_bin_info_list(self.get_bin_info_list())
+
+
+class StoredHistogram(object):
+    """A histogram whose bins were computed by :class:`Histogram` and
+    stored as a list of ``[title, raw_weight, percentage]``.
+    """
+
+    def __init__(self, stored_bin_info_list):
+        self.bin_info_list = [
+                BinInfo(title=title, raw_weight=raw_weight,
+                    percentage=percentage)
+                for title, raw_weight, percentage in stored_bin_info_list]
+
+    def total_weight(self):
+        return sum(bin_info.raw_weight for bin_info in self.bin_info_list)
+
+    def html(self):
+        return render_bin_info_list(self.bin_info_list)
+
+
+def render_bin_info_list(bin_info_list):
+    max_len = max(len(bin.title) for bin in bin_info_list)
+
+    from django.template.loader import render_to_string
+    if max_len < 20:
+        return render_to_string("course/histogram-wide.html", {
+            "bin_info_list": bin_info_list,
+            })
+    else:
+        return render_to_string("course/histogram.html", {
+            "bin_info_list": bin_info_list,
+            })
 
 # }}}
 
@@ -260,24 +343,39 @@ def is_page_multiple_submit(flow_desc, page_desc):
 
 # {{{ flow analytics
 
-def make_grade_histogram(pctx, flow_id):
-    qset = FlowSession.objects.filter(
-            course=pctx.course,
-            flow_id=flow_id,
-            participation__roles__permissions__permission=(
-                pperm.included_in_grade_statistics))
+def get_in_progress_label():
+    return "".join(["<",
+        pgettext("Status of session", "in progress"),
+        ">"])
+
+
+def make_grade_histogram(course, flow_id):
+    import numpy as np
+
+    sessions = np.array(list(FlowSession.objects
+            .filter(
+                course=course,
+                flow_id=flow_id,
+                participation__roles__permissions__permission=(
+                    pperm.included_in_grade_statistics))
+            .values_list("in_progress", "points", "max_points")),
+            dtype=np.float64).reshape(-1, 3)
+    in_progress, points, max_points = sessions.T
 
     hist = Histogram(
         num_min_value=0,
         num_max_value=100)
-    for session in qset:
-        if session.in_progress:
-            hist.add_data_point(
-                    "".join(["<",
-                        pgettext("Status of session", "in progress"),
-                        ">"]))
-        else:
-            hist.add_data_point(session.points_percentage())
+
+    in_progress_count = np.count_nonzero(in_progress)
+    if in_progress_count:
+        hist.add_data_point(get_in_progress_label(), in_progress_count)
+
+    # NaN (i.e. no grade) unless there are points and nonzero max points,
+    # as in FlowSession.points_percentage()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentages = np.where(
+                max_points != 0, 100*points/max_points, np.nan)
+    hist.add_data_points(percentages[in_progress == 0])
 
     return hist
 
@@ -303,113 +401,21 @@ def safe_div(num, denom):
     return num/denom
 
 
-def make_page_answer_stats_list(pctx, flow_id, restrict_to_first_attempt):
-    flow_desc = get_flow_desc(pctx.repo, pctx.course, flow_id,
-            pctx.course_commit_sha)
-
-    page_cache = PageInstanceCache(pctx.repo, pctx.course, flow_id)
-
-    page_info_list = []
-    for group_desc in flow_desc.groups:
-        for page_desc in group_desc.pages:
-            points = 0
-            graded_count = 0
-            empty_count = 0
-
-            answer_count = 0
-            total_count = 0
-
-            visits = (FlowPageVisit.objects
-                    .filter(
-                        flow_session__course=pctx.course,
-                        flow_session__flow_id=flow_id,
-                        flow_session__participation__roles__permissions__permission=(
-                            pperm.included_in_grade_statistics),
-                        page_data__group_id=group_desc.id,
-                        page_data__page_id=page_desc.id,
-                        is_submitted_answer=True,
-                        ))
-
-            if connection.features.can_distinct_on_fields:
-                if restrict_to_first_attempt:
-                    visits = (visits
-                            .distinct("flow_session__participation__id")
-                            .order_by("flow_session__participation__id",
-                                "visit_time"))
-                elif is_page_multiple_submit(flow_desc, page_desc):
-                    visits = (visits
-                            .distinct("page_data__id")
-                            .order_by("page_data__id", "-visit_time"))
-
-            visits = (visits
-                    .select_related("flow_session")
-                    .select_related("page_data"))
-
-            answer_expected = False
-
-            title = None
-            for visit in visits:
-                page = page_cache.get_page(group_desc.id, page_desc.id,
-                        pctx.course_commit_sha)
-
-                answer_expected = answer_expected or page.expects_answer()
-
-                from course.page import PageContext
-                grading_page_context = PageContext(
-                        course=pctx.course,
-                        repo=pctx.repo,
-                        commit_sha=pctx.course_commit_sha,
-                        flow_session=visit.flow_session)
-
-                title = page.title(grading_page_context, visit.page_data.data)
-
-                answer_feedback = visit.get_most_recent_feedback()
-
-                if visit.answer is not None:
-                    answer_count += 1
-                else:
-                    empty_count += 1
-
-                total_count += 1
-
-                if (answer_feedback is not None
-                        and answer_feedback.correctness is not None):
-                    if visit.answer is None:
-                        assert answer_feedback.correctness == 0
-                    else:
-                        points += answer_feedback.correctness
-
-                    graded_count += 1
-
-            if not answer_expected:
-                continue
+def make_time_histogram(course, flow_id):
+    import numpy as np
+    from django.db.models import F, Case, When, DurationField
 
-            page_info_list.append(
-                    PageAnswerStats(
-                        group_id=group_desc.id,
-                        page_id=page_desc.id,
-                        title=title,
-                        average_correctness=safe_div(points, graded_count),
-                        average_emptiness=safe_div(
-                            empty_count, graded_count),
-                        answer_count=answer_count,
-                        total_count=total_count,
-                        url=reverse(
-                            "relate-page_analytics",
-                            args=(
-                                pctx.course_identifier,
-                                flow_id,
-                                group_desc.id,
-                                page_desc.id,
-                                ))))
-
-    return page_info_list
-
-
-def make_time_histogram(pctx, flow_id):
-    qset = FlowSession.objects.filter(
-            course=pctx.course,
-            flow_id=flow_id)
+    sessions = (FlowSession.objects
+            .filter(
+                course=course,
+                flow_id=flow_id)
+            .annotate(duration=Case(
+                # Django's SQLite timestamp subtraction fails on NULL.
+                When(completion_time__isnull=False,
+                    then=F("completion_time") - F("start_time")),
+                default=None,
+                output_field=DurationField()))
+            .values_list("in_progress", "duration"))
 
     from relate.utils import string_concat
     hist = Histogram(
@@ -419,32 +425,478 @@ def make_time_histogram(pctx, flow_id):
                     "$>$ %.1f ",
                     pgettext("Minute (time unit)", "min"))
                 % minutes))
-    for session in qset:
-        if session.in_progress:
-            hist.add_data_point(
-                    "".join(["<",
-                        pgettext("Status of session", "in progress"),
-                        ">"]))
+
+    in_progress_count = 0
+    minutes = []
+    for in_progress, duration in sessions:
+        if in_progress:
+            in_progress_count += 1
+        elif duration is not None:
+            minutes.append(duration.total_seconds() / 60)
         else:
-            delta = session.completion_time - session.start_time
-            minutes = delta.total_seconds() / 60
-            hist.add_data_point(minutes)
+            minutes.append(np.nan)
+
+    if in_progress_count:
+        hist.add_data_point(get_in_progress_label(), in_progress_count)
+    hist.add_data_points(minutes)
 
     return hist
 
 
-def count_participants(pctx, flow_id):
+def count_participants(course, flow_id):
     if not connection.features.can_distinct_on_fields:
         return None
 
     qset = (FlowSession.objects
             .filter(
-                course=pctx.course,
+                course=course,
                 flow_id=flow_id)
             .order_by("participation__id")
             .distinct("participation__id"))
     return qset.count()
 
+# }}}
+
+
+# {{{ flow analytics snapshots
+
+# A snapshot keeps the answers counted towards the statistics in its
+# 'state', grouped by flow session, so that the sessions that changed since
+# the last refresh can be recounted (and those that were deleted dropped)
+# without going through the other sessions' visits. Each counted answer is
+# a list [page key, answer key, [visit time, visit id, has answer,
+# correctness, normalized answer digest]], where the answer key makes a
+# session's last attempt at a page allowing multiple submissions replace
+# earlier ones in the "all" mode. In the "first" mode, a participant's
+# first attempt replaces later ones. The normalized answers themselves are
+# kept once per page in 'data'.
+SNAPSHOT_MODES = ["all", "first"]
+
+# Flow sessions are recounted if they were modified since this long
+# before the previous refresh. Since the modification time is taken when
+# a change is written rather than when it is committed, this needs to
+# exceed the duration of the transactions making changes.
+FLOW_ANALYTICS_SAFETY_LAG = 10*60
+
+# Snapshots are rebuilt from scratch after this long, to catch up on
+# changes that do not mark their session as modified (e.g. those made
+# with QuerySet.update) or that took longer than the safety lag to commit.
+FLOW_ANALYTICS_REBUILD_INTERVAL = 24*60*60
+
+# The number of sessions whose visits are fetched in one query.
+FLOW_ANALYTICS_SESSION_CHUNK_SIZE = 200
+
+# Answers that were saved before normalized answers were stored and that
+# can no longer be normalized (e.g. because the page changed type) are
+# counted under this digest, which no normalized answer has.
+UNNORMALIZABLE_ANSWER_DIGEST = "unnormalizable"
+
+
+def _merge_counted_answer(counted_answers, key, counted_answer, keep_latest):
+    old_answer = counted_answers.get(key)
+
+    if (old_answer is None
+            or (counted_answer[:2] > old_answer[:2]) == keep_latest):
+        counted_answers[key] = counted_answer
+
+
+def _summarize_counted_answers(counted_answers):
+    points = 0
+    graded_count = 0
+    empty_count = 0
+
+    answer_count = 0
+    total_count = 0
+
+    digest_and_correctness_to_count = {}  # type: Dict[Tuple[Text, Optional[float]], int]  # noqa
+
+    for (_visit_time, _visit_id, has_answer, correctness,
+            digest) in counted_answers:
+        if has_answer:
+            answer_count += 1
+        else:
+            empty_count += 1
+
+        total_count += 1
+
+        if correctness is not None:
+            if has_answer:
+                points += correctness
+
+            graded_count += 1
+
+        key = (digest, correctness)
+        digest_and_correctness_to_count[key] = \
+                digest_and_correctness_to_count.get(key, 0) + 1
+
+    return {
+            "average_correctness": safe_div(points, graded_count),
+            "average_emptiness": safe_div(empty_count, graded_count),
+            "answer_count": answer_count,
+            "total_count": total_count,
+            "answers": [
+                [digest, correctness, count]
+                for (digest, correctness), count in six.iteritems(
+                    digest_and_correctness_to_count)],
+            }
+
+
+def _get_stored_bin_info_list(hist):
+    return [
+            [six.text_type(bin_info.title), bin_info.raw_weight,
+                bin_info.percentage]
+            for bin_info in hist.get_bin_info_list()]
+
+
+def _count_session_answers(snapshot, repo, commit_sha, flow_desc, session_ids):
+    """Recount the answers of the flow sessions with *session_ids* into
+    the 'state' of *snapshot*.
+    """
+
+    from django.db.models import Case, When, Value, BooleanField
+    from course.page import PageContext
+
+    course = snapshot.course
+    page_cache = PageInstanceCache(repo, course, snapshot.flow_id)
+
+    page_key_set = set(
+            "%s/%s" % (group_desc.id, page_desc.id)
+            for group_desc in flow_desc.groups
+            for page_desc in group_desc.pages)
+    multiple_submit_page_keys = set(
+            "%s/%s" % (group_desc.id, page_desc.id)
+            for group_desc in flow_desc.groups
+            for page_desc in group_desc.pages
+            if is_page_multiple_submit(flow_desc, page_desc))
+
+    sessions_state = snapshot.state["sessions"]
+    pages_data = snapshot.data["pages"]
+
+    for session_id in session_ids:
+        sessions_state[str(session_id)]["answers"] = []
+
+    for chunk_start in range(
+            0, len(session_ids), FLOW_ANALYTICS_SESSION_CHUNK_SIZE):
+        visits = (FlowPageVisit.objects
+                .filter(
+                    flow_session__in=session_ids[
+                        chunk_start:
+                        chunk_start+FLOW_ANALYTICS_SESSION_CHUNK_SIZE],
+                    is_submitted_answer=True)
+                .annotate(
+                    has_answer=Case(
+                        When(answer__isnull=True, then=Value(False)),
+                        default=Value(True),
+                        output_field=BooleanField()))
+                # Answers are normalized when they are saved, so they are
+                # usually not needed. (JSONField does not load deferred
+                # values on access, see below.)
+                .defer("answer")
+                .select_related("flow_session")
+                .select_related("page_data")
+                .order_by("visit_time", "id"))
+
+        for visit in visits.iterator():
+            page_data = visit.page_data
+            page_key = "%s/%s" % (page_data.group_id, page_data.page_id)
+            if page_key not in page_key_set:
+                continue
+
+            page = page_cache.get_page(
+                    page_data.group_id, page_data.page_id, commit_sha)
+            if not page.expects_answer():
+                continue
+
+            page_context = PageContext(
+                    course=course,
+                    repo=repo,
+                    commit_sha=commit_sha,
+                    flow_session=visit.flow_session)
+
+            if visit.normalized_answer_digest is None:
+                # saved before normalized answers were stored, see the
+                # backfill_normalized_answers management command
+                visit.refresh_from_db(fields=["answer"])
+                try:
+                    visit.store_normalized_answer(page, page_context)
+                except Exception:
+                    # Left without a digest for backfill_normalized_answers
+                    # to report.
+                    visit.normalized_answer = six.text_type(
+                            _("(could not be normalized)"))
+                    visit.normalized_answer_digest = \
+                            UNNORMALIZABLE_ANSWER_DIGEST
+                else:
+                    (FlowPageVisit.objects
+                            .filter(id=visit.id)
+                            .update(
+                                normalized_answer=visit.normalized_answer,
+                                normalized_answer_digest=(
+                                    visit.normalized_answer_digest)))
+
+            if page_key not in pages_data:
+                # Title and body may depend on page data, so they are taken
+                # from one instance of each page.
+                pages_data[page_key] = {
+                        "group_id": page_data.group_id,
+                        "page_id": page_data.page_id,
+                        "title": six.text_type(
+                            page.title(page_context, page_data.data)),
+                        "body": six.text_type(
+                            page.body(page_context, page_data.data)),
+                        "normalized_answers": {},
+                        }
+
+            normalized_answers = pages_data[page_key]["normalized_answers"]
+            if visit.normalized_answer_digest not in normalized_answers:
+                normalized_answers[visit.normalized_answer_digest] = \
+                        visit.normalized_answer
+
+            if page_key in multiple_submit_page_keys:
+                key = "d%d" % page_data.id
+            else:
+                key = "v%d" % visit.id
+
+            sessions_state[str(visit.flow_session_id)]["answers"].append([
+                page_key,
+                key,
+                [
+                    visit.visit_time.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                    visit.id,
+                    visit.has_answer,
+                    visit.latest_correctness,
+                    visit.normalized_answer_digest]])
+
+
+def _update_flow_analytics_snapshot(snapshot, repo, commit_sha,
+        modified_since):
+    """Bring *snapshot* up to date with the flow sessions that were modified
+    since *modified_since* (all of them if *None*), as well as with those
+    that were added to or removed from the grade statistics.
+
+    :returns: whether anything changed.
+    """
+
+    course = snapshot.course
+    flow_id = snapshot.flow_id
+
+    from course.grades import get_grade_statistics_participations
+
+    snapshot.state.setdefault("sessions", {})
+    snapshot.data.setdefault("pages", {})
+    sessions_state = snapshot.state["sessions"]
+
+    # {{{ find the sessions to (re-)count
+
+    sessions = (FlowSession.objects
+            .filter(
+                course=course,
+                flow_id=flow_id,
+                participation__in=get_grade_statistics_participations(course))
+            .values_list("id", "participation_id", "modification_time"))
+
+    session_ids = set()
+    modified_session_ids = []
+    for session_id, participation_id, modification_time in sessions:
+        session_ids.add(str(session_id))
+
+        if (modified_since is None
+                or str(session_id) not in sessions_state
+                or modification_time is None
+                or modification_time >= modified_since):
+            modified_session_ids.append(session_id)
+            sessions_state[str(session_id)] = {
+                    "participation_id": participation_id,
+                    }
+
+    removed_session_ids = set(sessions_state) - session_ids
+    for session_id in removed_session_ids:
+        del sessions_state[session_id]
+
+    if (not modified_session_ids
+            and not removed_session_ids
+            and "page_keys" in snapshot.data):
+        return False
+
+    # }}}
+
+    flow_desc = get_flow_desc(repo, course, flow_id, commit_sha)
+    _count_session_answers(snapshot, repo, commit_sha, flow_desc,
+            modified_session_ids)
+
+    # {{{ summarize the counted answers of all sessions
+
+    mode_to_page_key_to_answers = dict(
+            (mode, {}) for mode in SNAPSHOT_MODES)  # type: Dict[Text, Dict[Text, Dict[Text, Any]]]  # noqa
+
+    for session_state in six.itervalues(sessions_state):
+        participation_key = "p%d" % session_state["participation_id"]
+        for page_key, key, counted_answer in session_state["answers"]:
+            _merge_counted_answer(
+                    mode_to_page_key_to_answers["all"].setdefault(page_key, {}),
+                    key, counted_answer, keep_latest=True)
+            _merge_counted_answer(
+                    mode_to_page_key_to_answers["first"]
+                    .setdefault(page_key, {}),
+                    participation_key, counted_answer, keep_latest=False)
+
+    pages_data = snapshot.data["pages"]
+    for mode, page_key_to_answers in six.iteritems(
+            mode_to_page_key_to_answers):
+        for page_key, counted_answers in six.iteritems(page_key_to_answers):
+            pages_data[page_key][mode] = _summarize_counted_answers(
+                    six.itervalues(counted_answers))
+
+    snapshot.data["page_keys"] = [
+            page_key
+            for page_key in (
+                "%s/%s" % (group_desc.id, page_desc.id)
+                for group_desc in flow_desc.groups
+                for page_desc in group_desc.pages)
+            if page_key in mode_to_page_key_to_answers["all"]]
+
+    # }}}
+
+    # Sessions are few compared with page visits, so these are simply
+    # recomputed.
+    snapshot.data["grade_histogram"] = _get_stored_bin_info_list(
+            make_grade_histogram(course, flow_id))
+    snapshot.data["time_histogram"] = _get_stored_bin_info_list(
+            make_time_histogram(course, flow_id))
+    snapshot.data["participant_count"] = count_participants(course, flow_id)
+
+    return True
+
+
+def refresh_flow_analytics_snapshot(course, repo, commit_sha, flow_id):
+    """Create or bring up to date the
+    :class:`course.models.FlowAnalyticsSnapshot` of the flow *flow_id* at
+    *commit_sha*. Only the flow sessions modified since shortly (see
+    :data:`FLOW_ANALYTICS_SAFETY_LAG`) before the previous refresh are
+    recounted, as well as those of participants who started being
+    included in grade statistics. Sessions that were deleted (or whose
+    participants stopped being included) are dropped. Every
+    :data:`FLOW_ANALYTICS_REBUILD_INTERVAL`, the snapshot is rebuilt from
+    scratch.
+
+    :returns: the snapshot.
+    """
+
+    from django.db import transaction
+    from datetime import timedelta
+    from django.utils.timezone import now
+    from course.models import FlowAnalyticsSnapshot
+
+    snapshot, created = FlowAnalyticsSnapshot.objects.get_or_create(
+            course=course, flow_id=flow_id, commit_sha=commit_sha.decode())
+
+    # Taken before looking at the sessions so that sessions modified in the
+    # meantime are recounted by the next refresh.
+    refresh_start_time = now()
+
+    with transaction.atomic():
+        snapshot = (FlowAnalyticsSnapshot.objects
+                .select_for_update()
+                .get(pk=snapshot.pk))
+        snapshot.course = course
+
+        modified_since = snapshot.modification_watermark
+        if (snapshot.rebuild_time is None
+                or snapshot.rebuild_time < refresh_start_time - timedelta(
+                    seconds=FLOW_ANALYTICS_REBUILD_INTERVAL)):
+            snapshot.state = {}
+            snapshot.data = {}
+            snapshot.rebuild_time = refresh_start_time
+            modified_since = None
+
+        _update_flow_analytics_snapshot(snapshot, repo, commit_sha,
+                modified_since)
+
+        snapshot.modification_watermark = refresh_start_time - timedelta(
+                seconds=FLOW_ANALYTICS_SAFETY_LAG)
+        snapshot.refresh_time = now()
+        snapshot.save()
+
+    return snapshot
+
+
+def get_flow_analytics_snapshot(pctx, flow_id):
+    """Return the :class:`course.models.FlowAnalyticsSnapshot` of the flow
+    *flow_id* at the commit being viewed, without its (large) state.
+
+    Snapshots of the active commit are refreshed periodically by
+    :func:`course.tasks.refresh_flow_analytics_snapshots`. Other snapshots,
+    as well as those that have missed refreshes (e.g. because the Celery
+    scheduler is not running), are refreshed here.
+    """
+
+    from django.conf import settings
+    from datetime import timedelta
+    from django.utils.timezone import now
+    from course.models import FlowAnalyticsSnapshot
+
+    refresh_interval = getattr(
+            settings, "RELATE_FLOW_ANALYTICS_REFRESH_INTERVAL", 5*60)
+
+    try:
+        snapshot = (FlowAnalyticsSnapshot.objects
+                .defer("state")
+                .get(
+                    course=pctx.course,
+                    flow_id=flow_id,
+                    commit_sha=pctx.course_commit_sha.decode()))
+    except ObjectDoesNotExist:
+        snapshot = None
+
+    if (snapshot is None
+            or snapshot.commit_sha != pctx.course.active_git_commit_sha
+            or snapshot.refresh_time < (
+                now() - timedelta(seconds=2*refresh_interval))):
+        try:
+            snapshot = refresh_flow_analytics_snapshot(
+                    pctx.course, pctx.repo, pctx.course_commit_sha, flow_id)
+        except ObjectDoesNotExist:
+            messages.add_message(pctx.request, messages.ERROR,
+                    _("Flow '%s' was not found in the repository, but it "
+                        "exists in the database--maybe it was deleted?")
+                    % flow_id)
+            raise http.Http404()
+
+    return snapshot
+
+# }}}
+
+
+# {{{ flow analytics view
+
+def make_page_answer_stats_list(pctx, snapshot, restrict_to_first_attempt):
+    mode = "first" if restrict_to_first_attempt else "all"
+
+    page_info_list = []
+    for page_key in snapshot.data.get("page_keys", []):
+        page_data = snapshot.data["pages"][page_key]
+        summary = page_data[mode]
+
+        page_info_list.append(
+                PageAnswerStats(
+                    group_id=page_data["group_id"],
+                    page_id=page_data["page_id"],
+                    title=page_data["title"],
+                    average_correctness=summary["average_correctness"],
+                    average_emptiness=summary["average_emptiness"],
+                    answer_count=summary["answer_count"],
+                    total_count=summary["total_count"],
+                    url=reverse(
+                        "relate-page_analytics",
+                        args=(
+                            pctx.course_identifier,
+                            snapshot.flow_id,
+                            page_data["group_id"],
+                            page_data["page_id"],
+                            ))))
+
+    return page_info_list
+
 
 @login_required
 @course_view
@@ -455,23 +907,22 @@ def flow_analytics(pctx, flow_id):
     restrict_to_first_attempt = int(
             bool(pctx.request.GET.get("restrict_to_first_attempt") == "1"))
 
-    try:
-        stats_list = make_page_answer_stats_list(pctx, flow_id,
-                restrict_to_first_attempt)
-    except ObjectDoesNotExist:
-        messages.add_message(pctx.request, messages.ERROR,
-                _("Flow '%s' was not found in the repository, but it exists in "
-                    "the database--maybe it was deleted?")
-                % flow_id)
-        raise http.Http404()
+    snapshot = get_flow_analytics_snapshot(pctx, flow_id)
 
     return render_course_page(pctx, "course/analytics-flow.html", {
         "flow_identifier": flow_id,
-        "grade_histogram": make_grade_histogram(pctx, flow_id),
-        "page_answer_stats_list": stats_list,
-        "time_histogram": make_time_histogram(pctx, flow_id),
-        "participant_count": count_participants(pctx, flow_id),
+        "grade_histogram": StoredHistogram(
+            snapshot.data["grade_histogram"]),
+        "page_answer_stats_list": make_page_answer_stats_list(
+            pctx, snapshot, restrict_to_first_attempt),
+        "time_histogram": StoredHistogram(
+            snapshot.data["time_histogram"]),
+        "participant_count": snapshot.data["participant_count"],
         "restrict_to_first_attempt": restrict_to_first_attempt,
+        "snapshot_time": snapshot.refresh_time,
+        "has_code_runs": (CodeRun.objects
+            .filter(course=pctx.course, flow_id=flow_id)
+            .exists()),
         })
 
 # }}}
@@ -494,86 +945,30 @@ def page_analytics(pctx, flow_id, group_id, page_id):
     if not pctx.has_permission(pperm.view_analytics):
         raise PermissionDenied(_("may not view analytics"))
 
-    flow_desc = get_flow_desc(pctx.repo, pctx.course, flow_id,
-            pctx.course_commit_sha)
-
     restrict_to_first_attempt = int(
             bool(pctx.request.GET.get("restrict_to_first_attempt") == "1"))
 
-    is_multiple_submit = is_flow_multiple_submit(flow_desc)
-
-    page_cache = PageInstanceCache(pctx.repo, pctx.course, flow_id)
-
-    visits = (FlowPageVisit.objects
-            .filter(
-                flow_session__course=pctx.course,
-                flow_session__flow_id=flow_id,
-                flow_session__participation__roles__permissions__permission=(
-                    pperm.included_in_grade_statistics),
-                page_data__group_id=group_id,
-                page_data__page_id=page_id,
-                is_submitted_answer=True,
-                ))
-
-    if connection.features.can_distinct_on_fields:
-        if restrict_to_first_attempt:
-            visits = (visits
-                    .distinct("flow_session__participation__id")
-                    .order_by("flow_session__participation__id", "visit_time"))
-        elif is_multiple_submit:
-            visits = (visits
-                    .distinct("page_data__id")
-                    .order_by("page_data__id", "-visit_time"))
-
-    visits = (visits
-            .select_related("flow_session")
-            .select_related("page_data"))
-
-    normalized_answer_and_correctness_to_count = {}
+    snapshot = get_flow_analytics_snapshot(pctx, flow_id)
 
     title = None
     body = None
-    total_count = 0
-    graded_count = 0
-
-    for visit in visits:
-        page = page_cache.get_page(group_id, page_id, pctx.course_commit_sha)
-
-        from course.page import PageContext
-        grading_page_context = PageContext(
-                course=pctx.course,
-                repo=pctx.repo,
-                commit_sha=pctx.course_commit_sha,
-                flow_session=visit.flow_session)
-
-        title = page.title(grading_page_context, visit.page_data.data)
-        body = page.body(grading_page_context, visit.page_data.data)
-        normalized_answer = page.normalized_answer(
-                grading_page_context, visit.page_data.data, visit.answer)
-
-        answer_feedback = visit.get_most_recent_feedback()
-
-        if answer_feedback is not None:
-            key = (normalized_answer, answer_feedback.correctness)
-            normalized_answer_and_correctness_to_count[key] = \
-                    normalized_answer_and_correctness_to_count.get(key, 0) + 1
-            graded_count += 1
-        else:
-            key = (normalized_answer, None)
-            normalized_answer_and_correctness_to_count[key] = \
-                    normalized_answer_and_correctness_to_count.get(key, 0) + 1
-
-        total_count += 1
-
     answer_stats = []
-    for (normalized_answer, correctness), count in \
-            six.iteritems(normalized_answer_and_correctness_to_count):
-        answer_stats.append(
-                AnswerStats(
-                    normalized_answer=normalized_answer,
-                    correctness=correctness,
-                    count=count,
-                    percentage=safe_div(100 * count, total_count)))
+
+    page_data = snapshot.data["pages"].get("%s/%s" % (group_id, page_id))
+    if page_data is not None:
+        title = page_data["title"]
+        body = page_data["body"]
+
+        summary = page_data["first" if restrict_to_first_attempt else "all"]
+        for digest, correctness, count in summary["answers"]:
+            answer_stats.append(
+                    AnswerStats(
+                        normalized_answer=(
+                            page_data["normalized_answers"][digest]),
+                        correctness=correctness,
+                        count=count,
+                        percentage=safe_div(
+                            100 * count, summary["total_count"])))
 
     answer_stats = sorted(
             answer_stats,
@@ -588,6 +983,121 @@ def page_analytics(pctx, flow_id, group_id, page_id):
         "body": body,
         "answer_stats_list": answer_stats,
         "restrict_to_first_attempt": restrict_to_first_attempt,
+        "snapshot_time": snapshot.refresh_time,
+        })
+
+# }}}
+
+
+# {{{ code run analytics
+
+CODE_RUN_ERROR_RESULTS = [
+        "uncaught_error",
+        "setup_compile_error",
+        "setup_error",
+        "test_compile_error",
+        "test_error",
+        ]
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile *q* (in percent) of the non-empty list
+    *sorted_values*.
+    """
+    from math import ceil
+    rank = max(int(ceil(q / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class CodeRunStats(object):
+    def __init__(self, page_id, runs):
+        self.page_id = page_id
+        self.run_count = len(runs)
+
+        timeout_count = 0
+        error_count = 0
+        queued_count = 0
+        self.retry_count = 0
+        response_sizes = []
+        total_times = []
+        exec_times = []
+
+        for result, retry_count, response_size, total_time, exec_time in runs:
+            if result == "timeout":
+                timeout_count += 1
+            elif result in CODE_RUN_ERROR_RESULTS:
+                error_count += 1
+            elif result == "queued":
+                queued_count += 1
+
+            self.retry_count += retry_count
+
+            if response_size is not None:
+                response_sizes.append(response_size)
+            if total_time is not None:
+                total_times.append(total_time)
+            if exec_time is not None:
+                exec_times.append(exec_time)
+
+        self.timeout_percent = safe_div(100 * timeout_count, self.run_count)
+        self.error_percent = safe_div(100 * error_count, self.run_count)
+        self.queued_percent = safe_div(100 * queued_count, self.run_count)
+
+        self.mean_response_size = (
+                safe_div(sum(response_sizes), len(response_sizes))
+                if response_sizes else None)
+
+        self.total_time_percentiles = self.get_percentiles(total_times)
+        self.exec_time_percentiles = self.get_percentiles(exec_times)
+
+    @staticmethod
+    def get_percentiles(values):
+        """
+        :returns: the median, 90th and 99th percentile and the maximum of
+            *values*, or *None* if *values* is empty.
+        """
+        if not values:
+            return None
+
+        values = sorted(values)
+        return [percentile(values, q) for q in [50, 90, 99]] + [values[-1]]
+
+
+@login_required
+@course_view
+def code_run_analytics(pctx, flow_id):
+    if not pctx.has_permission(pperm.view_analytics):
+        raise PermissionDenied(_("may not view analytics"))
+
+    runs_by_page_id = {}
+    for (page_id, result, retry_count, response_size,
+            queue_time, create_time, start_time, ready_time, exec_time,
+            remove_time) in (CodeRun.objects
+                .filter(course=pctx.course, flow_id=flow_id)
+                .values_list(
+                    "page_id", "result", "retry_count", "response_size",
+                    "queue_time", "create_time", "start_time", "ready_time",
+                    "exec_time", "remove_time")):
+        phase_times = [
+                t for t in [
+                    queue_time, create_time, start_time, ready_time,
+                    exec_time, remove_time]
+                if t is not None]
+        total_time = sum(phase_times) if phase_times else None
+
+        runs_by_page_id.setdefault(page_id, []).append(
+                (result, retry_count, response_size, total_time, exec_time))
+
+    stats_list = [
+            CodeRunStats(page_id, runs)
+            for page_id, runs in sorted(six.iteritems(runs_by_page_id))]
+
+    from course.page.code import get_runpy_admission_stats
+
+    return render_course_page(pctx, "course/analytics-code-runs.html", {
+        "flow_identifier": flow_id,
+        "code_run_stats_list": stats_list,
+        "admission_stats": get_runpy_admission_stats(),
         })
 
 # }}}
@@ -2,6 +2,8 @@
 
 from __future__ import division
 
+import logging
+
 __copyright__ = "Copyright (C) 2017 Andreas Kloeckner"
 
 __license__ = """
@@ -35,15 +37,29 @@ from course.constants import (
 
 from course.models import FlowSession
 
+logger = logging.getLogger(__name__)
+
 # {{{ mypy
 
 if 0:
-    from typing import Text, Any  # noqa
+    from typing import (  # noqa
+            Text, Any, Iterable, Iterator, Optional, Tuple, Callable, Sequence,
+            List, Dict)
+    from django.db.models import query  # noqa
     from course.auth import APIContext  # noqa
+    from relate.utils import Repo_ish  # noqa
+    from course.models import (  # noqa
+            Course, FlowPageData, FlowPageVisit)
+    from course.page.base import PageBase, PageContext  # noqa
+    from course.utils import PageInstanceCache  # noqa
 
 # }}}
 
 
+# The largest number of flow sessions returned per request when paginating
+MAX_FLOW_SESSION_PAGE_SIZE = 1000
+
+
 def flow_session_to_json(sess):
     # type: (FlowSession) -> Any
     last_activity = sess.last_activity()
@@ -66,6 +82,10 @@ def flow_session_to_json(sess):
                 last_activity.isoformat()
                 if last_activity is not None
                 else None),
+            modification_time=(
+                sess.modification_time.isoformat()
+                if sess.modification_time is not None
+                else None),
             page_count=sess.page_count,
 
             in_progress=sess.in_progress,
@@ -77,6 +97,134 @@ def flow_session_to_json(sess):
             )
 
 
+# {{{ flow session listing helpers
+
+def get_int_arg(api_ctx, name):
+    # type: (APIContext, Text) -> Optional[int]
+    value_str = api_ctx.request.GET.get(name)
+    if value_str is None:
+        return None
+
+    try:
+        return int(value_str)
+    except ValueError:
+        raise APIError("%s GET parameter must be an integer" % name)
+
+
+def get_flow_sessions_qset(api_ctx):
+    # type: (APIContext) -> query.QuerySet
+
+    """Return the sessions of the flow given by the ``flow_id`` GET
+    parameter, ordered by ID. If the ``modified_since`` GET parameter (an ISO
+    8601 date and time) is given, only sessions modified since then are
+    returned. Since modification times are taken when changes are written
+    rather than committed, clients need to allow for some overlap between
+    retrievals (see ``doc/api.rst``). Deleted sessions are not reported.
+    """
+
+    try:
+        flow_id = api_ctx.request.GET["flow_id"]
+    except KeyError:
+        raise APIError("must specify flow_id GET parameter")
+
+    sessions = (FlowSession.objects
+            .filter(
+                course=api_ctx.course,
+                flow_id=flow_id)
+            .select_related("participation__user")
+            .order_by("id"))
+
+    modified_since_str = api_ctx.request.GET.get("modified_since")
+    if modified_since_str is not None:
+        from django.utils.dateparse import parse_datetime
+        try:
+            modified_since = parse_datetime(modified_since_str)
+        except ValueError:
+            modified_since = None
+
+        if modified_since is None:
+            raise APIError("modified_since GET parameter must be an "
+                    "ISO 8601 date and time")
+
+        from django.utils.timezone import is_naive, make_aware
+        if is_naive(modified_since):
+            modified_since = make_aware(modified_since)
+
+        sessions = sessions.filter(modification_time__gte=modified_since)
+
+    return sessions
+
+
+def paginate_flow_sessions(api_ctx, sessions):
+    # type: (APIContext, query.QuerySet) -> Tuple[Iterable[FlowSession], Optional[Text]]  # noqa
+
+    """Restrict *sessions* (ordered by ID) to those with IDs above the
+    ``after_id`` GET parameter and, if the ``page_size`` GET parameter is
+    given, to a page of that many sessions.
+
+    :returns: a tuple ``(sessions, next_url)``, where *next_url* is the URL
+        of the next page, or *None* if there is none.
+    """
+
+    after_id = get_int_arg(api_ctx, "after_id")
+    if after_id is not None:
+        sessions = sessions.filter(id__gt=after_id)
+
+    page_size = get_int_arg(api_ctx, "page_size")
+    if page_size is None:
+        return sessions.iterator(), None
+
+    if not 1 <= page_size <= MAX_FLOW_SESSION_PAGE_SIZE:
+        raise APIError("page_size GET parameter must be between 1 and %d"
+                % MAX_FLOW_SESSION_PAGE_SIZE)
+
+    # Fetch one more session than needed to find out whether there is a
+    # next page.
+    session_list = list(sessions[:page_size+1])
+    if len(session_list) <= page_size:
+        return session_list, None
+
+    session_list = session_list[:page_size]
+
+    next_page_args = api_ctx.request.GET.copy()
+    next_page_args["after_id"] = str(session_list[-1].id)
+    return session_list, api_ctx.request.build_absolute_uri(
+            "?" + next_page_args.urlencode())
+
+
+def make_json_list_response(api_ctx, items, next_url=None,
+        default_format="json"):
+    # type: (APIContext, Iterable[Any], Optional[Text], Text) -> http.HttpResponse  # noqa
+
+    """Return *items* as a JSON list or, if the ``format`` GET parameter
+    (or, in its absence, *default_format*) is ``ndjson``, stream them as
+    newline-delimited JSON. *next_url* is sent in a ``Link`` header.
+    """
+
+    response_format = api_ctx.request.GET.get("format", default_format)
+
+    if response_format == "json":
+        response = http.JsonResponse(list(items), safe=False)
+
+    elif response_format == "ndjson":
+        import json
+        from django.core.serializers.json import DjangoJSONEncoder
+        response = http.StreamingHttpResponse(
+                (json.dumps(item, cls=DjangoJSONEncoder) + "\n"
+                    for item in items),
+                content_type="application/x-ndjson")
+
+    else:
+        raise APIError("format GET parameter must be 'json' or 'ndjson'")
+
+    if next_url is not None:
+        response["Link"] = '<%s>; rel="next"' % next_url
+
+    return response
+
+# }}}
+
+
 @with_course_api_auth
 def get_flow_sessions(api_ctx, course_identifier):
     # type: (APIContext, Text) -> http.HttpResponse
@@ -84,18 +232,200 @@ def get_flow_sessions(api_ctx, course_identifier):
     if not api_ctx.has_permission(pperm.view_gradebook):
         raise PermissionDenied("token role does not have required permissions")
 
-    try:
-        flow_id = api_ctx.request.GET["flow_id"]
-    except KeyError:
-        raise APIError("must specify flow_id GET parameter")
+    sessions, next_url = paginate_flow_sessions(
+            api_ctx, get_flow_sessions_qset(api_ctx))
+
+    return make_json_list_response(
+            api_ctx,
+            (flow_session_to_json(sess) for sess in sessions),
+            next_url)
+
+
+# {{{ flow session content helpers
+
+def flow_session_pages_to_json(pctx, get_page, all_page_data, answer_visits,
+        log_normalization_errors=False):
+    # type: (PageContext, Callable[[FlowPageData], Optional[PageBase]], Iterable[FlowPageData], Sequence[Optional[FlowPageVisit]], bool) -> List[Dict[Text, Any]]  # noqa
+
+    """
+    :arg get_page: returns the page object for a :class:`FlowPageData`,
+        or *None* if the page is no longer part of the flow (or no longer
+        of the same type). Answers for such pages are returned without a
+        normalized version.
+    :arg answer_visits: the answer visit of each page, indexed by page
+        ordinal, as returned by :func:`course.flow.assemble_answer_visits`.
+    :arg log_normalization_errors: if *True*, exceptions raised while
+        getting a page or normalizing an answer are logged, and the answer
+        is returned without a normalized version. Otherwise, they propagate.
+    """
+
+    pages = []
+    for i, page_data in enumerate(all_page_data):
+        assert i == page_data.page_ordinal
+
+        page_data_json = dict(
+                ordinal=i,
+                page_type=page_data.page_type,
+                group_id=page_data.group_id,
+                page_id=page_data.page_id,
+                page_data=page_data.data,
+                title=page_data.title,
+                bookmarked=page_data.bookmarked,
+                )
+        answer_json = None
+        grade_json = None
+
+        visit = answer_visits[i] if i < len(answer_visits) else None
+        if visit is not None:
+            # norm_answer needs to be JSON-encodable
+            norm_answer = None  # type: Any
+
+            try:
+                page = get_page(page_data)
+
+                norm_bytes_answer_tup = None
+                if page is not None:
+                    norm_bytes_answer_tup = page.normalized_bytes_answer(
+                            pctx, page_data.data, visit.answer)
 
-    sessions = FlowSession.objects.filter(
-            course=api_ctx.course,
-            flow_id=flow_id)
+                if norm_bytes_answer_tup is not None:
+                    answer_file_ext, norm_bytes_answer = norm_bytes_answer_tup
 
-    result = [flow_session_to_json(sess) for sess in sessions]
+                    if answer_file_ext in [".txt", ".py"]:
+                        norm_answer = norm_bytes_answer.decode("utf-8")
+                    elif answer_file_ext == ".json":
+                        import json
+                        norm_answer = json.loads(norm_bytes_answer)
+                    else:
+                        from base64 import b64encode
+                        norm_answer = [
+                                answer_file_ext, b64encode(norm_bytes_answer)]
+            except Exception:
+                if not log_normalization_errors:
+                    raise
+
+                # A page that fails to normalize an answer (e.g. one that
+                # was changed in an incompatible way) should not keep the
+                # remaining content from being retrieved. The raw answer
+                # data is still returned.
+                logger.exception(
+                        "failed to normalize answer of flow session %d, "
+                        "page %d", page_data.flow_session_id, i)
+                norm_answer = None
+
+            answer_json = dict(
+                visit_time=visit.visit_time.isoformat(),
+                remote_address=repr(visit.remote_address),
+                user=visit.user.username if visit.user is not None else None,
+                impersonated_by=(visit.impersonated_by.username
+                    if visit.impersonated_by is not None else None),
+                is_synthetic_visit=visit.is_synthetic,
+                answer_data=visit.answer,
+                answer=norm_answer,
+                )
+
+            grade = visit.get_most_recent_grade()
+            if grade is not None:
+                grade_json = dict(
+                    grader=(grade.grader.username
+                        if grade.grader is not None else None),
+                    grade_time=grade.grade_time.isoformat(),
+                    graded_at_git_commit_sha=grade.graded_at_git_commit_sha,
+                    max_points=grade.max_points,
+                    correctness=grade.correctness,
+                    feedback=grade.feedback)
+
+        pages.append({
+            "page": page_data_json,
+            "answer": answer_json,
+            "grade": grade_json,
+            })
+
+    return pages
+
+
+def get_answer_visits_qset(flow_sessions):
+    # type: (List[FlowSession]) -> query.QuerySet
+    from course.flow import get_multiple_flow_session_graded_answers_qset
+    return (get_multiple_flow_session_graded_answers_qset(flow_sessions)
+            .select_related("page_data")
+            .select_related("user")
+            .select_related("impersonated_by")
+            .select_related("latest_grade__grader")
+            .order_by("visit_time"))
+
+
+# Number of sessions whose page data and answers are retrieved together
+FLOW_SESSION_CONTENT_CHUNK_SIZE = 50
+
+
+def iter_flow_session_contents(course, repo, commit_sha, page_cache, sessions):
+    # type: (Course, Repo_ish, bytes, PageInstanceCache, Iterable[FlowSession]) -> Iterator[Dict[Text, Any]]  # noqa
+
+    """Yield the content of each of *sessions*, as returned by
+    ``get-flow-session-content``. Unlike that, this does not bring the page
+    data of the sessions up to date with the flow, so that it does not write
+    to the database. Answers to pages no longer in the flow are returned
+    without a normalized version, as are answers to pages whose type
+    changed.
+    """
+
+    from itertools import islice
+    from django.core.exceptions import ObjectDoesNotExist
+    from course.models import FlowPageData
+    from course.page.base import PageContext
+
+    def get_page(page_data):
+        try:
+            page = page_cache.get_page(
+                    page_data.group_id, page_data.page_id, commit_sha)
+        except ObjectDoesNotExist:
+            return None
+
+        if page.page_desc.type != page_data.page_type:
+            # The page data (and answer) belong to a different page type.
+            return None
+
+        return page
+
+    sessions = iter(sessions)
+    while True:
+        session_chunk = list(islice(sessions, FLOW_SESSION_CONTENT_CHUNK_SIZE))
+        if not session_chunk:
+            break
+
+        session_id_to_page_data = {}  # type: Dict[int, List[FlowPageData]]
+        for page_data in (FlowPageData.objects
+                .filter(
+                    flow_session__in=session_chunk,
+                    page_ordinal__isnull=False)
+                .order_by("flow_session_id", "page_ordinal")):
+            session_id_to_page_data.setdefault(
+                    page_data.flow_session_id, []).append(page_data)
+
+        # like course.flow.assemble_answer_visits: the latest answer wins
+        session_id_to_answer_visits = {
+                sess.id: [None] * (sess.page_count or 0)
+                for sess in session_chunk
+                }  # type: Dict[int, List[Optional[FlowPageVisit]]]
+        for visit in get_answer_visits_qset(session_chunk):
+            answer_visits = session_id_to_answer_visits[visit.flow_session_id]
+            ordinal = visit.page_data.page_ordinal
+            if ordinal is not None and ordinal < len(answer_visits):
+                answer_visits[ordinal] = visit
+
+        for sess in session_chunk:
+            yield {
+                "session": flow_session_to_json(sess),
+                "pages": flow_session_pages_to_json(
+                    PageContext(course, repo, commit_sha, sess),
+                    get_page,
+                    session_id_to_page_data.get(sess.id, []),
+                    session_id_to_answer_visits[sess.id],
+                    log_normalization_errors=True),
+                }
 
-    return http.JsonResponse(result, safe=False)
+# }}}
 
 
 @with_course_api_auth
@@ -129,76 +459,13 @@ def get_flow_session_content(api_ctx, course_identifier):
                 fctx.flow_desc)
 
         from course.flow import get_all_page_data
-        all_page_data = get_all_page_data(flow_session)
-        answer_visits = assemble_answer_visits(flow_session)
-
-        pages = []
-        for i, page_data in enumerate(all_page_data):
-            page = instantiate_flow_page_with_ctx(fctx, page_data)
-
-            assert i == page_data.page_ordinal
-
-            page_data_json = dict(
-                    ordinal=i,
-                    page_type=page_data.page_type,
-                    group_id=page_data.group_id,
-                    page_id=page_data.page_id,
-                    page_data=page_data.data,
-                    title=page_data.title,
-                    bookmarked=page_data.bookmarked,
-                    )
-            answer_json = None
-            grade_json = None
-
-            visit = answer_visits[i]
-            if visit is not None:
-                from course.page.base import PageContext
-                pctx = PageContext(api_ctx.course, repo, fctx.course_commit_sha,
-                        flow_session)
-                norm_bytes_answer_tup = page.normalized_bytes_answer(
-                        pctx, page_data.data, visit.answer)
-
-                # norm_answer needs to be JSON-encodable
-                norm_answer = None  # type: Any
-
-                if norm_bytes_answer_tup is not None:
-                    answer_file_ext, norm_bytes_answer = norm_bytes_answer_tup
-
-                    if answer_file_ext in [".txt", ".py"]:
-                        norm_answer = norm_bytes_answer.decode("utf-8")
-                    elif answer_file_ext == ".json":
-                        import json
-                        norm_answer = json.loads(norm_bytes_answer)
-                    else:
-                        from base64 import b64encode
-                        norm_answer = [answer_file_ext, b64encode(norm_bytes_answer)]
-
-                answer_json = dict(
-                    visit_time=visit.visit_time.isoformat(),
-                    remote_address=repr(visit.remote_address),
-                    user=visit.user.username if visit.user is not None else None,
-                    impersonated_by=(visit.impersonated_by.username
-                        if visit.impersonated_by is not None else None),
-                    is_synthetic_visit=visit.is_synthetic,
-                    answer_data=visit.answer,
-                    answer=norm_answer,
-                    )
-
-                grade = visit.get_most_recent_grade()
-                if grade is not None:
-                    grade_json = dict(
-                        grader=grade.grader,
-                        grade_time=grade.grade_time.isoformat(),
-                        graded_at_git_commit_sha=grade.graded_at_git_commit_sha,
-                        max_points=grade.max_points,
-                        correctness=grade.correctness,
-                        feedback=grade.feedback)
-
-            pages.append({
-                "page": page_data_json,
-                "answer": answer_json,
-                "grade": grade_json,
-                })
+        from course.page.base import PageContext
+        pages = flow_session_pages_to_json(
+                PageContext(api_ctx.course, repo, fctx.course_commit_sha,
+                    flow_session),
+                lambda page_data: instantiate_flow_page_with_ctx(fctx, page_data),
+                get_all_page_data(flow_session),
+                assemble_answer_visits(flow_session))
 
     result = {
         "session": flow_session_to_json(flow_session),
@@ -208,4 +475,41 @@ def get_flow_session_content(api_ctx, course_identifier):
     return http.JsonResponse(result, safe=False)
 
 
+@with_course_api_auth
+def get_flow_sessions_content(api_ctx, course_identifier):
+    # type: (APIContext, Text) -> http.HttpResponse
+
+    if not api_ctx.has_permission(pperm.view_gradebook):
+        raise PermissionDenied("token role does not have required permissions")
+
+    sessions, next_url = paginate_flow_sessions(
+            api_ctx, get_flow_sessions_qset(api_ctx))
+
+    from django.core.exceptions import ObjectDoesNotExist
+    from course.content import get_course_repo, get_course_commit_sha
+    from course.utils import PageInstanceCache
+
+    course = api_ctx.course
+    commit_sha = get_course_commit_sha(course, None)
+
+    repo = get_course_repo(course)
+    page_cache = PageInstanceCache(repo, course, api_ctx.request.GET["flow_id"])
+    try:
+        page_cache.get_flow_desc_from_cache(commit_sha)
+    except ObjectDoesNotExist:
+        repo.close()
+        raise http.Http404()
+
+    def iter_contents():
+        try:
+            for content in iter_flow_session_contents(
+                    course, repo, commit_sha, page_cache, sessions):
+                yield content
+        finally:
+            repo.close()
+
+    return make_json_list_response(
+            api_ctx, iter_contents(), next_url, default_format="ndjson")
+
+
 # vim: foldmethod=marker
@@ -32,7 +32,7 @@ from django.shortcuts import (  # noqa
 from django.contrib import messages
 import django.forms as forms
 from django.core.exceptions import (PermissionDenied, SuspiciousOperation,
-        ObjectDoesNotExist)
+        ObjectDoesNotExist, ImproperlyConfigured)
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit, Layout, Div, Button
 from django.conf import settings
@@ -1107,6 +1107,31 @@ class APIError(Exception):
     pass
 
 
+# For how long (in seconds) a successfully checked token secret is
+# remembered, so that repeated API requests do not each pay for hashing it.
+VERIFIED_TOKEN_CACHE_TIMEOUT = 5 * 60
+
+
+def _get_verified_token_cache():
+    try:
+        import django.core.cache as cache
+    except ImproperlyConfigured:
+        return None
+
+    return cache.caches["default"]
+
+
+def _get_verified_token_cache_key(token_id, token_hash_str):
+    # type: (int, Text) -> Text
+
+    # Only a keyed digest of the secret goes into the cache (key).
+    from django.utils.crypto import salted_hmac
+    return "relate-api-token:%d:%s" % (
+            token_id,
+            salted_hmac("course.auth.find_matching_token",
+                token_hash_str).hexdigest())
+
+
 def find_matching_token(
         course_identifier=None, token_id=None, token_hash_str=None,
         now_datetime=None):
@@ -1117,15 +1142,27 @@ def find_matching_token(
     except AuthenticationToken.DoesNotExist:
         return None
 
-    from django.contrib.auth.hashers import check_password
-    if not check_password(token_hash_str, token.token_hash):
-        return None
-
+    # Checked on the token as stored for every request, so that revocation
+    # and expiry take effect regardless of the cache below.
     if token.revocation_time is not None:
         return None
     if token.valid_until is not None and now_datetime > token.valid_until:
         return None
 
+    def_cache = _get_verified_token_cache()
+    cache_key = _get_verified_token_cache_key(token.id, token_hash_str)
+
+    # The cached value is the hash the secret was checked against, so that
+    # entries for a token whose secret was replaced no longer match.
+    if def_cache is None or def_cache.get(cache_key) != token.token_hash:
+        from django.contrib.auth.hashers import check_password
+        if not check_password(token_hash_str, token.token_hash):
+            return None
+
+        if def_cache is not None:
+            def_cache.set(cache_key, token.token_hash,
+                    VERIFIED_TOKEN_CACHE_TIMEOUT)
+
     return token
 
 
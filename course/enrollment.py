@@ -34,7 +34,8 @@ from django.shortcuts import (  # noqa
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
-from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.core.exceptions import (
+        PermissionDenied, SuspiciousOperation, ImproperlyConfigured)
 from django.conf import settings
 from django.urls import reverse
 from django.db import transaction, IntegrityError
@@ -71,17 +72,110 @@ from pytools.lex import RE as REBase  # noqa
 # {{{ for mypy
 
 if False:
-    from typing import Any, Tuple, Text, Optional, List, FrozenSet  # noqa
+    from typing import Any, Tuple, Text, Optional, List, FrozenSet, Callable  # noqa
     from course.utils import CoursePageContext  # noqa
 
 # }}}
 
 
+# {{{ participation cache
+
+# Cached participations (along with their roles, tags and permissions) of a
+# course are dropped whenever anything they depend on is saved, by changing
+# the course's cache version. This only bounds the staleness resulting from
+# changes that bypass model signals. Since that only reaches the cache of
+# the process doing the change, participations are only cached if the cache
+# is shared among processes.
+PARTICIPATION_CACHE_TIMEOUT = 60 * 60
+
+
+def _get_participation_cache():
+    from relate.utils import is_cache_shared
+    if not is_cache_shared():
+        return None
+
+    try:
+        import django.core.cache as cache
+    except ImproperlyConfigured:
+        return None
+
+    return cache.caches["default"]
+
+
+def _get_participation_cache_version_key(course_id):
+    # type: (int) -> Text
+    return "relate-participation-version:%d" % course_id
+
+
+def _get_participation_cache_key(cache, course_id, user_id):
+    # type: (Any, int, Optional[int]) -> Text
+
+    """
+    :arg user_id: *None* for users not participating in the course.
+    """
+
+    version_key = _get_participation_cache_version_key(course_id)
+    version = cache.get(version_key)
+    if version is None:
+        from uuid import uuid4
+        cache.add(version_key, uuid4().hex, None)
+        version = cache.get(version_key)
+
+    return "relate-participation:%d:%s:%s" % (
+            course_id,
+            user_id if user_id is not None else "none",
+            version)
+
+
+def invalidate_participation_cache(course_id):
+    # type: (int) -> None
+    cache = _get_participation_cache()
+    if cache is None:
+        return
+
+    version_key = _get_participation_cache_version_key(course_id)
+
+    def change_version():
+        from uuid import uuid4
+        cache.set(version_key, uuid4().hex, None)
+
+    # Changing the version again once the transaction commits keeps requests
+    # that retrieve the participation in the meantime from caching stale
+    # data.
+    change_version()
+    transaction.on_commit(change_version)
+
+# }}}
+
+
 # {{{ get_participation_for_request
 
+def _get_participation_from_db(user, course):
+    # type: (Any, Course) -> Optional[Participation]
+
+    participations = list(Participation.objects.filter(
+            user=user,
+            course=course,
+            status=participation_status.active
+            ))
+
+    # The uniqueness constraint should have ensured that.
+    assert len(participations) <= 1
+
+    if len(participations) == 0:
+        return None
+
+    return participations[0]
+
+
 def get_participation_for_request(request, course):
     # type: (http.HttpRequest, Course) -> Optional[Participation]
 
+    """The returned participation comes with its roles, tags and
+    permissions, cached across requests until they change if the cache is
+    shared among processes.
+    """
+
     # "wake up" lazy object
     # http://stackoverflow.com/questions/20534577/int-argument-must-be-a-string-or-a-number-not-simplelazyobject  # noqa
     user = request.user
@@ -96,19 +190,30 @@ def get_participation_for_request(request, course):
     if not user.is_authenticated:
         return None
 
-    participations = list(Participation.objects.filter(
-            user=user,
-            course=course,
-            status=participation_status.active
-            ))
+    cache = _get_participation_cache()
+    if cache is None:
+        return _get_participation_from_db(user, course)
 
-    # The uniqueness constraint should have ensured that.
-    assert len(participations) <= 1
+    cache_key = _get_participation_cache_key(cache, course.id, user.id)
+    cached_result = cache.get(cache_key)
+    if cached_result is not None:
+        # wrapped in a tuple to tell users without participations from
+        # cache misses
+        (participation,) = cached_result
+        return participation
 
-    if len(participations) == 0:
-        return None
+    participation = _get_participation_from_db(user, course)
 
-    return participations[0]
+    if participation is not None:
+        # These are retrieved now so that they are pickled along with the
+        # participation.
+        participation.permissions()
+        participation.role_identifiers()
+        participation.tag_names()
+
+    cache.set(cache_key, (participation,), PARTICIPATION_CACHE_TIMEOUT)
+
+    return participation
 
 # }}}
 
@@ -119,20 +224,36 @@ def get_participation_role_identifiers(course, participation):
     # type: (Course, Optional[Participation]) -> List[Text]
 
     if participation is None:
-        return (
+        return _get_unenrolled_cached(course, "roles", lambda: list(
                 ParticipationRole.objects.filter(
                     course=course,
                     is_default_for_unenrolled=True)
-                .values_list("identifier", flat=True))
+                .values_list("identifier", flat=True)))
 
     else:
-        return [r.identifier for r in participation.roles.all()]
+        return participation.role_identifiers()
 
 # }}}
 
 
 # {{{ get_permissions
 
+def _get_unenrolled_cached(course, name, compute):
+    # type: (Course, Text, Callable[[], Any]) -> Any
+    cache = _get_participation_cache()
+    if cache is None:
+        return compute()
+
+    cache_key = "%s:%s" % (
+            _get_participation_cache_key(cache, course.id, None), name)
+    result = cache.get(cache_key)
+    if result is None:
+        result = compute()
+        cache.set(cache_key, result, PARTICIPATION_CACHE_TIMEOUT)
+
+    return result
+
+
 def get_participation_permissions(
         course,  # type: Course
         participation,  # type: Optional[Participation]
@@ -144,16 +265,18 @@ def get_participation_permissions(
     else:
         from course.models import ParticipationRolePermission
 
-        perm_list = list(
-                ParticipationRolePermission.objects.filter(
-                    role__is_default_for_unenrolled=True)
-                .values_list("permission", "argument"))
+        def compute():
+            perm_list = list(
+                    ParticipationRolePermission.objects.filter(
+                        role__course=course,
+                        role__is_default_for_unenrolled=True)
+                    .values_list("permission", "argument"))
 
-        perm = frozenset(
-                (permission, argument) if argument else (permission, None)
-                for permission, argument in perm_list)
+            return frozenset(
+                    (permission, argument) if argument else (permission, None)
+                    for permission, argument in perm_list)
 
-        return perm
+        return _get_unenrolled_cached(course, "permissions", compute)
 
 # }}}
 
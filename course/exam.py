@@ -24,7 +24,6 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import six
 
 from django.contrib.auth import get_user_model
 import django.forms as forms
@@ -602,16 +601,10 @@ def check_in_for_exam(request):
 
 
 def is_from_exams_only_facility(request):
-    from course.utils import get_facilities_config
-    for name, props in six.iteritems(get_facilities_config(request)):
-        if not props.get("exams_only", False):
-            continue
-
-        # By now we know that this facility is exams-only
-        if name in request.relate_facilities:
-            return True
-
-    return False
+    from course.utils import get_facility_index
+    return bool(
+            get_facility_index(request).exams_only_facilities
+            & request.relate_facilities)
 
 
 def get_login_exam_ticket(request):
@@ -699,90 +692,124 @@ class ExamFacilityMiddleware(object):
         return self.get_response(request)
 
 
+# URL names of the views that may be used in a session locked down to an
+# exam flow session
+EXAM_LOCKDOWN_ALLOWED_URL_NAMES = frozenset([
+    "relate-get_repo_file",
+    "relate-get_current_repo_file",
+
+    "relate-check_in_for_exam",
+    "relate-list_available_exams",
+
+    "relate-sign_in_choice",
+    "relate-sign_in_by_email",
+    "relate-sign_in_stage2_with_token",
+    "relate-sign_in_by_user_pw",
+    "relate-user_profile",
+    "relate-logout",
+    ])
+
+# URL names of the views that may be used in a locked-down session if they
+# refer to the exam flow session (by its ``flow_session_id``)
+EXAM_LOCKDOWN_FLOW_SESSION_URL_NAMES = frozenset([
+    "relate-view_resume_flow",
+    "relate-view_flow_page",
+    "relate-update_expiration_mode",
+    "relate-update_page_bookmark_state",
+    "relate-finish_flow_session_view",
+    ])
+
+EXAM_LOCKDOWN_ALLOWED_PATH_PREFIXES = ("/saml2", "/select2")
+
+
+def get_exam_lockdown_flow(request):
+    # type: (http.HttpRequest) -> Tuple[Text, Text]
+
+    """Return the course identifier and the flow ID of the flow session that
+    *request*'s session is locked down to. These are stored in the session by
+    :func:`course.flow.lock_down_if_needed`, so that the flow session
+    does not need to be retrieved on every request.
+    """
+
+    try:
+        return (
+                request.session["relate_session_locked_to_exam_course_identifier"],
+                request.session["relate_session_locked_to_exam_flow_id"])
+    except KeyError:
+        pass
+
+    # locked down before these were stored
+    try:
+        exam_flow_session = (FlowSession.objects
+                .select_related("course")
+                .get(pk=request.session[
+                    "relate_session_locked_to_exam_flow_session_pk"]))
+    except ObjectDoesNotExist:
+        msg = _("Error while processing exam lockdown: "
+                "flow session not found.")
+        messages.add_message(request, messages.ERROR, msg)
+        raise PermissionDenied(msg)
+
+    request.session["relate_session_locked_to_exam_course_identifier"] = \
+            exam_flow_session.course.identifier
+    request.session["relate_session_locked_to_exam_flow_id"] = \
+            exam_flow_session.flow_id
+
+    return exam_flow_session.course.identifier, exam_flow_session.flow_id
+
+
 class ExamLockdownMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        request.relate_exam_lockdown = False
+        request.relate_exam_lockdown = (
+                "relate_session_locked_to_exam_flow_session_pk"
+                in request.session)
 
-        if "relate_session_locked_to_exam_flow_session_pk" in request.session:
-            exam_flow_session_pk = request.session[
-                    "relate_session_locked_to_exam_flow_session_pk"]
+        return self.get_response(request)
 
-            try:
-                exam_flow_session = FlowSession.objects.get(pk=exam_flow_session_pk)
-            except ObjectDoesNotExist:
-                msg = _("Error while processing exam lockdown: "
-                        "flow session not found.")
-                messages.add_message(request, messages.ERROR, msg)
-                raise PermissionDenied(msg)
-
-            request.relate_exam_lockdown = True
-
-            from django.urls import resolve
-            resolver_match = resolve(request.path)
-
-            from course.views import (get_repo_file, get_current_repo_file)
-            from course.flow import (
-                    view_start_flow, view_resume_flow, view_flow_page,
-                    update_expiration_mode, update_page_bookmark_state,
-                    finish_flow_session_view)
-            from course.auth import (user_profile, sign_in_choice, sign_in_by_email,
-                    sign_in_stage2_with_token, sign_in_by_user_pw, sign_out)
-
-            ok = False
-            if resolver_match.func in [
-                    get_repo_file,
-                    get_current_repo_file,
-
-                    check_in_for_exam,
-                    list_available_exams,
-
-                    sign_in_choice,
-                    sign_in_by_email,
-                    sign_in_stage2_with_token,
-                    sign_in_by_user_pw,
-                    user_profile,
-                    sign_out]:
-                ok = True
-
-            elif request.path.startswith("/saml2"):
-                ok = True
-
-            elif request.path.startswith("/select2"):
-                ok = True
-
-            elif (
-                    resolver_match.func in [
-                        view_resume_flow,
-                        view_flow_page,
-                        update_expiration_mode,
-                        update_page_bookmark_state,
-                        finish_flow_session_view]
-                    and
-                    int(resolver_match.kwargs["flow_session_id"])
-                    == exam_flow_session_pk):
-                ok = True
-
-            elif (
-                    resolver_match.func == view_start_flow
-                    and
-                    resolver_match.kwargs["flow_id"]
-                    == exam_flow_session.flow_id):
-                ok = True
-
-            if not ok:
-                messages.add_message(request, messages.ERROR,
-                        _("Your RELATE session is currently locked down "
-                        "to this exam flow. Navigating to other parts of "
-                        "RELATE is not currently allowed. "
-                        "To exit this exam, log out."))
-                return redirect("relate-view_start_flow",
-                        exam_flow_session.course.identifier,
-                        exam_flow_session.flow_id)
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not request.relate_exam_lockdown:
+            return None
 
-        return self.get_response(request)
+        exam_flow_session_pk = request.session[
+                "relate_session_locked_to_exam_flow_session_pk"]
+        exam_course_identifier, exam_flow_id = get_exam_lockdown_flow(request)
+
+        # set by the URL resolution preceding process_view
+        url_name = request.resolver_match.url_name
+
+        ok = False
+        if url_name in EXAM_LOCKDOWN_ALLOWED_URL_NAMES:
+            ok = True
+
+        elif request.path.startswith(EXAM_LOCKDOWN_ALLOWED_PATH_PREFIXES):
+            ok = True
+
+        elif (
+                url_name in EXAM_LOCKDOWN_FLOW_SESSION_URL_NAMES
+                and
+                int(view_kwargs["flow_session_id"]) == exam_flow_session_pk):
+            ok = True
+
+        elif (
+                url_name == "relate-view_start_flow"
+                and
+                view_kwargs["flow_id"] == exam_flow_id):
+            ok = True
+
+        if not ok:
+            messages.add_message(request, messages.ERROR,
+                    _("Your RELATE session is currently locked down "
+                    "to this exam flow. Navigating to other parts of "
+                    "RELATE is not currently allowed. "
+                    "To exit this exam, log out."))
+            return redirect("relate-view_start_flow",
+                    exam_course_identifier,
+                    exam_flow_id)
+
+        return None
 
 # }}}
 
@@ -88,7 +88,7 @@ from relate.utils import retry_transaction_decorator
 # {{{ mypy
 
 if False:
-    from typing import Any, Optional, Iterable, Sequence, Tuple, Text, List, FrozenSet  # noqa
+    from typing import Any, Optional, Iterable, Sequence, Tuple, Text, List, FrozenSet, Dict  # noqa
     import datetime  # noqa
     from course.models import Course  # noqa
     from course.utils import (  # noqa
@@ -318,8 +318,15 @@ def adjust_flow_session_page_data(repo, flow_session,
 # {{{ grade page visit
 
 def grade_page_visit(visit, visit_grade_model=FlowPageVisitGrade,
-        grade_data=None, respect_preview=True):
-    # type: (FlowPageVisit, type, Any, bool) -> None
+        grade_data=None, respect_preview=True, precomputed_feedback=None):
+    # type: (FlowPageVisit, type, Any, bool, Optional[Dict[int, Optional[AnswerFeedback]]]) -> None  # noqa
+    """
+    :arg precomputed_feedback: if not *None*, a dictionary mapping visit IDs
+        to answer feedback, as obtained from :func:`precompute_regrade_feedback`.
+        If *visit* is found in it, the feedback is used instead of grading
+        the page.
+    """
+
     if not visit.is_submitted_answer:
         raise RuntimeError(_("cannot grade ungraded answer"))
 
@@ -367,10 +374,21 @@ def grade_page_visit(visit, visit_grade_model=FlowPageVisitGrade,
                 commit_sha=course_commit_sha,
                 flow_session=flow_session)
 
-        with translation.override(settings.RELATE_ADMIN_EMAIL_LOCALE):
-            answer_feedback = page.grade(
-                    grading_page_context, visit.page_data.data,
-                    visit.answer, grade_data=grade_data)
+        if (precomputed_feedback is not None
+                and visit.id in precomputed_feedback):
+            answer_feedback = precomputed_feedback[visit.id]
+        else:
+            with translation.override(settings.RELATE_ADMIN_EMAIL_LOCALE):
+                answer_feedback = page.grade(
+                        grading_page_context, visit.page_data.data,
+                        visit.answer, grade_data=grade_data)
+
+        if answer_feedback is not None and answer_feedback.is_deferred:
+            # The answer could not be graded right now (e.g. the code
+            # servers were busy). Keep the grade we have, if any. Otherwise,
+            # the visit stays ungraded, so that grade_page_visits grades it
+            # again.
+            return
 
         grade = visit_grade_model()
         grade.visit = visit
@@ -387,6 +405,104 @@ def grade_page_visit(visit, visit_grade_model=FlowPageVisitGrade,
 
         update_bulk_feedback(page_data, grade, bulk_feedback_json)
 
+
+def precompute_regrade_feedback(
+        repo,  # type: Repo_ish
+        course,  # type: Course
+        sessions,  # type: Iterable[FlowSession]
+        ):
+    # type: (...) -> Dict[int, Optional[AnswerFeedback]]
+    """Grade the answer visits that :func:`regrade_session` would regrade
+    in *sessions*, with visits to the same page graded together through
+    :meth:`course.page.base.PageBase.grade_multiple`. For code questions,
+    this runs all answers to a page in a single container.
+
+    :returns: a dictionary mapping visit IDs to answer feedback, suitable for
+        passing as *precomputed_feedback* to :func:`regrade_session`.
+    """
+
+    from course.content import (
+            get_course_commit_sha,
+            get_flow_desc,
+            get_flow_page_desc,
+            instantiate_flow_page)
+
+    # {{{ gather visits by page
+
+    visits_by_page = {}  # type: Dict[Tuple[Text, Text, Text], List[Tuple[FlowPageVisit, Any]]]  # noqa
+
+    for session in sessions:
+        adjust_flow_session_page_data(repo, session, course.identifier,
+                respect_preview=False)
+
+        for visit in assemble_answer_visits(session):
+            if visit is None:
+                continue
+
+            most_recent_grade = visit.get_most_recent_grade()
+            if session.in_progress and most_recent_grade is None:
+                # regrade_session only regrades pages that already have
+                # a grade.
+                continue
+
+            grade_data = None
+            if most_recent_grade is not None:
+                grade_data = most_recent_grade.grade_data
+
+            visits_by_page.setdefault(
+                    (session.flow_id,
+                        visit.page_data.group_id, visit.page_data.page_id),
+                    []).append((visit, grade_data))
+
+    # }}}
+
+    course_commit_sha = get_course_commit_sha(course, None)
+
+    from course.page import PageContext
+
+    precomputed_feedback = {}  # type: Dict[int, Optional[AnswerFeedback]]
+
+    for (flow_id, group_id, page_id), visits_and_grade_data in (
+            six.iteritems(visits_by_page)):
+        flow_desc = get_flow_desc(repo, course, flow_id, course_commit_sha)
+
+        try:
+            page_desc = get_flow_page_desc(
+                    flow_id, flow_desc, group_id, page_id)
+        except ObjectDoesNotExist:
+            # Leave it to grade_page_visit to deal with this.
+            continue
+
+        page = instantiate_flow_page(
+                location="flow '%s', group, '%s', page '%s'"
+                % (flow_id, group_id, page_id),
+                repo=repo, page_desc=page_desc,
+                commit_sha=course_commit_sha)
+
+        if not page.expects_answer() or not page.is_answer_gradable():
+            continue
+
+        with translation.override(settings.RELATE_ADMIN_EMAIL_LOCALE):
+            answer_feedbacks = page.grade_multiple(
+                    [PageContext(
+                        course=course,
+                        repo=repo,
+                        commit_sha=course_commit_sha,
+                        flow_session=visit.flow_session)
+                        for visit, grade_data in visits_and_grade_data],
+                    [visit.page_data.data
+                        for visit, grade_data in visits_and_grade_data],
+                    [visit.answer
+                        for visit, grade_data in visits_and_grade_data],
+                    [grade_data
+                        for visit, grade_data in visits_and_grade_data])
+
+        for (visit, grade_data), answer_feedback in zip(
+                visits_and_grade_data, answer_feedbacks):
+            precomputed_feedback[visit.id] = answer_feedback
+
+    return precomputed_feedback
+
 # }}}
 
 
@@ -489,6 +605,7 @@ def get_prev_answer_visits_qset(page_data):
     return (
             get_flow_session_graded_answers_qset(page_data.flow_session)
             .filter(page_data=page_data)
+            .select_related("latest_grade")
             .order_by("-visit_time"))
 
 
@@ -515,7 +632,7 @@ def assemble_page_grades(flow_sessions):
     of the lists may vary since the flow page count may vary per session.
     """
     id_to_fsess_idx = {fsess.id: i for i, fsess in enumerate(flow_sessions)}
-    answer_visit_ids = [
+    answer_grade_ids = [
             [None] * fsess.page_count for fsess in flow_sessions
             ]  # type: List[List[Optional[int]]]
 
@@ -524,41 +641,37 @@ def assemble_page_grades(flow_sessions):
     all_answer_visits = (
         get_multiple_flow_session_graded_answers_qset(flow_sessions)
         .order_by("visit_time")
-        .values("id", "flow_session_id", "page_data__page_ordinal",
+        .values("latest_grade_id", "flow_session_id", "page_data__page_ordinal",
                 "is_submitted_answer"))
 
     for answer_visit in all_answer_visits:
         fsess_idx = id_to_fsess_idx[answer_visit["flow_session_id"]]
         page_ordinal = answer_visit["page_data__page_ordinal"]
         if page_ordinal is not None:
-            answer_visit_ids[fsess_idx][page_ordinal] = answer_visit["id"]
+            answer_grade_ids[fsess_idx][page_ordinal] = \
+                    answer_visit["latest_grade_id"]
 
         if not flow_sessions[fsess_idx].in_progress:
             assert answer_visit["is_submitted_answer"] is True
 
-    flat_answer_visit_ids = []
-    for visit_id_list in answer_visit_ids:
-        for visit_id in visit_id_list:
-            if visit_id is not None:
-                flat_answer_visit_ids.append(visit_id)
-
-    # Get all grade visits associated with the answer visits.
-    grades = (FlowPageVisitGrade.objects
-              .filter(visit__in=flat_answer_visit_ids)
-              .order_by("visit__id")
-              .order_by("grade_time"))
+    flat_answer_grade_ids = []
+    for grade_id_list in answer_grade_ids:
+        for grade_id in grade_id_list:
+            if grade_id is not None:
+                flat_answer_grade_ids.append(grade_id)
 
-    grades_by_answer_visit = {}
-    for grade in grades:
-        grades_by_answer_visit[grade.visit_id] = grade
+    # Get the most recent grades of the answer visits.
+    grades_by_id = dict(
+            (grade.id, grade)
+            for grade in FlowPageVisitGrade.objects.filter(
+                id__in=flat_answer_grade_ids))
 
-    def get_grades_for_visit_group(visit_group):
-        # type: (List[Optional[int]]) -> List[Optional[FlowPageVisit]]
+    def get_grades_for_grade_id_group(grade_id_group):
+        # type: (List[Optional[int]]) -> List[Optional[FlowPageVisitGrade]]
 
-        return [grades_by_answer_visit.get(visit_id)
-            for visit_id in visit_group]
+        return [grades_by_id.get(grade_id) for grade_id in grade_id_group]
 
-    return [get_grades_for_visit_group(group) for group in answer_visit_ids]
+    return [get_grades_for_grade_id_group(group) for group in answer_grade_ids]
 
 
 def assemble_answer_visits(flow_session):
@@ -568,6 +681,8 @@ def assemble_answer_visits(flow_session):
 
     answer_page_visits = (
             get_flow_session_graded_answers_qset(flow_session)
+            .select_related("page_data")
+            .select_related("latest_grade")
             .order_by("visit_time"))
 
     for page_visit in answer_page_visits:
@@ -917,6 +1032,7 @@ def grade_page_visits(
         answer_visits,  # type: List[Optional[FlowPageVisit]]
         force_regrade=False,  # type: bool
         respect_preview=True,  # type: bool
+        precomputed_feedback=None,  # type: Optional[Dict[int, Optional[AnswerFeedback]]]  # noqa
         ):
     # type: (...) -> None
     for i in range(len(answer_visits)):
@@ -940,6 +1056,7 @@ def grade_page_visits(
             new_answer_visit.page_data = page_data
             new_answer_visit.is_synthetic = True
             new_answer_visit.answer = None
+            new_answer_visit.store_normalized_answer(page, None)
             new_answer_visit.is_submitted_answer = True
             new_answer_visit.save()
 
@@ -949,14 +1066,17 @@ def grade_page_visits(
                 continue
 
         if answer_visit is not None:
-            if not answer_visit.grades.count() or force_regrade:  # type: ignore
-                grade_page_visit(answer_visit, respect_preview=respect_preview)
+            if answer_visit.latest_grade_id is None or force_regrade:
+                grade_page_visit(answer_visit, respect_preview=respect_preview,
+                        precomputed_feedback=precomputed_feedback)
 
 
 @retry_transaction_decorator()
 def finish_flow_session(fctx, flow_session, grading_rule,
-        force_regrade=False, now_datetime=None, respect_preview=True):
+        force_regrade=False, now_datetime=None, respect_preview=True,
+        precomputed_feedback=None):
     """
+    :arg precomputed_feedback: see :func:`grade_page_visit`.
     :returns: :class:`GradeInfo`
     """
     # Do not be tempted to call adjust_flow_session_page_data in here.
@@ -975,7 +1095,8 @@ def finish_flow_session(fctx, flow_session, grading_rule,
 
     grade_page_visits(fctx, flow_session, answer_visits,
             force_regrade=force_regrade,
-            respect_preview=respect_preview)
+            respect_preview=respect_preview,
+            precomputed_feedback=precomputed_feedback)
 
     # ORDERING RESTRICTION: Must grade pages before gathering grade info
 
@@ -1225,6 +1346,7 @@ def finish_flow_session_standalone(
         now_datetime=None,  # type: Optional[datetime.datetime]
         past_due_only=False,  # type: bool
         respect_preview=True,  # type:bool
+        precomputed_feedback=None,  # type: Optional[Dict[int, Optional[AnswerFeedback]]]  # noqa
         ):
     # type: (...) -> bool
 
@@ -1253,7 +1375,8 @@ def finish_flow_session_standalone(
     finish_flow_session(fctx, session, grading_rule,
             force_regrade=force_regrade,
             now_datetime=now_datetime_filled,
-            respect_preview=respect_preview)
+            respect_preview=respect_preview,
+            precomputed_feedback=precomputed_feedback)
 
     return True
 
@@ -1280,8 +1403,13 @@ def regrade_session(
         repo,  # type: Repo_ish
         course,  # type: Course
         session,  # type: FlowSession
+        precomputed_feedback=None,  # type: Optional[Dict[int, Optional[AnswerFeedback]]]  # noqa
         ):
     # type: (...) -> None
+    """
+    :arg precomputed_feedback: see :func:`precompute_regrade_feedback`.
+    """
+
     adjust_flow_session_page_data(repo, session, course.identifier,
             respect_preview=False)
 
@@ -1295,7 +1423,8 @@ def regrade_session(
                 if answer_visit is not None:
                     if answer_visit.get_most_recent_grade():
                         # Only make a new grade if there already is one.
-                        grade_page_visit(answer_visit, respect_preview=False)
+                        grade_page_visit(answer_visit, respect_preview=False,
+                                precomputed_feedback=precomputed_feedback)
     else:
         prev_completion_time = session.completion_time
 
@@ -1311,7 +1440,8 @@ def regrade_session(
             finish_flow_session_standalone(
                     repo, course, session, force_regrade=True,
                     now_datetime=prev_completion_time,
-                    respect_preview=False)
+                    respect_preview=False,
+                    precomputed_feedback=precomputed_feedback)
 
 
 def recalculate_session_grade(repo, course, session):
@@ -1358,6 +1488,13 @@ def lock_down_if_needed(
                 "relate_session_locked_to_exam_flow_session_pk"] = \
                         flow_session.pk
 
+        # for course.exam.ExamLockdownMiddleware
+        request.session[
+                "relate_session_locked_to_exam_course_identifier"] = \
+                        flow_session.course.identifier
+        request.session[
+                "relate_session_locked_to_exam_flow_id"] = flow_session.flow_id
+
 
 # {{{ view: start flow
 
@@ -2202,6 +2339,14 @@ def post_flow_page(
         if hasattr(request, "relate_impersonate_original_user"):
             answer_visit.impersonated_by = \
                 request.relate_impersonate_original_user
+        try:
+            answer_visit.store_normalized_answer(fpctx.page, page_context)
+        except Exception:
+            # The normalized answer is only used by the analytics, and
+            # must not keep the answer from being saved. Without a digest,
+            # it gets filled in later (see backfill_normalized_answers).
+            answer_visit.normalized_answer = None
+            answer_visit.normalized_answer_digest = None
         answer_visit.save()
 
         prev_answer_visits.insert(0, answer_visit)
@@ -2222,7 +2367,10 @@ def post_flow_page(
                         page_context, page_data.data, answer_visit.answer,
                         grade_data=None)  # type: Optional[AnswerFeedback]
 
-            if answer_visit.is_submitted_answer:
+            if (answer_visit.is_submitted_answer
+                    and not (feedback is not None and feedback.is_deferred)):
+                # Deferred feedback is not stored, so that the answer
+                # is graded again once the session is finished.
                 grade = FlowPageVisitGrade()
                 grade.visit = answer_visit
                 grade.max_points = fpctx.page.max_points(page_data.data)
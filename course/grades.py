@@ -35,8 +35,8 @@ from django.shortcuts import (  # noqa
         render, redirect, get_object_or_404)
 from django.contrib import messages  # noqa
 from django.core.exceptions import (
-        PermissionDenied, SuspiciousOperation, ObjectDoesNotExist)
-from django.db import connection
+        PermissionDenied, SuspiciousOperation, ObjectDoesNotExist,
+        ImproperlyConfigured)
 from django import forms
 from django.db import transaction
 from django.utils.timezone import now
@@ -51,18 +51,23 @@ from course.utils import course_view, render_course_page
 from course.models import (
         Participation, participation_status,
         GradingOpportunity, GradeChange, GradeStateMachine,
+        CurrentGradeState,
         grade_state_change_types,
         FlowSession, FlowPageVisit)
 from course.flow import adjust_flow_session_page_data
 from course.views import get_now_or_fake_time
 from course.constants import (
         participation_permission as pperm,
+        grade_aggregation_strategy,
         )
 
 # {{{ for mypy
 
 if False:
-    from typing import Tuple, Text, Optional, Any, Iterable, List  # noqa
+    from typing import (  # noqa
+        Tuple, Text, Optional, Any, Iterable, List, Dict, Set, Callable)
+    from django.db.models import query  # noqa
+    from relate.utils import Repo_ish  # noqa
     from course.utils import CoursePageContext  # noqa
     from course.content import FlowDesc  # noqa
     from course.models import Course, FlowPageVisitGrade  # noqa
@@ -174,6 +179,192 @@ def view_participant_list(pctx):
 # }}}
 
 
+# {{{ grade matrix
+
+_AGGREGATION_STRATEGY_CODES = dict(
+        (strategy, code)
+        for code, strategy in enumerate([
+            grade_aggregation_strategy.max_grade,
+            grade_aggregation_strategy.avg_grade,
+            grade_aggregation_strategy.min_grade,
+            grade_aggregation_strategy.use_earliest,
+            grade_aggregation_strategy.use_latest,
+            ]))
+
+
+class GradeMatrix(object):
+    """Aggregated grade percentages of a set of participations for a set
+    of grading opportunities, obtained in a columnar fashion.
+
+    .. attribute:: participation_ids
+
+        A sorted :mod:`numpy` integer array of the participation IDs that
+        have a grade history for at least one of :attr:`opportunities`.
+
+    .. attribute:: opportunities
+
+        A list of :class:`course.models.GradingOpportunity` instances.
+
+    .. attribute:: percentages
+
+        A :mod:`numpy` array of shape
+        ``(len(participation_ids), len(opportunities))``, with each entry
+        equal to :meth:`course.models.GradeStateMachine.percentage` for
+        the corresponding participation and opportunity, or NaN where
+        that is *None*.
+
+    .. attribute:: counts
+
+        The number of non-NaN percentages for each opportunity.
+
+    .. attribute:: averages
+
+        The mean of the non-NaN percentages for each opportunity, or NaN
+        if there are none.
+    """
+
+    def __init__(self, opportunities, participations):
+        # type: (List[GradingOpportunity], Any) -> None
+
+        """
+        :arg participations: a queryset of
+            :class:`course.models.Participation` to which the matrix is
+            restricted.
+        """
+
+        import numpy as np
+
+        self.opportunities = opportunities
+        opp_ids = [opp.id for opp in opportunities]
+
+        # {{{ gather (participation, opportunity, valid percentages) columns
+
+        # Grade histories without a current grade state get replayed, to
+        # obtain the same result (or error) as get_grade_table.
+        from django.db.models import Exists, OuterRef
+        unmaterialized_grade_changes = (GradeChange.objects
+                .filter(
+                    opportunity__in=opp_ids,
+                    participation__in=participations)
+                .annotate(has_current_state=Exists(
+                    CurrentGradeState.objects.filter(
+                        participation=OuterRef("participation"),
+                        opportunity=OuterRef("opportunity"))))
+                .filter(has_current_state=False)
+                .order_by("grade_time")
+                .select_related("opportunity"))
+
+        pair_to_grade_changes = {}  # type: Dict[Tuple[int, int], List[GradeChange]]  # noqa
+        for gchange in unmaterialized_grade_changes:
+            pair_to_grade_changes.setdefault(
+                    (gchange.participation_id, gchange.opportunity_id),
+                    []).append(gchange)
+
+        pair_participation_ids = []
+        pair_opp_ids = []
+        pair_lengths = []
+        values = []  # type: List[Any]
+
+        def add_pair(participation_id, opp_id, valid_percentages):
+            pair_participation_ids.append(participation_id)
+            pair_opp_ids.append(opp_id)
+            pair_lengths.append(len(valid_percentages))
+            # Grades without points have a percentage of None.
+            values.extend(
+                    float(pct) if pct is not None else np.nan
+                    for pct in valid_percentages)
+
+        # (values_list would skip decoding of the JSON field.)
+        for cgstate in (CurrentGradeState.objects
+                .filter(
+                    opportunity__in=opp_ids,
+                    participation__in=participations)
+                .only(
+                    "participation_id", "opportunity_id", "valid_percentages")
+                .iterator()):
+            add_pair(cgstate.participation_id, cgstate.opportunity_id,
+                    cgstate.valid_percentages)
+
+        for (participation_id, opp_id), grade_changes in six.iteritems(
+                pair_to_grade_changes):
+            add_pair(participation_id, opp_id,
+                    GradeStateMachine().consume(grade_changes).valid_percentages)
+
+        # }}}
+
+        lengths = np.array(pair_lengths, dtype=np.intp)
+        values = np.array(values, dtype=np.float64)
+
+        # {{{ aggregate each pair's percentages by its opportunity's strategy
+
+        opp_id_to_col = dict((opp_id, i) for i, opp_id in enumerate(opp_ids))
+        cols = np.array(
+                [opp_id_to_col[opp_id] for opp_id in pair_opp_ids],
+                dtype=np.intp)
+
+        # An unknown strategy yields no percentages for its opportunity,
+        # rather than failing the whole matrix.
+        strategy_codes = np.array(
+                [_AGGREGATION_STRATEGY_CODES.get(opp.aggregation_strategy, -1)
+                    for opp in opportunities],
+                dtype=np.intp)[cols]
+
+        pair_percentages = np.full(len(lengths), np.nan)
+
+        has_values = (lengths > 0) & (strategy_codes >= 0)
+        starts = (np.cumsum(lengths) - lengths)[has_values]
+        ends = starts + lengths[has_values] - 1
+
+        if len(starts):
+            # NaN-aware: fmax/fmin ignore NaNs, and the average is taken
+            # over the non-NaN percentages only.
+            is_number = ~np.isnan(values)
+            number_counts = np.add.reduceat(is_number.astype(np.intp), starts)
+            number_sums = np.add.reduceat(
+                    np.where(is_number, values, 0), starts)
+            averages = np.full(len(starts), np.nan)
+            np.divide(number_sums, number_counts, out=averages,
+                    where=number_counts > 0)
+
+            aggregates = np.array([
+                np.fmax.reduceat(values, starts),
+                averages,
+                np.fmin.reduceat(values, starts),
+                values[starts],
+                values[ends],
+                ])
+            pair_percentages[has_values] = aggregates[
+                    strategy_codes[has_values],
+                    np.arange(len(starts))]
+
+        # }}}
+
+        self.participation_ids, rows = np.unique(
+                np.array(pair_participation_ids, dtype=np.intp),
+                return_inverse=True)
+
+        self.percentages = np.full(
+                (len(self.participation_ids), len(opportunities)), np.nan)
+        self.percentages[rows, cols] = pair_percentages
+
+        graded = ~np.isnan(self.percentages)
+        self.counts = graded.sum(axis=0)
+        sums = np.where(graded, self.percentages, 0).sum(axis=0)
+        self.averages = np.full(len(opportunities), np.nan)
+        np.divide(sums, self.counts, out=self.averages, where=self.counts > 0)
+
+
+def get_grade_statistics_participations(course):
+    return (Participation.objects
+            .filter(
+                course=course,
+                roles__permissions__permission=(
+                    pperm.included_in_grade_statistics))
+            .distinct())
+
+# }}}
+
+
 # {{{ grading opportunity list
 
 @course_view
@@ -187,8 +378,19 @@ def view_grading_opportunity_list(pctx):
                 )
             .order_by("identifier")))
 
+    grade_matrix = GradeMatrix(grading_opps,
+            get_grade_statistics_participations(pctx.course))
+
+    import numpy as np
+    grading_opps_and_stats = [
+            (opp,
+                None if np.isnan(average) else float(average),
+                int(count))
+            for opp, average, count in zip(
+                grading_opps, grade_matrix.averages, grade_matrix.counts)]
+
     return render_course_page(pctx, "course/gradebook-opp-list.html", {
-        "grading_opps": grading_opps,
+        "grading_opps_and_stats": grading_opps_and_stats,
         })
 
 # }}}
@@ -203,71 +405,114 @@ class GradeInfo:
         self.grade_state_machine = grade_state_machine
 
 
-def get_grade_table(course):
-    # type: (Course) -> Tuple[List[Participation], List[GradingOpportunity], List[List[GradeInfo]]]  # noqa
-
-    # NOTE: It's important that these queries are sorted consistently,
-    # also consistently with the code below.
-    grading_opps = list((GradingOpportunity.objects
+def get_gradebook_opportunities(course):
+    # type: (Course) -> List[GradingOpportunity]
+    return list((GradingOpportunity.objects
             .filter(
                 course=course,
                 shown_in_grade_book=True,
                 )
             .order_by("identifier")))
 
-    participations = list(Participation.objects
-            .filter(
-                course=course,
-                status=participation_status.active)
-            .order_by("id")
-            .select_related("user"))
 
-    grade_changes = list(GradeChange.objects
+def iter_grade_table_rows(course, grading_opps, participations=None):
+    # type: (Course, List[GradingOpportunity], Optional[query.QuerySet]) -> Iterable[Tuple[Participation, List[GradeInfo]]]  # noqa
+
+    """Generate a pair ``(participation, grade_row)`` for each active
+    participation in *course*, in order of their IDs, where *grade_row*
+    contains a :class:`GradeInfo` for each of *grading_opps*.
+
+    Participations and their current grade states are read through
+    database cursors as the rows are consumed, so that the whole table
+    need not be held in memory.
+
+    :arg participations: if given, a query set of
+        :class:`course.models.Participation` to which the table is
+        restricted, instead of all active participations in *course*.
+    """
+
+    if participations is None:
+        participations = (Participation.objects
+                .filter(
+                    course=course,
+                    status=participation_status.active))
+
+    grading_opp_ids = [opp.id for opp in grading_opps]
+
+    # Grade histories without a current grade state (e.g. because they
+    # are not valid) get replayed, to obtain the same result (or error)
+    # as before the state was materialized.
+    from django.db.models import Exists, OuterRef
+    unmaterialized_grade_changes = (GradeChange.objects
             .filter(
-                opportunity__course=course,
-                opportunity__shown_in_grade_book=True)
-            .order_by(
-                "participation__id",
-                "opportunity__identifier",
-                "grade_time")
-            .select_related("participation")
-            .select_related("participation__user")
+                opportunity__in=grading_opp_ids,
+                participation__in=participations)
+            .annotate(has_current_state=Exists(
+                CurrentGradeState.objects.filter(
+                    participation=OuterRef("participation"),
+                    opportunity=OuterRef("opportunity"))))
+            .filter(has_current_state=False)
+            .order_by("grade_time")
             .select_related("opportunity"))
 
-    idx = 0
+    pair_to_grade_changes = {}  # type: Dict[Tuple[int, int], List[GradeChange]]
+    for gchange in unmaterialized_grade_changes:
+        pair_to_grade_changes.setdefault(
+                (gchange.participation_id, gchange.opportunity_id), []).append(
+                        gchange)
 
-    grade_table = []
-    for participation in participations:
-        while (
-                idx < len(grade_changes)
-                and grade_changes[idx].participation.id < participation.id):
-            idx += 1
+    # Both are sorted by participation ID, so they can be merged.
+    grade_states = (CurrentGradeState.objects
+            .filter(
+                opportunity__in=grading_opp_ids,
+                participation__in=participations)
+            .order_by("participation_id")
+            .select_related("opportunity")
+            .iterator())
+    next_grade_state = next(grade_states, None)
+
+    for participation in (participations
+            .order_by("id")
+            .select_related("user")
+            .iterator()):
+        participation_grade_states = {}
+        while (next_grade_state is not None
+                and next_grade_state.participation_id <= participation.id):
+            if next_grade_state.participation_id == participation.id:
+                participation_grade_states[next_grade_state.opportunity_id] = \
+                        next_grade_state
+            next_grade_state = next(grade_states, None)
 
         grade_row = []
         for opp in grading_opps:
-            while (
-                    idx < len(grade_changes)
-                    and grade_changes[idx].participation.pk == participation.pk
-                    and grade_changes[idx].opportunity.identifier < opp.identifier
-                    ):
-                idx += 1
-
-            my_grade_changes = []
-            while (
-                    idx < len(grade_changes)
-                    and grade_changes[idx].opportunity.pk == opp.pk
-                    and grade_changes[idx].participation.pk == participation.pk):
-                my_grade_changes.append(grade_changes[idx])
-                idx += 1
-
-            state_machine = GradeStateMachine()
-            state_machine.consume(my_grade_changes)
+            key = (participation.id, opp.id)
+            if key in pair_to_grade_changes:
+                state_machine = GradeStateMachine()
+                state_machine.consume(pair_to_grade_changes[key])
+            elif opp.id in participation_grade_states:
+                state_machine = (
+                        participation_grade_states[opp.id]
+                        .get_grade_state_machine())
+            else:
+                state_machine = GradeStateMachine()
 
             grade_row.append(
                     GradeInfo(
                         opportunity=opp,
                         grade_state_machine=state_machine))
 
+        yield participation, grade_row
+
+
+def get_grade_table(course):
+    # type: (Course) -> Tuple[List[Participation], List[GradingOpportunity], List[List[GradeInfo]]]  # noqa
+
+    grading_opps = get_gradebook_opportunities(course)
+
+    participations = []
+    grade_table = []
+    for participation, grade_row in iter_grade_table_rows(course, grading_opps):
+        participations.append(participation)
         grade_table.append(grade_row)
 
     return participations, grading_opps, grade_table
@@ -278,20 +523,215 @@ def view_gradebook(pctx):
     if not pctx.has_permission(pperm.view_gradebook):
         raise PermissionDenied(_("may not view grade book"))
 
-    participations, grading_opps, grade_table = get_grade_table(pctx.course)
+    # The rows are fetched page by page through view_gradebook_data.
+    return render_course_page(pctx, "course/gradebook.html", {
+        "grading_opportunities": get_gradebook_opportunities(pctx.course),
+        })
 
-    def grade_key(entry):
-        (participation, grades) = entry
-        return (participation.user.last_name.lower(),
-                    participation.user.first_name.lower())
 
-    grade_table = sorted(zip(participations, grade_table), key=grade_key)
+# Upper bound on the number of rows served by view_gradebook_data at once
+GRADEBOOK_DATA_MAX_PAGE_LENGTH = 500
 
-    return render_course_page(pctx, "course/gradebook.html", {
-        "grade_table": grade_table,
-        "grading_opportunities": grading_opps,
-        "participations": participations,
-        "grade_state_change_types": grade_state_change_types,
+
+def _get_int_param(request, name, default):
+    # type: (http.HttpRequest, Text, int) -> int
+    try:
+        return int(request.GET.get(name, default))
+    except ValueError:
+        raise SuspiciousOperation(_("invalid '%s' parameter") % name)
+
+
+def get_sorted_gradebook_participation_ids(course, participations, sort_column,
+        descending):
+    # type: (Course, query.QuerySet, Text, bool) -> List[int]
+
+    """
+    :arg participations: a query set of :class:`course.models.Participation`.
+    :arg sort_column: ``"username"``, ``"name"``, ``"id"`` or the ID of a
+        :class:`course.models.GradingOpportunity` in *course*, as a string.
+    :returns: the IDs of *participations*, in the requested order.
+    """
+
+    from django.db.models.functions import Lower
+
+    if sort_column in ["username", "name", "id"]:
+        order_by = {
+                "username": [Lower("user__username")],
+                "name": [Lower("user__last_name"), Lower("user__first_name")],
+                "id": [],
+                }[sort_column]
+        if descending:
+            order_by = [field.desc() for field in order_by]
+
+        return list(participations
+                .order_by(*(order_by + ["id"]))
+                .values_list("id", flat=True))
+
+    # Percentages depend on the opportunity's aggregation strategy, which
+    # is not expressible in SQL. Only this one column is gathered to sort
+    # by it.
+    try:
+        opp = GradingOpportunity.objects.get(course=course, id=int(sort_column))
+    except (ValueError, ObjectDoesNotExist):
+        raise SuspiciousOperation(_("invalid sort column"))
+
+    import numpy as np
+    participation_ids = np.array(
+            participations.order_by("id").values_list("id", flat=True),
+            dtype=np.intp)
+
+    grade_matrix = GradeMatrix([opp], participations)
+
+    # Ungraded participations sort before all graded ones.
+    sort_keys = np.full(len(participation_ids), -1.)
+    graded_percentages = np.nan_to_num(grade_matrix.percentages[:, 0])
+    sort_keys[np.searchsorted(participation_ids, grade_matrix.participation_ids)] \
+            = graded_percentages
+
+    if descending:
+        sort_keys = -sort_keys
+
+    return [int(pid)
+            for pid in participation_ids[np.argsort(sort_keys, kind="mergesort")]]
+
+
+def _percentage_to_json(percentage):
+    # type: (Any) -> Optional[float]
+    if percentage is None:
+        return None
+    return float(percentage)
+
+
+@course_view
+def view_gradebook_data(pctx):
+    """Serve a page of the grade book as JSON, in the format expected by
+    the server-side processing mode of DataTables. Besides the DataTables
+    parameters ``draw``, ``start``, ``length``, ``search[value]`` and
+    ``order[0][column]``/``order[0][dir]`` (which refer to the ``name``
+    given in ``columns[i][name]``), ``opportunity`` may be given (repeatedly)
+    to restrict the grade columns to those opportunity IDs.
+    """
+
+    if not pctx.has_permission(pperm.view_gradebook):
+        raise PermissionDenied(_("may not view grade book"))
+
+    request = pctx.request
+    is_masked = pctx.has_permission(pperm.view_participant_masked_profile)
+
+    grading_opps = get_gradebook_opportunities(pctx.course)
+    if "opportunity" in request.GET:
+        try:
+            requested_opp_ids = set(
+                    int(opp_id) for opp_id in request.GET.getlist("opportunity"))
+        except ValueError:
+            raise SuspiciousOperation(_("invalid 'opportunity' parameter"))
+        grading_opps = [opp for opp in grading_opps if opp.id in requested_opp_ids]
+
+    start = max(0, _get_int_param(request, "start", 0))
+    length = _get_int_param(request, "length", GRADEBOOK_DATA_MAX_PAGE_LENGTH)
+    if length < 0 or length > GRADEBOOK_DATA_MAX_PAGE_LENGTH:
+        length = GRADEBOOK_DATA_MAX_PAGE_LENGTH
+
+    # {{{ filter
+
+    all_participations = (Participation.objects
+            .filter(
+                course=pctx.course,
+                status=participation_status.active))
+    participations = all_participations
+
+    search = request.GET.get("search[value]", "").strip()
+    if search and not is_masked:
+        from django.db.models import Q
+        for word in search.split():
+            participations = participations.filter(
+                    Q(user__username__icontains=word)
+                    | Q(user__first_name__icontains=word)
+                    | Q(user__last_name__icontains=word))
+
+    # }}}
+
+    # {{{ sort
+
+    sort_column = "name"
+    if "order[0][column]" in request.GET:
+        order_column_idx = _get_int_param(request, "order[0][column]", 0)
+        sort_column = request.GET.get(
+                "columns[%d][name]" % order_column_idx, sort_column)
+    descending = request.GET.get("order[0][dir]") == "desc"
+
+    if is_masked and sort_column in ["username", "name"]:
+        # Masked profiles are derived from the user ID.
+        sort_column = "id"
+
+    participation_ids = get_sorted_gradebook_participation_ids(
+            pctx.course, participations, sort_column, descending)
+
+    # }}}
+
+    page_participation_ids = participation_ids[start:start+length]
+
+    page_participations = (Participation.objects
+            .filter(id__in=page_participation_ids))
+    id_to_grade_row = dict(
+            (participation.id, (participation, grade_row))
+            for participation, grade_row in iter_grade_table_rows(
+                pctx.course, grading_opps, page_participations))
+
+    from django.db.models import Q
+    privileged_ids = set(page_participations
+            .filter(
+                Q(roles__permissions__permission=pperm.view_gradebook,
+                    roles__permissions__argument__isnull=True)
+                | Q(individual_permissions__permission=pperm.view_gradebook,
+                    individual_permissions__argument__isnull=True))
+            .values_list("id", flat=True))
+    id_to_role_desc = dict(
+            (participation.id, participation.get_role_desc())
+            for participation in (Participation.objects
+                .filter(id__in=privileged_ids)
+                .prefetch_related("roles")))
+
+    rows = []
+    for participation_id in page_participation_ids:
+        participation, grade_row = id_to_grade_row[participation_id]
+        user = participation.user
+
+        if is_masked:
+            user_desc = (
+                    ugettext("Me") if user == request.user
+                    else six.text_type(user.get_masked_profile()))
+            full_name = None
+        else:
+            user_desc = user.username
+            full_name = six.text_type(user.get_full_name())
+
+        rows.append({
+            "participation_id": participation.id,
+            "user": user_desc,
+            "name": full_name,
+            "role": id_to_role_desc.get(participation.id),
+            "url": reverse("relate-view_participant_grades",
+                args=(pctx.course.identifier, participation.id)),
+            "grades": [
+                {
+                    "state": six.text_type(
+                        grade_info.grade_state_machine.stringify_state()),
+                    "percentage": _percentage_to_json(
+                        grade_info.grade_state_machine.percentage()),
+                    "url": reverse("relate-view_single_grade",
+                        args=(pctx.course.identifier, participation.id,
+                            grade_info.opportunity.id)),
+                    }
+                for grade_info in grade_row],
+            })
+
+    return http.JsonResponse({
+        "draw": _get_int_param(request, "draw", 0),
+        "recordsTotal": all_participations.count(),
+        "recordsFiltered": len(participation_ids),
+        "opportunity_ids": [opp.id for opp in grading_opps],
+        "data": rows,
         })
 
 
@@ -300,38 +740,263 @@ def export_gradebook_csv(pctx):
     if not pctx.has_permission(pperm.batch_export_grade):
         raise PermissionDenied(_("may not batch-export grades"))
 
-    participations, grading_opps, grade_table = get_grade_table(pctx.course)
+    grading_opps = get_gradebook_opportunities(pctx.course)
 
-    from six import StringIO
-    csvfile = StringIO()
+    def generate_rows():
+        yield ['user_name', 'last_name', 'first_name'] + [
+                gopp.identifier for gopp in grading_opps]
 
-    if six.PY2:
-        import unicodecsv as csv
-    else:
-        import csv
+        for participation, grades in iter_grade_table_rows(
+                pctx.course, grading_opps):
+            yield [
+                participation.user.username,
+                participation.user.last_name,
+                participation.user.first_name,
+                ] + [grade_info.grade_state_machine
+                        .stringify_machine_readable_state()
+                    for grade_info in grades]
+
+    from course.utils import make_streaming_csv_response
+    return make_streaming_csv_response(
+            generate_rows(), "grades-%s.csv" % pctx.course.identifier)
+
+# }}}
+
+
+# {{{ grade summaries by grading opportunity
 
-    fieldnames = ['user_name', 'last_name', 'first_name'] + [
-            gopp.identifier for gopp in grading_opps]
+# Cached summaries are dropped whenever the grade changes or flow sessions
+# they summarize are saved. This only bounds the staleness resulting from
+# changes that bypass model signals.
+#
+# Summaries are only cached if the cache is shared among processes (see
+# relate.utils.is_cache_shared), since dropping them would otherwise only
+# reach the process that saved the change.
+OPPORTUNITY_SUMMARY_CACHE_TIMEOUT = 60 * 60
 
-    writer = csv.writer(csvfile)
 
-    writer.writerow(fieldnames)
+def _get_summary_cache():
+    from relate.utils import is_cache_shared
+    if not is_cache_shared():
+        return None
+
+    try:
+        import django.core.cache as cache
+    except ImproperlyConfigured:
+        return None
 
-    for participation, grades in zip(participations, grade_table):
-        writer.writerow([
-            participation.user.username,
-            participation.user.last_name,
-            participation.user.first_name,
-            ] + [grade_info.grade_state_machine.stringify_machine_readable_state()
-                for grade_info in grades])
+    return cache.caches["default"]
+
+
+# The fields of CurrentGradeState (besides the participation) that are
+# cached for each grade state machine.
+_GRADE_STATE_SUMMARY_FIELDS = (
+        "state", "valid_percentages", "has_extension", "due_time",
+        "last_graded_time", "last_report_time")
+
+
+def _get_opportunity_grades_cache_key(opportunity_id):
+    # type: (int) -> Text
+    return "relate-opp-grades:%d" % opportunity_id
+
+
+def _get_flow_sessions_cache_key(course_id, flow_id):
+    # type: (int, Text) -> Optional[Text]
+    from six.moves.urllib.parse import quote_plus
+    cache_key = "relate-flow-sessions:%d:%s" % (course_id, quote_plus(flow_id))
+
+    # Memcache is apparently limited to 250 characters.
+    if len(cache_key) >= 240:
+        return None
+    return cache_key
+
+
+def _delete_now_and_on_commit(cache_key):
+    # type: (Optional[Text]) -> None
+    cache = _get_summary_cache()
+    if cache is None or cache_key is None:
+        return
+
+    # Deleting again once the transaction commits keeps requests that
+    # recompute the summary in the meantime from caching stale data.
+    cache.delete(cache_key)
+    transaction.on_commit(lambda: cache.delete(cache_key))
+
+
+def invalidate_opportunity_grade_summary(opportunity_id):
+    # type: (int) -> None
+    _delete_now_and_on_commit(_get_opportunity_grades_cache_key(opportunity_id))
+
+
+def invalidate_flow_session_summary(course_id, flow_id):
+    # type: (int, Text) -> None
+    _delete_now_and_on_commit(_get_flow_sessions_cache_key(course_id, flow_id))
+
+
+def get_opportunity_grade_state_machines(opportunity):
+    # type: (GradingOpportunity) -> Dict[int, GradeStateMachine]
+
+    """
+    :returns: a mapping from the IDs of participations with a grade
+        history for *opportunity* to their current
+        :class:`course.models.GradeStateMachine`. Cached until a grade
+        change for *opportunity* is saved.
+    """
+
+    cache = _get_summary_cache()
+    cache_key = _get_opportunity_grades_cache_key(opportunity.id)
+
+    # The cache holds the fields of the (possibly unsaved) current grade
+    # states, not the state machines, which drag along their opportunity.
+    summary = None
+    if cache is not None:
+        summary = cache.get(cache_key)
+
+    if summary is None:
+        summary = [
+                (cgstate.participation_id,)
+                + tuple(getattr(cgstate, field)
+                    for field in _GRADE_STATE_SUMMARY_FIELDS)
+                for cgstate in _get_current_grade_states(opportunity)]
+
+        if cache is not None:
+            cache.set(cache_key, summary, OPPORTUNITY_SUMMARY_CACHE_TIMEOUT)
+
+    result = {}
+    for values in summary:
+        cgstate = CurrentGradeState(
+                opportunity=opportunity,
+                participation_id=values[0],
+                **dict(zip(_GRADE_STATE_SUMMARY_FIELDS, values[1:])))
+        result[cgstate.participation_id] = cgstate.get_grade_state_machine()
+
+    return result
+
+
+def _get_current_grade_states(opportunity):
+    # type: (GradingOpportunity) -> List[CurrentGradeState]
+
+    """
+    :returns: a list of the :class:`course.models.CurrentGradeState`
+        objects for *opportunity*, including unsaved ones for grade
+        histories that have none.
+    """
+
+    result = []
+
+    # Grade histories without a current grade state get replayed, to
+    # obtain the same result (or error) as the grade book.
+    from django.db.models import Exists, OuterRef
+    unmaterialized_grade_changes = (GradeChange.objects
+            .filter(opportunity=opportunity)
+            .annotate(has_current_state=Exists(
+                CurrentGradeState.objects.filter(
+                    participation=OuterRef("participation"),
+                    opportunity=OuterRef("opportunity"))))
+            .filter(has_current_state=False)
+            .order_by("grade_time")
+            .select_related("opportunity"))
+
+    participation_id_to_grade_changes = {}  # type: Dict[int, List[GradeChange]]
+    for gchange in unmaterialized_grade_changes:
+        participation_id_to_grade_changes.setdefault(
+                gchange.participation_id, []).append(gchange)
+
+    for participation_id, grade_changes in six.iteritems(
+            participation_id_to_grade_changes):
+        result.append(CurrentGradeState.from_grade_changes(
+            participation_id, opportunity, grade_changes))
+
+    result.extend(CurrentGradeState.objects.filter(opportunity=opportunity))
+
+    return result
+
+
+# The fields of the flow sessions that FlowSessionSummary keeps, i.e. those
+# that the grade book by opportunity shows, in the order of the model.
+_FLOW_SESSION_SUMMARY_FIELDS = tuple(
+        field.attname for field in FlowSession._meta.concrete_fields
+        if field.attname in [
+            "id", "course_id", "participation_id", "flow_id",
+            "start_time", "completion_time", "page_count", "in_progress",
+            "access_rules_tag", "points", "max_points"])
+
+
+def _get_flow_session_summary_values(course_id, flow_id):
+    # type: (int, Text) -> List[Tuple[Any, ...]]
+    return list(FlowSession.objects
+            .filter(
+                course=course_id,
+                flow_id=flow_id,
+                participation__isnull=False)
+            .order_by("participation_id", "start_time")
+            .values_list(*_FLOW_SESSION_SUMMARY_FIELDS))
 
-    response = http.HttpResponse(
-            csvfile.getvalue().encode("utf-8"),
-            content_type="text/plain; charset=utf-8")
-    response['Content-Disposition'] = (
-            'attachment; filename="grades-%s.csv"'
-            % pctx.course.identifier)
-    return response
+
+class FlowSessionSummary(object):
+    """The flow sessions of a flow, grouped by participation.
+
+    .. attribute:: participation_id_to_sessions
+
+        A mapping from participation IDs to lists of
+        :class:`course.models.FlowSession`, ordered by start time.
+        Only the fields in :data:`_FLOW_SESSION_SUMMARY_FIELDS` are loaded,
+        others are fetched from the database on access.
+
+    .. attribute:: access_rules_tags
+
+        A sorted list of the distinct access rules tags of the sessions,
+        possibly including *None*.
+    """
+
+    def __init__(self, session_values):
+        # type: (List[Tuple[Any, ...]]) -> None
+
+        """
+        :arg session_values: tuples of the values of
+            :data:`_FLOW_SESSION_SUMMARY_FIELDS`, as returned by
+            :func:`_get_flow_session_summary_values`.
+        """
+
+        self.participation_id_to_sessions = {}  # type: Dict[int, List[FlowSession]]  # noqa
+        access_rules_tags = set()  # type: Set[Optional[Text]]
+
+        for values in session_values:
+            fsession = FlowSession.from_db(
+                    None, _FLOW_SESSION_SUMMARY_FIELDS, values)
+            self.participation_id_to_sessions.setdefault(
+                    fsession.participation_id, []).append(fsession)
+            access_rules_tags.add(fsession.access_rules_tag)
+
+        self.access_rules_tags = sorted(
+                access_rules_tags, key=lambda tag: (tag is not None, tag))
+
+
+def get_flow_session_summary(course, flow_id):
+    # type: (Course, Text) -> FlowSessionSummary
+
+    """
+    :returns: a :class:`FlowSessionSummary` for *flow_id*. Cached until a
+        session of the flow is saved.
+    """
+
+    cache = _get_summary_cache()
+    cache_key = _get_flow_sessions_cache_key(course.id, flow_id)
+
+    # Only the field values are cached, to stay clear of the cache's
+    # item size limit (1 MB for memcached) for large classes.
+    session_values = None
+    if cache is not None and cache_key is not None:
+        session_values = cache.get(cache_key)
+
+    if session_values is None:
+        session_values = _get_flow_session_summary_values(course.id, flow_id)
+
+        if cache is not None and cache_key is not None:
+            cache.set(cache_key, session_values,
+                    OPPORTUNITY_SUMMARY_CACHE_TIMEOUT)
+
+    return FlowSessionSummary(session_values)
 
 # }}}
 
@@ -412,13 +1077,16 @@ def view_grades_by_opportunity(pctx, opp_id):
             )
 
     batch_session_ops_form = None  # type: Optional[ModifySessionsForm]
-    if batch_ops_allowed and opportunity.flow_id:
-        cursor = connection.cursor()
-        cursor.execute("select distinct access_rules_tag from course_flowsession "
-                "where course_id = %s and flow_id = %s "
-                "order by access_rules_tag", (pctx.course.id, opportunity.flow_id))
+    if opportunity.flow_id:
+        flow_session_summary = get_flow_session_summary(
+                pctx.course, opportunity.flow_id)  # type: Optional[FlowSessionSummary]  # noqa
+    else:
+        flow_session_summary = None
+
+    if batch_ops_allowed and flow_session_summary is not None:
         session_rule_tags = [
-                mangle_session_access_rule_tag(row[0]) for row in cursor.fetchall()]
+                mangle_session_access_rule_tag(tag)
+                for tag in flow_session_summary.access_rules_tags]
 
         request = pctx.request
         if request.method == "POST":
@@ -502,9 +1170,6 @@ def view_grades_by_opportunity(pctx, opp_id):
 
     # }}}
 
-    # NOTE: It's important that these queries are sorted consistently,
-    # also consistently with the code below.
-
     participations = list(Participation.objects
             .filter(
                 course=pctx.course,
@@ -512,80 +1177,30 @@ def view_grades_by_opportunity(pctx, opp_id):
             .order_by("id")
             .select_related("user"))
 
-    grade_changes = list(GradeChange.objects
-            .filter(opportunity=opportunity)
-            .order_by(
-                "participation__id",
-                "grade_time")
-            .select_related("participation")
-            .select_related("participation__user")
-            .select_related("opportunity"))
-
-    if opportunity.flow_id:
-        flow_sessions = list(FlowSession.objects
-                .filter(
-                    flow_id=opportunity.flow_id,
-                    )
-                .order_by(
-                    "participation__id",
-                    "start_time"
-                    ))  # type: Optional[List[FlowSession]]
-    else:
-        flow_sessions = None
+    participation_id_to_state_machine = \
+            get_opportunity_grade_state_machines(opportunity)
 
     view_page_grades = pctx.request.GET.get("view_page_grades") == "1"
 
-    gchng_idx = 0
-    fsess_idx = 0
-
     finished_sessions = 0
     total_sessions = 0
 
     grade_table = []  # type: List[Tuple[Participation, OpportunitySessionGradeInfo]]
-    for idx, participation in enumerate(participations):
-        # Advance in grade change list
-        while (
-                gchng_idx < len(grade_changes)
-                and grade_changes[gchng_idx].participation.pk < participation.pk):
-            gchng_idx += 1
-
-        my_grade_changes = []
-        while (
-                gchng_idx < len(grade_changes)
-                and grade_changes[gchng_idx].participation.pk == participation.pk):
-            my_grade_changes.append(grade_changes[gchng_idx])
-            gchng_idx += 1
-
-        state_machine = GradeStateMachine()
-        state_machine.consume(my_grade_changes)
+    for participation in participations:
+        state_machine = participation_id_to_state_machine.get(participation.id)
+        if state_machine is None:
+            state_machine = GradeStateMachine()
 
-        # Advance in flow session list
-        if flow_sessions is None:
+        if flow_session_summary is None:
             grade_table.append(
                     (participation, OpportunitySessionGradeInfo(
                         grade_state_machine=state_machine,
                         flow_session=None)))
         else:
-            while (
-                    fsess_idx < len(flow_sessions) and (
-                    flow_sessions[fsess_idx].participation is None or
-                    flow_sessions[fsess_idx].participation.pk < participation.pk)):
-                fsess_idx += 1
-
-            my_flow_sessions = []
-            while (
-                    fsess_idx < len(flow_sessions) and
-                    flow_sessions[fsess_idx].participation is not None and
-                    flow_sessions[fsess_idx].participation.pk == participation.pk):
-                my_flow_sessions.append(flow_sessions[fsess_idx])
-                fsess_idx += 1
-
-            for fsession in my_flow_sessions:
+            for fsession in (flow_session_summary.participation_id_to_sessions
+                    .get(participation.id, [])):
                 total_sessions += 1
 
-                if fsession is None:
-                    continue
-
                 if not fsession.in_progress:
                     finished_sessions += 1
 
@@ -747,47 +1362,12 @@ def view_reopen_session(pctx, flow_session_id, opportunity_id):
 def average_grade(opportunity):
     # type: (GradingOpportunity) -> Tuple[Optional[float], int]
 
-    grade_changes = (GradeChange.objects
-            .filter(
-                opportunity=opportunity,
-                participation__roles__permissions__permission=(
-                    pperm.included_in_grade_statistics))
-            .order_by(
-                "participation__id",
-                "grade_time")
-            .select_related("participation")
-            .select_related("opportunity"))
-
-    grades = []
-    my_grade_changes = []  # type: List[GradeChange]
-
-    def finalize():
-        # type: () -> None
-
-        if not my_grade_changes:
-            return
-
-        state_machine = GradeStateMachine()
-        state_machine.consume(my_grade_changes)
-
-        percentage = state_machine.percentage()
-        if percentage is not None:
-            grades.append(percentage)
+    grade_matrix = GradeMatrix([opportunity],
+            get_grade_statistics_participations(opportunity.course))
 
-        del my_grade_changes[:]
-
-    last_participation = None
-    for gchange in grade_changes:
-        if last_participation != gchange.participation:
-            finalize()
-            last_participation = gchange.participation
-
-        my_grade_changes.append(gchange)
-
-    finalize()
-
-    if grades:
-        return sum(grades)/len(grades), len(grades)
+    count = int(grade_matrix.counts[0])
+    if count:
+        return float(grade_matrix.averages[0]), count
     else:
         return None, 0
 
@@ -1089,68 +1669,88 @@ class ParticipantNotFound(ValueError):
     pass
 
 
-def find_participant_from_inst_id(course, inst_id_str):
-    inst_id_str = inst_id_str.strip()
+class ParticipantFinder(object):
+    """Finds active participants of a course by institutional ID or by
+    email address/NetID, resolving all identifiers from a single query.
+    """
 
-    matches = (Participation.objects
-            .filter(
-                course=course,
-                status=participation_status.active,
-                user__institutional_id__exact=inst_id_str)
-            .select_related("user"))
+    def __init__(self, course):
+        self.inst_id_to_participations = {}  # type: Dict[Text, List[Participation]]  # noqa
+        self.id_to_participations = {}  # type: Dict[Text, List[Participation]]
 
-    if not matches:
-        raise ParticipantNotFound(
-                # Translators: use institutional_id_string to find user
-                # (participant).
-                _("no participant found with institutional ID "
-                "'%(inst_id_string)s'") % {
-                    "inst_id_string": inst_id_str})
-    if len(matches) > 1:
-        raise ParticipantNotFound(
-                _("more than one participant found with institutional ID "
-                "'%(inst_id_string)s'") % {
-                    "inst_id_string": inst_id_str})
+        for participation in (Participation.objects
+                .filter(
+                    course=course,
+                    status=participation_status.active)
+                .select_related("user")):
+            user = participation.user
 
-    return matches[0]
+            if user.institutional_id is not None:
+                self.inst_id_to_participations.setdefault(
+                        user.institutional_id, []).append(participation)
 
+            if user.email:
+                email = user.email.lower()
+                self.id_to_participations.setdefault(
+                        email, []).append(participation)
 
-def find_participant_from_id(course, id_str):
-    id_str = id_str.strip().lower()
+                at_index = email.find("@")
+                if at_index > 0:
+                    self.id_to_participations.setdefault(
+                            email[:at_index], []).append(participation)
 
-    matches = (Participation.objects
-            .filter(
-                course=course,
-                status=participation_status.active,
-                user__email__istartswith=id_str)
-            .select_related("user"))
+    def find_from_inst_id(self, inst_id_str):
+        # type: (Text) -> Participation
 
-    surviving_matches = []
-    for match in matches:
-        if match.user.email.lower() == id_str:
-            surviving_matches.append(match)
-            continue
+        inst_id_str = inst_id_str.strip()
 
-        email = match.user.email.lower()
-        at_index = email.index("@")
-        assert at_index > 0
-        uid = email[:at_index]
+        matches = self.inst_id_to_participations.get(inst_id_str, [])
 
-        if uid == id_str:
-            surviving_matches.append(match)
-            continue
+        if not matches:
+            raise ParticipantNotFound(
+                    # Translators: use institutional_id_string to find user
+                    # (participant).
+                    _("no participant found with institutional ID "
+                    "'%(inst_id_string)s'") % {
+                        "inst_id_string": inst_id_str})
+        if len(matches) > 1:
+            raise ParticipantNotFound(
+                    _("more than one participant found with institutional ID "
+                    "'%(inst_id_string)s'") % {
+                        "inst_id_string": inst_id_str})
+
+        return matches[0]
+
+    def find_from_id(self, id_str):
+        # type: (Text) -> Participation
+
+        """
+        :arg id_str: an email address, or the part of it before the ``@``.
+        """
+
+        id_str = id_str.strip().lower()
+
+        matches = self.id_to_participations.get(id_str, [])
 
-    if not surviving_matches:
-        raise ParticipantNotFound(
-                # Translators: use id_string to find user (participant).
-                _("no participant found for '%(id_string)s'") % {
-                    "id_string": id_str})
-    if len(surviving_matches) > 1:
-        raise ParticipantNotFound(
-                _("more than one participant found for '%(id_string)s'") % {
-                    "id_string": id_str})
+        if not matches:
+            raise ParticipantNotFound(
+                    # Translators: use id_string to find user (participant).
+                    _("no participant found for '%(id_string)s'") % {
+                        "id_string": id_str})
+        if len(matches) > 1:
+            raise ParticipantNotFound(
+                    _("more than one participant found for '%(id_string)s'") % {
+                        "id_string": id_str})
 
-    return surviving_matches[0]
+        return matches[0]
+
+
+def find_participant_from_inst_id(course, inst_id_str):
+    return ParticipantFinder(course).find_from_inst_id(inst_id_str)
+
+
+def find_participant_from_id(course, id_str):
+    return ParticipantFinder(course).find_from_id(id_str)
 
 
 def fix_decimal(s):
@@ -1176,6 +1776,17 @@ def csv_to_grade_changes(
 
     from course.utils import get_col_contents_or_empty
 
+    participant_finder = ParticipantFinder(course)
+
+    # most recent grade change of each participation for this attempt
+    participation_id_to_last_grade = dict(
+            (gchange.participation_id, gchange)
+            for gchange in (GradeChange.objects
+                .filter(
+                    opportunity=grading_opportunity,
+                    attempt_id=attempt_id)
+                .order_by("grade_time")))
+
     total_count = 0
     spamreader = csv.reader(file_contents)
     for row in spamreader:
@@ -1187,11 +1798,11 @@ def csv_to_grade_changes(
         gchange.opportunity = grading_opportunity
         try:
             if attr_type == "email_or_id":
-                gchange.participation = find_participant_from_id(
-                        course, get_col_contents_or_empty(row, attr_column-1))
+                gchange.participation = participant_finder.find_from_id(
+                        get_col_contents_or_empty(row, attr_column-1))
             elif attr_type == "inst_id":
-                gchange.participation = find_participant_from_inst_id(
-                        course, get_col_contents_or_empty(row, attr_column-1))
+                gchange.participation = participant_finder.find_from_inst_id(
+                        get_col_contents_or_empty(row, attr_column-1))
             else:
                 raise ParticipantNotFound(
                     _("Unknown user attribute '%(attr_type)s'") % {
@@ -1217,16 +1828,9 @@ def csv_to_grade_changes(
         gchange.creator = creator
         gchange.grade_time = grade_time
 
-        last_grades = (GradeChange.objects
-                .filter(
-                    opportunity=grading_opportunity,
-                    participation=gchange.participation,
-                    attempt_id=gchange.attempt_id)
-                .order_by("-grade_time")[:1])
-
-        if last_grades.count():
-            last_grade, = last_grades
+        last_grade = participation_id_to_last_grade.get(gchange.participation.id)
 
+        if last_grade is not None:
             if last_grade.state == grade_state_change_types.graded:
 
                 updated = []
@@ -1258,6 +1862,46 @@ def csv_to_grade_changes(
     return total_count, result
 
 
+# Number of grade changes inserted per query
+GRADE_IMPORT_BATCH_SIZE = 500
+
+# Imports of files with more lines than this are run as a background task.
+GRADE_IMPORT_TASK_MIN_LINES = 500
+
+
+def save_imported_grade_changes(grade_changes, progress_callback=None):
+    # type: (List[GradeChange], Optional[Any]) -> None
+
+    """Insert *grade_changes* in batches and update the corresponding
+    :class:`course.models.CurrentGradeState` entries.
+
+    :arg progress_callback: if not *None*, called as
+        ``progress_callback(current, total)`` after each batch.
+    """
+
+    from course.models import update_current_grade_states
+
+    total = len(grade_changes)
+    for start in range(0, total, GRADE_IMPORT_BATCH_SIZE):
+        GradeChange.objects.bulk_create(
+                grade_changes[start:start + GRADE_IMPORT_BATCH_SIZE])
+
+        if progress_callback is not None:
+            progress_callback(min(start + GRADE_IMPORT_BATCH_SIZE, total), total)
+
+    opportunity_id_to_participation_ids = {}  # type: Dict[int, Set[int]]
+    for gchange in grade_changes:
+        opportunity_id_to_participation_ids.setdefault(
+                gchange.opportunity_id, set()).add(gchange.participation_id)
+
+    for opportunity_id, participation_ids in six.iteritems(
+            opportunity_id_to_participation_ids):
+        update_current_grade_states(opportunity_id, participation_ids)
+
+        # bulk_create does not send the signals that would do this
+        invalidate_opportunity_grade_summary(opportunity_id)
+
+
 @course_view
 @transaction.atomic
 def import_grades(pctx):
@@ -1275,10 +1919,30 @@ def import_grades(pctx):
 
         is_import = "import" in request.POST
         if form.is_valid():
+            f = request.FILES["file"]
+            f.seek(0)
+            data = f.read().decode("utf-8", errors="replace")
+
+            if (is_import
+                    and len(data.splitlines()) > GRADE_IMPORT_TASK_MIN_LINES):
+                from course.tasks import import_grades_from_csv
+                async_res = import_grades_from_csv.delay(
+                        pctx.course.id,
+                        form.cleaned_data["grading_opportunity"].id,
+                        attempt_id=form.cleaned_data["attempt_id"],
+                        file_contents=data,
+                        attr_type=form.cleaned_data["attr_type"],
+                        attr_column=form.cleaned_data["attr_column"],
+                        points_column=form.cleaned_data["points_column"],
+                        feedback_column=form.cleaned_data["feedback_column"],
+                        max_points=form.cleaned_data["max_points"],
+                        creator_id=request.user.id,
+                        grade_time=now(),
+                        has_header=form.cleaned_data["format"] == "csvhead")
+
+                return redirect("relate-monitor_task", async_res.id)
+
             try:
-                f = request.FILES["file"]
-                f.seek(0)
-                data = f.read().decode("utf-8", errors="replace")
                 total_count, grade_changes = csv_to_grade_changes(
                         log_lines=log_lines,
                         course=pctx.course,
@@ -1312,7 +1976,7 @@ def import_grades(pctx):
                 from django.template.loader import render_to_string
 
                 if is_import:
-                    GradeChange.objects.bulk_create(grade_changes)
+                    save_imported_grade_changes(grade_changes)
                     form_text = render_to_string(
                             "course/grade-import-preview.html", {
                                 "show_grade_changes": False,
@@ -1342,6 +2006,165 @@ def import_grades(pctx):
 
 # {{{ download all submissions
 
+# Number of page visits whose answers and grades are loaded at once
+# when writing a submissions archive
+SUBMISSION_ARCHIVE_CHUNK_SIZE = 100
+
+
+def get_submission_archive_visits(course, flow_id, group_id, page_id,
+        restrict_to_rules_tag=None, non_in_progress_only=True):
+    # type: (Course, Text, Text, Text, Optional[Text], bool) -> query.QuerySet
+
+    """
+    :arg restrict_to_rules_tag: if not *None*, only include sessions
+        with this access rules tag.
+    :returns: a query set of the submitted :class:`course.models.FlowPageVisit`
+        instances for page *page_id* in group *group_id*, oldest first.
+    """
+
+    visits = (FlowPageVisit.objects
+            .filter(
+                flow_session__course=course,
+                flow_session__flow_id=flow_id,
+                page_data__group_id=group_id,
+                page_data__page_id=page_id,
+                is_submitted_answer=True,
+                )
+            .order_by("visit_time", "id"))
+
+    if non_in_progress_only:
+        visits = visits.filter(flow_session__in_progress=False)
+
+    if restrict_to_rules_tag is not None:
+        visits = visits.filter(flow_session__access_rules_tag=restrict_to_rules_tag)
+
+    return visits
+
+
+def write_submissions_archive(subm_zip, course, repo, commit_sha, flow_id,
+        visits, which_attempt, include_feedback, progress_callback=None):
+    # type: (Any, Course, Repo_ish, bytes, Text, query.QuerySet, Text, bool, Optional[Callable[[int, int], None]]) -> int  # noqa
+
+    """Write the answers submitted in *visits* (as obtained from
+    :func:`get_submission_archive_visits`) to the
+    :class:`zipfile.ZipFile` *subm_zip*.
+
+    Only the identifiers of the selected visits are held in memory. Their
+    answers and grades are loaded in chunks while the archive is written.
+
+    :arg which_attempt: one of ``"first"``, ``"last"`` and ``"all"``.
+    :arg progress_callback: if given, called with the number of submissions
+        written so far and the total number of submissions.
+    :returns: the number of submissions written.
+    """
+
+    from course.page import PageContext
+    from course.page.base import AnswerFeedback
+    from course.utils import PageInstanceCache
+
+    page_cache = PageInstanceCache(repo, course, flow_id)
+
+    visits = (visits
+            .select_related("flow_session")
+            .select_related("flow_session__participation__user")
+            .select_related("page_data"))
+
+    def get_bytes_answer(visit):
+        page = page_cache.get_page(
+                visit.page_data.group_id, visit.page_data.page_id, commit_sha)
+
+        grading_page_context = PageContext(
+                course=course,
+                repo=repo,
+                commit_sha=commit_sha,
+                flow_session=visit.flow_session)
+
+        return page.normalized_bytes_answer(
+                grading_page_context, visit.page_data.data, visit.answer)
+
+    def get_key(username, flow_session_id):
+        if which_attempt in ["first", "last"]:
+            return (username,)
+        elif which_attempt == "all":
+            return (username, str(flow_session_id))
+        else:
+            raise NotImplementedError()
+
+    # {{{ select one visit per key
+
+    key_to_visit_id = {}  # type: Dict[Tuple[Text, ...], int]
+
+    # Answers are only normalized once they are written, so visits without
+    # an answer are left out here.
+    for visit_id, username, flow_session_id in (visits
+            .filter(answer__isnull=False)
+            .values_list(
+                "id", "flow_session__participation__user__username",
+                "flow_session_id")
+            .iterator()):
+        key = get_key(username, flow_session_id)
+        if which_attempt == "first" and key in key_to_visit_id:
+            # Already there, disregard further ones
+            continue
+
+        # Later submissions overwrite earlier ones.
+        key_to_visit_id[key] = visit_id
+
+    # }}}
+
+    visit_ids = sorted(key_to_visit_id.values())
+    total = len(visit_ids)
+
+    count = 0
+    for chunk_start in range(0, total, SUBMISSION_ARCHIVE_CHUNK_SIZE):
+        chunk_visits = (visits
+                .filter(id__in=visit_ids[
+                    chunk_start:chunk_start+SUBMISSION_ARCHIVE_CHUNK_SIZE])
+                .prefetch_related("grades"))
+
+        for visit in chunk_visits:
+            bytes_answer = get_bytes_answer(visit)
+            if bytes_answer is None:
+                # the page has no answers to download
+                continue
+
+            extension, bytes_answer = bytes_answer
+            basename = "-".join(get_key(
+                visit.flow_session.participation.user.username,
+                visit.flow_session_id))
+            subm_zip.writestr(basename + extension, bytes_answer)
+
+            if include_feedback:
+                visit_grades = list(visit.grades.all())
+
+                feedback_lines = []
+
+                feedback_lines.append(
+                    "scores: %s" % (
+                        ", ".join(
+                            str(g.correctness)
+                            for g in visit_grades)))
+
+                for i, grade in enumerate(visit_grades):
+                    feedback_lines.append(75*"-")
+                    feedback_lines.append(
+                        "grade %i: score: %s" % (i+1, grade.correctness))
+                    afb = AnswerFeedback.from_json(grade.feedback, None)
+                    if afb is not None:
+                        feedback_lines.append(afb.feedback)
+
+                subm_zip.writestr(
+                        basename + "-feedback.txt",
+                        "\n".join(feedback_lines))
+
+            count += 1
+
+        if progress_callback is not None:
+            progress_callback(count, total)
+
+    return count
+
+
 class DownloadAllSubmissionsForm(StyledForm):
     def __init__(self, page_ids, session_tag_choices, *args, **kwargs):
         super(DownloadAllSubmissionsForm, self).__init__(*args, **kwargs)
@@ -1419,8 +2242,6 @@ def download_all_submissions(pctx, flow_id):
             for group_desc in flow_desc.groups
             for page_desc in group_desc.pages]
 
-    from course.page.base import AnswerFeedback
-
     request = pctx.request
     if request.method == "POST":
         form = DownloadAllSubmissionsForm(page_ids, session_tag_choices,
@@ -1433,112 +2254,33 @@ def download_all_submissions(pctx, flow_id):
             group_id = form.cleaned_data["page_id"][:slash_index]
             page_id = form.cleaned_data["page_id"][slash_index+1:]
 
-            from course.utils import PageInstanceCache
-            page_cache = PageInstanceCache(pctx.repo, pctx.course, flow_id)
-
-            visits = (FlowPageVisit.objects
-                    .filter(
-                        flow_session__course=pctx.course,
-                        flow_session__flow_id=flow_id,
-                        page_data__group_id=group_id,
-                        page_data__page_id=page_id,
-                        is_submitted_answer=True,
-                        )
-                    .select_related("flow_session")
-                    .select_related("flow_session__participation__user")
-                    .select_related("page_data")
-
-                    # We overwrite earlier submissions with later ones
-                    # in a dictionary below.
-                    .order_by("visit_time"))
-
-            if form.cleaned_data["non_in_progress_only"]:
-                visits = visits.filter(flow_session__in_progress=False)
-
-            if form.cleaned_data["restrict_to_rules_tag"] != ALL_SESSION_TAG:
-                visits = (visits
-                        .filter(
-                            flow_session__access_rules_tag=(
-                                form.cleaned_data["restrict_to_rules_tag"])))
-
-            submissions = {}
-
-            for visit in visits:
-                page = page_cache.get_page(group_id, page_id,
-                        pctx.course_commit_sha)
-
-                from course.page import PageContext
-                grading_page_context = PageContext(
-                        course=pctx.course,
-                        repo=pctx.repo,
-                        commit_sha=pctx.course_commit_sha,
-                        flow_session=visit.flow_session)
-
-                bytes_answer = page.normalized_bytes_answer(
-                        grading_page_context, visit.page_data.data,
-                        visit.answer)
-
-                if which_attempt in ["first", "last"]:
-                    key = (visit.flow_session.participation.user.username,)
-                elif which_attempt == "all":
-                    key = (visit.flow_session.participation.user.username,
-                            str(visit.flow_session.id))
-                else:
-                    raise NotImplementedError()
-
-                if bytes_answer is not None:
-                    if (which_attempt == "first"
-                            and key in submissions):
-                        # Already there, disregard further ones
-                        continue
-
-                    submissions[key] = (
-                            bytes_answer, list(visit.grades.all()))
-
-            from six import BytesIO
-            from zipfile import ZipFile
-            bio = BytesIO()
-            with ZipFile(bio, "w") as subm_zip:
-                for key, ((extension, bytes_answer), visit_grades) in \
-                        six.iteritems(submissions):
-                    basename = "-".join(key)
-                    subm_zip.writestr(
-                            basename + extension,
-                            bytes_answer)
-
-                    if form.cleaned_data["include_feedback"]:
-                        feedback_lines = []
-
-                        feedback_lines.append(
-                            "scores: %s" % (
-                                ", ".join(
-                                    str(g.correctness)
-                                    for g in visit_grades)))
-
-                        for i, grade in enumerate(visit_grades):
-                            feedback_lines.append(75*"-")
-                            feedback_lines.append(
-                                "grade %i: score: %s" % (i+1, grade.correctness))
-                            afb = AnswerFeedback.from_json(grade.feedback, None)
-                            if afb is not None:
-                                feedback_lines.append(afb.feedback)
-
-                        subm_zip.writestr(
-                                basename + "-feedback.txt",
-                                "\n".join(feedback_lines))
-
-                extra_file = request.FILES.get("extra_file")
-                if extra_file is not None:
-                    subm_zip.writestr(extra_file.name, extra_file.read())
-
-            response = http.HttpResponse(
-                    bio.getvalue(),
-                    content_type="application/zip")
-            response['Content-Disposition'] = (
-                    'attachment; filename="submissions_%s_%s_%s_%s_%s.zip"'
-                    % (pctx.course.identifier, flow_id, group_id, page_id,
-                        now().date().strftime("%Y-%m-%d")))
-            return response
+            from course.tasks import build_submissions_archive
+
+            extra_file = request.FILES.get("extra_file")
+            if extra_file is not None:
+                extra_file_name = extra_file.name
+                extra_file_contents = extra_file.read()
+            else:
+                extra_file_name = None
+                extra_file_contents = None
+
+            restrict_to_rules_tag = form.cleaned_data["restrict_to_rules_tag"]
+            if restrict_to_rules_tag == ALL_SESSION_TAG:
+                restrict_to_rules_tag = None
+
+            async_res = build_submissions_archive.delay(
+                    pctx.course.id, flow_id, group_id, page_id,
+                    commit_sha=pctx.course_commit_sha,
+                    which_attempt=which_attempt,
+                    restrict_to_rules_tag=restrict_to_rules_tag,
+                    non_in_progress_only=(
+                        form.cleaned_data["non_in_progress_only"]),
+                    include_feedback=form.cleaned_data["include_feedback"],
+                    extra_file_name=extra_file_name,
+                    extra_file_contents=extra_file_contents,
+                    requester_id=request.user.id)
+
+            return redirect("relate-monitor_task", async_res.id)
 
     else:
         form = DownloadAllSubmissionsForm(page_ids, session_tag_choices)
@@ -0,0 +1,106 @@
+from __future__ import division
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+            "Store the normalized answers used by the analytics for page "
+            "visits whose answers were saved before they were stored.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'course_identifiers', nargs='*', metavar='COURSE_IDENTIFIER',
+            help='Courses to process. Default: all courses.')
+
+    def handle(self, *args, **options):
+        from django.core.exceptions import ObjectDoesNotExist
+        from course.content import get_course_repo
+        from course.models import (
+                Course, FlowPageVisit, get_normalized_answer_digest)
+        from course.page import PageContext
+        from course.utils import PageInstanceCache
+
+        courses = Course.objects.order_by("identifier")
+        if options["course_identifiers"]:
+            courses = courses.filter(
+                    identifier__in=options["course_identifiers"])
+            missing = (
+                    set(options["course_identifiers"])
+                    - set(courses.values_list("identifier", flat=True)))
+            if missing:
+                raise CommandError(
+                        "unknown course(s): %s" % ", ".join(sorted(missing)))
+
+        failed_count = 0
+
+        for course in courses:
+            visits = FlowPageVisit.objects.filter(
+                    flow_session__course=course,
+                    is_submitted_answer__isnull=False,
+                    normalized_answer_digest__isnull=True)
+
+            # Empty answers need no page to be normalized.
+            empty_count = (visits
+                    .filter(answer__isnull=True)
+                    .update(
+                        normalized_answer=None,
+                        normalized_answer_digest=(
+                            get_normalized_answer_digest(None))))
+
+            repo = get_course_repo(course)
+            flow_id_to_page_cache = {}
+
+            count = 0
+            for visit in (visits
+                    .select_related("flow_session")
+                    .select_related("page_data")
+                    .order_by("id")
+                    .iterator()):
+                flow_session = visit.flow_session
+                page_data = visit.page_data
+                commit_sha = flow_session.active_git_commit_sha.encode()
+
+                page_cache = flow_id_to_page_cache.setdefault(
+                        flow_session.flow_id,
+                        PageInstanceCache(repo, course, flow_session.flow_id))
+
+                try:
+                    page = page_cache.get_page(
+                            page_data.group_id, page_data.page_id, commit_sha)
+                    visit.store_normalized_answer(
+                            page,
+                            PageContext(
+                                course=course,
+                                repo=repo,
+                                commit_sha=commit_sha,
+                                flow_session=flow_session))
+                except Exception as e:
+                    if not isinstance(e, ObjectDoesNotExist):
+                        failed_count += 1
+                    self.stderr.write(
+                            "%s: visit %d (%s/%s/%s): %s: %s"
+                            % (course.identifier, visit.id,
+                                flow_session.flow_id, page_data.group_id,
+                                page_data.page_id, type(e).__name__, e))
+                    continue
+
+                # Not saving the visit, which would mark its session as
+                # modified.
+                (FlowPageVisit.objects
+                        .filter(id=visit.id)
+                        .update(
+                            normalized_answer=visit.normalized_answer,
+                            normalized_answer_digest=(
+                                visit.normalized_answer_digest)))
+                count += 1
+
+            repo.close()
+
+            self.stdout.write(
+                    "%s: %d normalized answers stored (%d empty)"
+                    % (course.identifier, count + empty_count, empty_count))
+
+        if failed_count:
+            raise CommandError(
+                    "%d answers could not be normalized" % failed_count)
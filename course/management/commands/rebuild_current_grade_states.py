@@ -0,0 +1,82 @@
+from __future__ import division
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = (
+            "Rebuild the materialized current grade states used by the grade "
+            "book from the grade history, or check them for consistency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'course_identifiers', nargs='*', metavar='COURSE_IDENTIFIER',
+            help='Courses to process. Default: all courses.')
+        parser.add_argument(
+            '--check', action='store_true', dest='check',
+            help=('Only report current grade states that disagree with '
+                  'the grade history, do not change anything.'))
+
+    def handle(self, *args, **options):
+        from course.models import (
+                Course, CurrentGradeState, compute_current_grade_states)
+
+        courses = Course.objects.order_by("identifier")
+        if options["course_identifiers"]:
+            courses = courses.filter(
+                    identifier__in=options["course_identifiers"])
+            missing = (
+                    set(options["course_identifiers"])
+                    - set(courses.values_list("identifier", flat=True)))
+            if missing:
+                raise CommandError(
+                        "unknown course(s): %s" % ", ".join(sorted(missing)))
+
+        inconsistent_count = 0
+
+        for course in courses:
+            expected = compute_current_grade_states(course)
+
+            if options["check"]:
+                actual = dict(
+                        ((cgstate.participation_id, cgstate.opportunity_id),
+                            cgstate)
+                        for cgstate in CurrentGradeState.objects.filter(
+                            opportunity__course=course))
+
+                for cgstate in expected:
+                    key = (cgstate.participation_id, cgstate.opportunity_id)
+                    actual_cgstate = actual.pop(key, None)
+                    if (actual_cgstate is None
+                            or not actual_cgstate.has_same_state(cgstate)):
+                        inconsistent_count += 1
+                        self.stdout.write(
+                                "%s: participation %d, opportunity %d: "
+                                "%s, expected %s"
+                                % (course.identifier,
+                                    key[0], key[1],
+                                    "missing" if actual_cgstate is None
+                                    else actual_cgstate.state,
+                                    cgstate.state))
+
+                for key in sorted(actual):
+                    inconsistent_count += 1
+                    self.stdout.write(
+                            "%s: participation %d, opportunity %d: "
+                            "no valid grade history"
+                            % (course.identifier, key[0], key[1]))
+
+            else:
+                with transaction.atomic():
+                    CurrentGradeState.objects.filter(
+                            opportunity__course=course).delete()
+                    CurrentGradeState.objects.bulk_create(expected)
+
+                self.stdout.write(
+                        "%s: %d current grade states"
+                        % (course.identifier, len(expected)))
+
+        if inconsistent_count:
+            raise CommandError(
+                    "%d inconsistent current grade states" % inconsistent_count)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0111_alter_git_source_in_course_to_a_required_field'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('flow_id', models.CharField(blank=True, db_index=True, max_length=200, null=True, verbose_name='Flow ID')),
+                ('page_id', models.CharField(max_length=200, verbose_name='Page ID')),
+                ('time', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Time')),
+                ('image', models.CharField(blank=True, max_length=200, null=True, verbose_name='Image')),
+                ('exec_host', models.CharField(blank=True, max_length=200, null=True, verbose_name='Execution host')),
+                ('result', models.CharField(max_length=50, verbose_name='Result')),
+                ('response_size', models.IntegerField(blank=True, help_text='Size of the response from the container, in bytes.', null=True, verbose_name='Response size')),
+                ('retry_count', models.IntegerField(default=0, help_text='Number of times the run was repeated because of a spurious failure.', verbose_name='Retry count')),
+                ('batch_size', models.IntegerField(default=1, help_text='Number of runs that shared the container.', verbose_name='Batch size')),
+                ('queue_time', models.FloatField(blank=True, null=True, verbose_name='Queue time')),
+                ('create_time', models.FloatField(blank=True, null=True, verbose_name='Container creation time')),
+                ('start_time', models.FloatField(blank=True, null=True, verbose_name='Container start time')),
+                ('ready_time', models.FloatField(blank=True, null=True, verbose_name='Container ready time')),
+                ('exec_time', models.FloatField(blank=True, null=True, verbose_name='Execution time')),
+                ('remove_time', models.FloatField(blank=True, null=True, verbose_name='Container removal time')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='course.Course', verbose_name='Course')),
+                ('participation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='course.Participation', verbose_name='Participation')),
+            ],
+            options={
+                'verbose_name': 'Code run',
+                'verbose_name_plural': 'Code runs',
+                'ordering': ('course', 'time'),
+            },
+        ),
+    ]
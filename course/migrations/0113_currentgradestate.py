@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+def fill_current_grade_states(apps, schema_editor):
+    # Like the rebuild_current_grade_states management command, but on the
+    # historical models, which lack the methods it relies on.
+
+    from functools import partial
+    from itertools import groupby
+    from course.constants import grade_state_change_types
+    from course.models import GradeStateMachine
+
+    GradeChange = apps.get_model("course", "GradeChange")  # noqa
+    CurrentGradeState = apps.get_model("course", "CurrentGradeState")  # noqa
+
+    def get_percentage(gchange):
+        if (gchange.max_points is not None
+                and gchange.points is not None
+                and gchange.max_points != 0):
+            return 100*gchange.points/gchange.max_points
+        else:
+            return None
+
+    grade_changes = (GradeChange.objects
+            .order_by("participation_id", "opportunity_id", "grade_time")
+            .select_related("opportunity"))
+
+    cgstates = []
+    for (participation_id, opportunity_id), pair_grade_changes in groupby(
+            grade_changes.iterator(),
+            lambda gchange: (gchange.participation_id, gchange.opportunity_id)):
+        pair_grade_changes = list(pair_grade_changes)
+        for gchange in pair_grade_changes:
+            gchange.percentage = partial(get_percentage, gchange)
+
+        try:
+            machine = GradeStateMachine().consume(pair_grade_changes)
+        except ValueError:
+            # Leave it to those replaying the history to report the problem.
+            continue
+
+        has_extension = any(
+                gchange.state == grade_state_change_types.extension
+                for gchange in pair_grade_changes)
+
+        cgstates.append(CurrentGradeState(
+                opportunity_id=opportunity_id,
+                participation_id=participation_id,
+                state=machine.state,
+                valid_percentages=[
+                    str(pct) if pct is not None else None
+                    for pct in machine.valid_percentages],
+                has_extension=has_extension,
+                due_time=machine.due_time if has_extension else None,
+                last_graded_time=machine.last_graded_time,
+                last_report_time=machine.last_report_time))
+
+    CurrentGradeState.objects.bulk_create(cgstates, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0112_coderun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentGradeState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(blank=True, choices=[('grading_started', 'Grading started'), ('graded', 'Graded'), ('retrieved', 'Retrieved'), ('unavailable', 'Unavailable'), ('extension', 'Extension'), ('report_sent', 'Report sent'), ('do_over', 'Do-over'), ('exempt', 'Exempt')], max_length=50, null=True, verbose_name='State')),
+                ('valid_percentages', jsonfield.fields.JSONField(default=list, help_text='The percentages being aggregated, as decimal strings, in the order in which they were received.', verbose_name='Valid percentages')),
+                ('has_extension', models.BooleanField(default=False, verbose_name='Has extension')),
+                ('due_time', models.DateTimeField(blank=True, help_text='Only used if an extension was granted. Otherwise, the due time of the opportunity applies.', null=True, verbose_name='Due time')),
+                ('last_graded_time', models.DateTimeField(blank=True, null=True, verbose_name='Last graded time')),
+                ('last_report_time', models.DateTimeField(blank=True, null=True, verbose_name='Last report time')),
+                ('opportunity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='course.GradingOpportunity', verbose_name='Grading opportunity')),
+                ('participation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='course.Participation', verbose_name='Participation')),
+            ],
+            options={
+                'verbose_name': 'Current grade state',
+                'verbose_name_plural': 'Current grade states',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='currentgradestate',
+            unique_together=set([('participation', 'opportunity')]),
+        ),
+        migrations.RunPython(
+            fill_current_grade_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0113_currentgradestate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlowAnalyticsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('flow_id', models.CharField(max_length=200, verbose_name='Flow ID')),
+                ('commit_sha', models.CharField(max_length=200, verbose_name='Commit SHA')),
+                ('visit_watermark', models.IntegerField(default=0, help_text='ID of the latest page visit taken into account.', verbose_name='Visit watermark')),
+                ('grade_watermark', models.IntegerField(default=0, help_text='ID of the latest page visit grade taken into account.', verbose_name='Grade watermark')),
+                ('refresh_time', models.DateTimeField(blank=True, null=True, verbose_name='Refresh time')),
+                ('state', jsonfield.fields.JSONField(default=dict, help_text='The counted answers of each page, as needed to update the snapshot.', verbose_name='State')),
+                ('data', jsonfield.fields.JSONField(default=dict, help_text='The statistics shown by the analytics views.', verbose_name='Data')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='course.Course', verbose_name='Course')),
+            ],
+            options={
+                'verbose_name': 'Flow analytics snapshot',
+                'verbose_name_plural': 'Flow analytics snapshots',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='flowanalyticssnapshot',
+            unique_together=set([('course', 'flow_id', 'commit_sha')]),
+        ),
+    ]
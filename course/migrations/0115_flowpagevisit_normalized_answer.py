@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def delete_flow_analytics_snapshots(apps, schema_editor):
+    # Snapshots now refer to normalized answers by digest. They are rebuilt
+    # when needed.
+    FlowAnalyticsSnapshot = apps.get_model("course", "FlowAnalyticsSnapshot")  # noqa
+    FlowAnalyticsSnapshot.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0114_flowanalyticssnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowpagevisit',
+            name='normalized_answer',
+            field=models.TextField(blank=True, help_text='The answer as summarized by the page for analytics.', null=True, verbose_name='Normalized answer'),
+        ),
+        migrations.AddField(
+            model_name='flowpagevisit',
+            name='normalized_answer_digest',
+            field=models.CharField(blank=True, help_text='SHA-1 digest identifying the normalized answer. Empty if the normalized answer was not stored.', max_length=40, null=True, verbose_name='Normalized answer digest'),
+        ),
+        migrations.RunPython(
+            delete_flow_analytics_snapshots, migrations.RunPython.noop),
+    ]
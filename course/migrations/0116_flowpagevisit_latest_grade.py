@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_latest_grades(apps, schema_editor):
+    from django.db.models import OuterRef, Subquery
+
+    FlowPageVisit = apps.get_model("course", "FlowPageVisit")  # noqa
+    FlowPageVisitGrade = apps.get_model("course", "FlowPageVisitGrade")  # noqa
+
+    latest_grades = (FlowPageVisitGrade.objects
+            .filter(visit=OuterRef("pk"))
+            .order_by("-grade_time", "-id"))
+
+    FlowPageVisit.objects.update(
+            latest_grade=Subquery(latest_grades.values("id")[:1]),
+            latest_correctness=Subquery(
+                latest_grades.values("correctness")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0115_flowpagevisit_normalized_answer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowpagevisit',
+            name='latest_correctness',
+            field=models.FloatField(blank=True, help_text='The correctness of the most recent grade of this visit.', null=True, verbose_name='Latest correctness'),
+        ),
+        migrations.AddField(
+            model_name='flowpagevisit',
+            name='latest_grade',
+            field=models.ForeignKey(blank=True, help_text='The most recent grade of this visit.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='course.FlowPageVisitGrade', verbose_name='Latest grade'),
+        ),
+        migrations.RunPython(fill_latest_grades, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_last_activity_times(apps, schema_editor):
+    from django.db.models import OuterRef, Subquery
+
+    FlowSession = apps.get_model("course", "FlowSession")  # noqa
+    FlowPageVisit = apps.get_model("course", "FlowPageVisit")  # noqa
+
+    FlowSession.objects.update(
+            last_activity_time=Subquery(
+                FlowPageVisit.objects
+                .filter(
+                    flow_session=OuterRef("pk"),
+                    answer__isnull=False,
+                    is_synthetic=False)
+                .order_by("-visit_time")
+                .values("visit_time")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0116_flowpagevisit_latest_grade'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowsession',
+            name='last_activity_time',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Time of the most recent (non-synthetic) answer.', null=True, verbose_name='Last activity time'),
+        ),
+        migrations.RunPython(fill_last_activity_times, migrations.RunPython.noop),
+    ]
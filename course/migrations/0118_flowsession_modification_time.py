@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_modification_times(apps, schema_editor):
+    from django.db.models import F
+
+    FlowSession = apps.get_model("course", "FlowSession")  # noqa
+
+    # the latest of the start, completion and last activity times
+    FlowSession.objects.update(modification_time=F("start_time"))
+    for field_name in ["completion_time", "last_activity_time"]:
+        (FlowSession.objects
+                .filter(**{field_name + "__gt": F("modification_time")})
+                .update(modification_time=F(field_name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0117_flowsession_last_activity_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowsession',
+            name='modification_time',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Time this session, its answers or their grades were last changed.', null=True, verbose_name='Modification time'),
+        ),
+        migrations.RunPython(fill_modification_times, migrations.RunPython.noop),
+    ]
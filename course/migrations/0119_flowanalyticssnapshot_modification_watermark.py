@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0118_flowsession_modification_time'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='flowanalyticssnapshot',
+            name='grade_watermark',
+        ),
+        migrations.RemoveField(
+            model_name='flowanalyticssnapshot',
+            name='visit_watermark',
+        ),
+        migrations.AddField(
+            model_name='flowanalyticssnapshot',
+            name='modification_watermark',
+            field=models.DateTimeField(blank=True, help_text='Flow sessions modified since this time are recounted by the next refresh.', null=True, verbose_name='Modification watermark'),
+        ),
+        migrations.AddField(
+            model_name='flowanalyticssnapshot',
+            name='rebuild_time',
+            field=models.DateTimeField(blank=True, help_text='The time at which the snapshot was last rebuilt from scratch.', null=True, verbose_name='Rebuild time'),
+        ),
+        migrations.AlterField(
+            model_name='flowanalyticssnapshot',
+            name='state',
+            field=jsonfield.fields.JSONField(default=dict, help_text='The counted answers of each flow session, as needed to update the snapshot.', verbose_name='State'),
+        ),
+    ]
@@ -28,14 +28,14 @@ from typing import cast
 
 import six
 
-from django.db import models
+from django.db import models, transaction
 from django.utils.timezone import now
 from django.urls import reverse
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.utils.translation import (
         ugettext_lazy as _, pgettext_lazy)
 from django.core.validators import RegexValidator
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from django.conf import settings
@@ -63,6 +63,7 @@ from course.page.base import AnswerFeedback
 if False:
     from typing import List, Dict, Any, Optional, Text, Iterable, Tuple, FrozenSet  # noqa
     from course.content import FlowDesc  # noqa
+    from django.db.models import query  # noqa
     import datetime # noqa
 
 # }}}
@@ -536,7 +537,7 @@ class Participation(models.Model):
         perm = (
                 list(
                     ParticipationRolePermission.objects.filter(
-                        role__course=self.course,
+                        role__course=self.course_id,
                         role__participation=self)
                     .values_list("permission", "argument"))
                 +
@@ -558,6 +559,32 @@ class Participation(models.Model):
 
     # }}}
 
+    # {{{ roles and tags
+
+    _role_identifiers_cache = None  # type: List[Text]
+
+    def role_identifiers(self):
+        # type: () -> List[Text]
+
+        if self._role_identifiers_cache is None:
+            self._role_identifiers_cache = [
+                    r.identifier for r in self.roles.all()]
+
+        return self._role_identifiers_cache
+
+    _tag_names_cache = None  # type: FrozenSet[Text]
+
+    def tag_names(self):
+        # type: () -> FrozenSet[Text]
+
+        if self._tag_names_cache is None:
+            self._tag_names_cache = frozenset(
+                    self.tags.values_list("name", flat=True))
+
+        return self._tag_names_cache
+
+    # }}}
+
 
 class ParticipationPermission(ParticipationPermissionBase):
     participation = models.ForeignKey(Participation,
@@ -885,6 +912,21 @@ class FlowSession(models.Model):
     result_comment = models.TextField(blank=True, null=True,
             verbose_name=_('Result comment'))
 
+    # Kept up to date whenever answer visits are saved or deleted, see
+    # update_last_activity_time().
+    last_activity_time = models.DateTimeField(null=True, blank=True,
+            db_index=True,
+            help_text=_("Time of the most recent (non-synthetic) answer."),
+            verbose_name=_('Last activity time'))
+
+    # Also updated whenever answers or grades in the session change, see
+    # touch_flow_sessions().
+    modification_time = models.DateTimeField(null=True, blank=True,
+            auto_now=True, db_index=True,
+            help_text=_("Time this session, its answers or their grades "
+                "were last changed."),
+            verbose_name=_('Modification time'))
+
     class Meta:
         verbose_name = _("Flow session")
         verbose_name_plural = _("Flow sessions")
@@ -929,16 +971,7 @@ class FlowSession(models.Model):
 
     def last_activity(self):
         # type: () -> Optional[datetime.datetime]
-        for visit in (FlowPageVisit.objects
-                .filter(
-                    flow_session=self,
-                    answer__isnull=False,
-                    is_synthetic=False)
-                .order_by("-visit_time")
-                [:1]):
-            return visit.visit_time
-
-        return None
+        return self.last_activity_time
 
     def get_expiration_mode_desc(self):
         return dict(FLOW_SESSION_EXPIRATION_MODE_CHOICES).get(
@@ -1043,6 +1076,16 @@ class FlowPageVisit(models.Model):
             # Translators: "Answer" is a Noun.
             verbose_name=_('Answer'))
 
+    # Stored when the answer is saved, for analytics.
+    normalized_answer = models.TextField(null=True, blank=True,
+            help_text=_("The answer as summarized by the page for analytics."),
+            verbose_name=_('Normalized answer'))
+    normalized_answer_digest = models.CharField(max_length=40,
+            null=True, blank=True,
+            help_text=_("SHA-1 digest identifying the normalized answer. "
+                "Empty if the normalized answer was not stored."),
+            verbose_name=_('Normalized answer digest'))
+
     # is_submitted_answer may seem redundant with answers being
     # non-NULL, but it isn't. This supports saved (but as
     # yet ungraded) answers.
@@ -1056,6 +1099,17 @@ class FlowPageVisit(models.Model):
             # submitted answer fit for grading.
             verbose_name=_('Is submitted answer'))
 
+    # Kept up to date by update_latest_grades() whenever a grade is saved
+    # or deleted.
+    latest_grade = models.ForeignKey("FlowPageVisitGrade",
+            null=True, blank=True, related_name="+",
+            help_text=_("The most recent grade of this visit."),
+            verbose_name=_('Latest grade'), on_delete=models.SET_NULL)
+    latest_correctness = models.FloatField(null=True, blank=True,
+            help_text=_("The correctness of the most recent grade of "
+                "this visit."),
+            verbose_name=_('Latest correctness'))
+
     def __unicode__(self):
         result = (
                 # Translators: flow page visit
@@ -1082,15 +1136,28 @@ class FlowPageVisit(models.Model):
         # These must be distinguishable, to figure out what came later.
         unique_together = (("page_data", "visit_time"),)
 
-    def get_most_recent_grade(self):
-        # type: () -> Optional[FlowPageVisitGrade]
+    def store_normalized_answer(self, page, page_context):
+        """Set (but do not save) :attr:`normalized_answer` and
+        :attr:`normalized_answer_digest` from :attr:`answer`, as normalized
+        by *page*, an instance of :class:`course.page.base.PageBase`.
+        """
 
-        grades = self.grades.order_by("-grade_time")[:1]
+        if self.answer is None:
+            normalized_answer = None
+        else:
+            normalized_answer = page.normalized_answer(
+                    page_context, self.page_data.data, self.answer)
+            if normalized_answer is not None:
+                normalized_answer = six.text_type(normalized_answer)
 
-        for grade in grades:
-            return grade
+        self.normalized_answer = normalized_answer
+        self.normalized_answer_digest = get_normalized_answer_digest(
+                normalized_answer)
 
-        return None
+    def get_most_recent_grade(self):
+        # type: () -> Optional[FlowPageVisitGrade]
+
+        return self.latest_grade
 
     def get_most_recent_feedback(self):
         grade = self.get_most_recent_grade()
@@ -1109,6 +1176,70 @@ class FlowPageVisit(models.Model):
 # }}}
 
 
+def touch_flow_sessions(flow_sessions):
+    # type: (query.QuerySet) -> None
+
+    """Set :attr:`FlowSession.modification_time` of *flow_sessions* to now,
+    for changes that do not go through :meth:`FlowSession.save`.
+    """
+
+    flow_sessions.update(modification_time=now())
+
+
+def update_last_activity_time(flow_session_id):
+    # type: (int) -> None
+
+    """Recompute :attr:`FlowSession.last_activity_time` of the flow session
+    with *flow_session_id* from its visits.
+    """
+
+    from django.db.models import Subquery
+    FlowSession.objects.filter(id=flow_session_id).update(
+            modification_time=now(),
+            last_activity_time=Subquery(
+                FlowPageVisit.objects
+                .filter(
+                    flow_session=flow_session_id,
+                    answer__isnull=False,
+                    is_synthetic=False)
+                .order_by("-visit_time")
+                .values("visit_time")[:1]))
+
+
+@receiver(post_save, sender=FlowPageVisit,
+        dispatch_uid="update_last_activity_time_on_save")
+def _update_last_activity_time_on_save(sender, instance, raw=False, **kwargs):
+    if raw or instance.answer is None or instance.is_synthetic:
+        return
+
+    from django.db.models import Q, F, Case, When, Value
+    FlowSession.objects.filter(id=instance.flow_session_id).update(
+            modification_time=now(),
+            last_activity_time=Case(
+                When(
+                    Q(last_activity_time__isnull=True)
+                    | Q(last_activity_time__lt=instance.visit_time),
+                    then=Value(instance.visit_time)),
+                default=F("last_activity_time"),
+                output_field=models.DateTimeField()))
+
+    # Callers may go on to use the session they saved an answer to.
+    if FlowPageVisit.flow_session.is_cached(instance):
+        flow_session = instance.flow_session
+        if (flow_session.last_activity_time is None
+                or flow_session.last_activity_time < instance.visit_time):
+            flow_session.last_activity_time = instance.visit_time
+
+
+@receiver(post_delete, sender=FlowPageVisit,
+        dispatch_uid="update_last_activity_time_on_delete")
+def _update_last_activity_time_on_delete(sender, instance, **kwargs):
+    if instance.answer is None or instance.is_synthetic:
+        return
+
+    update_last_activity_time(instance.flow_session_id)
+
+
 #  {{{ flow page visit grade
 
 class FlowPageVisitGrade(models.Model):
@@ -1176,6 +1307,12 @@ class FlowPageVisitGrade(models.Model):
 
         ordering = ("visit", "grade_time")
 
+    def save(self, *args, **kwargs):
+        # so that the latest grade of the visit is updated along with
+        # the grade
+        with transaction.atomic():
+            super(FlowPageVisitGrade, self).save(*args, **kwargs)
+
     def __unicode__(self):
         # information on FlowPageVisitGrade class
         # Translators: return the information of the grade of a user
@@ -1187,6 +1324,52 @@ class FlowPageVisitGrade(models.Model):
         __str__ = __unicode__
 
 
+def update_latest_grades(visit_ids):
+    # type: (Iterable[int]) -> None
+
+    """Recompute :attr:`FlowPageVisit.latest_grade` and
+    :attr:`FlowPageVisit.latest_correctness` of the visits with
+    *visit_ids* from their grades. This needs to be called after creating
+    grades with :meth:`django.db.models.query.QuerySet.bulk_create`,
+    which bypasses the signal handler doing so.
+    """
+
+    from django.db.models import OuterRef, Subquery
+
+    latest_grades = (FlowPageVisitGrade.objects
+            .filter(visit=OuterRef("pk"))
+            .order_by("-grade_time", "-id"))
+
+    visits = FlowPageVisit.objects.filter(id__in=list(visit_ids))
+    visits.update(
+            latest_grade=Subquery(latest_grades.values("id")[:1]),
+            latest_correctness=Subquery(
+                latest_grades.values("correctness")[:1]))
+
+    touch_flow_sessions(FlowSession.objects.filter(
+        id__in=visits.values("flow_session_id")))
+
+
+@receiver(post_save, sender=FlowPageVisitGrade,
+        dispatch_uid="update_latest_grade_on_save")
+def _update_latest_grade_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    update_latest_grades([instance.visit_id])
+
+    # Callers commonly go on to use the visit they graded.
+    if FlowPageVisitGrade.visit.is_cached(instance):
+        instance.visit.refresh_from_db(
+                fields=["latest_grade", "latest_correctness"])
+
+
+@receiver(post_delete, sender=FlowPageVisitGrade,
+        dispatch_uid="update_latest_grade_on_delete")
+def _update_latest_grade_on_delete(sender, instance, **kwargs):
+    update_latest_grades([instance.visit_id])
+
+
 class FlowPageBulkFeedback(models.Model):
     # We're only storing one of these per page, because
     # they're 'bulk' (i.e. big, like plots or program output)
@@ -1210,6 +1393,13 @@ def update_bulk_feedback(page_data, grade, bulk_feedback_json):
                 bulk_feedback=bulk_feedback_json))
 
 
+def get_normalized_answer_digest(normalized_answer):
+    # type: (Optional[Text]) -> Text
+    import json
+    from hashlib import sha1
+    return sha1(json.dumps(normalized_answer).encode("utf-8")).hexdigest()
+
+
 def get_feedback_for_grade(grade):
     # type: (FlowPageVisitGrade) -> Optional[AnswerFeedback]
 
@@ -1783,6 +1973,229 @@ class GradeStateMachine(object):
 # }}}
 
 
+# {{{ current grade state
+
+class CurrentGradeState(models.Model):
+    """The outcome of feeding all :class:`GradeChange` objects of a
+    participation for one grading opportunity through a
+    :class:`GradeStateMachine`, stored so that the grade book need not
+    replay the grade history on every view.
+
+    Kept up to date by :func:`update_current_grade_state`, which is
+    called whenever a :class:`GradeChange` is saved or deleted. If
+    there is no :class:`CurrentGradeState` for a participation and
+    opportunity that have grade changes (e.g. because the grade changes
+    were bulk-created, or because they do not form a valid history),
+    users of this table should fall back to replaying the grade changes.
+    The ``rebuild_current_grade_states`` management command recreates
+    (or checks) the entire table.
+    """
+
+    opportunity = models.ForeignKey(GradingOpportunity,
+            verbose_name=_('Grading opportunity'), on_delete=models.CASCADE)
+    participation = models.ForeignKey(Participation,
+            verbose_name=_('Participation'), on_delete=models.CASCADE)
+
+    state = models.CharField(max_length=50, null=True, blank=True,
+            choices=GRADE_STATE_CHANGE_CHOICES,
+            verbose_name=_('State'))
+    valid_percentages = JSONField(default=list,
+            help_text=_("The percentages being aggregated, as decimal "
+                "strings, in the order in which they were received."),
+            verbose_name=_('Valid percentages'))
+
+    has_extension = models.BooleanField(default=False,
+            verbose_name=_('Has extension'))
+    due_time = models.DateTimeField(null=True, blank=True,
+            help_text=_("Only used if an extension was granted. Otherwise, "
+                "the due time of the opportunity applies."),
+            verbose_name=_('Due time'))
+    last_graded_time = models.DateTimeField(null=True, blank=True,
+            verbose_name=_('Last graded time'))
+    last_report_time = models.DateTimeField(null=True, blank=True,
+            verbose_name=_('Last report time'))
+
+    class Meta:
+        verbose_name = _("Current grade state")
+        verbose_name_plural = _("Current grade states")
+        unique_together = (("participation", "opportunity"),)
+
+    def __unicode__(self):
+        return "%s %s on %s" % (
+                self.participation, self.state, self.opportunity)
+
+    if six.PY3:
+        __str__ = __unicode__
+
+    @classmethod
+    def from_grade_changes(cls, participation_id, opportunity, grade_changes):
+        # type: (int, GradingOpportunity, Iterable[GradeChange]) -> CurrentGradeState  # noqa
+
+        """
+        :arg grade_changes: the grade changes of *participation_id* for
+            *opportunity*, in the order of their ``grade_time``.
+        :returns: an unsaved :class:`CurrentGradeState`.
+        :raises ValueError: if *grade_changes* are not a valid grade history.
+        """
+
+        machine = GradeStateMachine()
+        machine.consume(grade_changes)
+
+        has_extension = any(
+                gchange.state == grade_state_change_types.extension
+                for gchange in grade_changes)
+
+        return cls(
+                opportunity=opportunity,
+                participation_id=participation_id,
+                state=machine.state,
+                valid_percentages=[
+                    # grades without points have a percentage of None
+                    str(pct) if pct is not None else None
+                    for pct in machine.valid_percentages],
+                has_extension=has_extension,
+                due_time=machine.due_time if has_extension else None,
+                last_graded_time=machine.last_graded_time,
+                last_report_time=machine.last_report_time)
+
+    def get_grade_state_machine(self):
+        # type: () -> GradeStateMachine
+
+        """
+        :returns: a :class:`GradeStateMachine` in the same state as one that
+            has consumed all grade changes of :attr:`participation`
+            for :attr:`opportunity`.
+        """
+
+        from decimal import Decimal
+
+        def parse_percentage(pct):
+            # "None" may have been stored before None became null.
+            if pct is None or pct == "None":
+                return None
+            return Decimal(pct)
+
+        # Consuming nothing yields a machine in the same (finished) shape
+        # as one that has consumed the actual history.
+        machine = GradeStateMachine().consume([])
+        machine.opportunity = self.opportunity
+        machine.state = self.state
+        machine.valid_percentages = [
+                parse_percentage(pct) for pct in self.valid_percentages]
+        machine.due_time = (
+                self.due_time if self.has_extension
+                else self.opportunity.due_time)
+        machine.last_graded_time = self.last_graded_time
+        machine.last_report_time = self.last_report_time
+
+        return machine
+
+    def has_same_state(self, other):
+        # type: (CurrentGradeState) -> bool
+        return all(
+                getattr(self, attr) == getattr(other, attr)
+                for attr in [
+                    "state", "valid_percentages", "has_extension", "due_time",
+                    "last_graded_time", "last_report_time"])
+
+
+def _make_current_grade_states(grade_changes):
+    # type: (Iterable[GradeChange]) -> List[CurrentGradeState]
+
+    """
+    :arg grade_changes: grade changes ordered by participation,
+        opportunity and grade time.
+    :returns: a list of unsaved :class:`CurrentGradeState` objects for
+        those participations and opportunities that have a valid grade
+        history.
+    """
+
+    result = []
+
+    from itertools import groupby
+    for (participation_id, opportunity_id), pair_grade_changes in groupby(
+            grade_changes,
+            lambda gchange: (gchange.participation_id, gchange.opportunity_id)):
+        pair_grade_changes = list(pair_grade_changes)
+        try:
+            result.append(CurrentGradeState.from_grade_changes(
+                participation_id, pair_grade_changes[0].opportunity,
+                pair_grade_changes))
+        except ValueError:
+            # Leave it to those replaying the history to report the problem.
+            pass
+
+    return result
+
+
+def update_current_grade_states(opportunity_id, participation_ids):
+    # type: (int, Iterable[int]) -> None
+
+    """Recompute the :class:`CurrentGradeState` of each of
+    *participation_ids* for *opportunity_id* from its grade changes.
+    This needs to be called after creating grade changes with
+    :meth:`django.db.models.query.QuerySet.bulk_create`, which bypasses
+    the signal handler doing so.
+    """
+
+    participation_ids = list(participation_ids)
+
+    grade_changes = (GradeChange.objects
+            .filter(
+                opportunity_id=opportunity_id,
+                participation_id__in=participation_ids)
+            .order_by("participation_id", "grade_time")
+            .select_related("opportunity"))
+
+    CurrentGradeState.objects.filter(
+            opportunity_id=opportunity_id,
+            participation_id__in=participation_ids).delete()
+
+    CurrentGradeState.objects.bulk_create(
+            _make_current_grade_states(grade_changes))
+
+
+def update_current_grade_state(participation_id, opportunity_id):
+    # type: (int, int) -> None
+
+    """Recompute the :class:`CurrentGradeState` of *participation_id* for
+    *opportunity_id* from its grade changes.
+    """
+
+    update_current_grade_states(opportunity_id, [participation_id])
+
+
+@receiver(post_save, sender=GradeChange,
+        dispatch_uid="update_current_grade_state_on_save")
+@receiver(post_delete, sender=GradeChange,
+        dispatch_uid="update_current_grade_state_on_delete")
+def _update_current_grade_state(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    update_current_grade_state(
+            instance.participation_id, instance.opportunity_id)
+
+
+def compute_current_grade_states(course):
+    # type: (Course) -> List[CurrentGradeState]
+
+    """
+    :returns: a list of unsaved :class:`CurrentGradeState` objects for
+        all participations and grading opportunities of *course* that have
+        a valid grade history.
+    """
+
+    grade_changes = (GradeChange.objects
+            .filter(opportunity__course=course)
+            .order_by("participation_id", "opportunity_id", "grade_time")
+            .select_related("opportunity"))
+
+    return _make_current_grade_states(grade_changes.iterator())
+
+# }}}
+
+
 # {{{ flow <-> grading integration
 
 def get_flow_grading_opportunity(course, flow_id, flow_desc,
@@ -1814,6 +2227,136 @@ def get_flow_grading_opportunity(course, flow_id, flow_desc,
 # }}}
 
 
+# {{{ code run telemetry
+
+class CodeRun(models.Model):
+    """One execution of participant code in a runpy container, as made
+    by :class:`course.page.code.PythonCodeQuestion` when grading. Used to
+    size runner hosts and to find pages whose code misbehaves.
+
+    Timings are in seconds. Runs that were part of a batch (see
+    :attr:`batch_size`) share the container set-up and tear-down times.
+    """
+
+    course = models.ForeignKey(Course,
+            verbose_name=_('Course'), on_delete=models.CASCADE)
+    flow_id = models.CharField(max_length=200, null=True, blank=True,
+            db_index=True,
+            verbose_name=_('Flow ID'))
+    page_id = models.CharField(max_length=200,
+            verbose_name=_('Page ID'))
+    participation = models.ForeignKey(Participation, null=True, blank=True,
+            verbose_name=_('Participation'), on_delete=models.SET_NULL)
+    time = models.DateTimeField(default=now, db_index=True,
+            verbose_name=_('Time'))
+
+    image = models.CharField(max_length=200, null=True, blank=True,
+            verbose_name=_('Image'))
+    exec_host = models.CharField(max_length=200, null=True, blank=True,
+            verbose_name=_('Execution host'))
+    result = models.CharField(max_length=50,
+            verbose_name=_('Result'))
+    response_size = models.IntegerField(null=True, blank=True,
+            verbose_name=_('Response size'),
+            help_text=_("Size of the response from the container, in bytes."))
+    retry_count = models.IntegerField(default=0,
+            verbose_name=_('Retry count'),
+            help_text=_("Number of times the run was repeated because of "
+                "a spurious failure."))
+    batch_size = models.IntegerField(default=1,
+            verbose_name=_('Batch size'),
+            help_text=_("Number of runs that shared the container."))
+
+    queue_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Queue time'))
+    create_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Container creation time'))
+    start_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Container start time'))
+    ready_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Container ready time'))
+    exec_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Execution time'))
+    remove_time = models.FloatField(null=True, blank=True,
+            verbose_name=_('Container removal time'))
+
+    class Meta:
+        verbose_name = _("Code run")
+        verbose_name_plural = _("Code runs")
+        ordering = ("course", "time")
+
+    def __unicode__(self):
+        return "%s: %s/%s at %s: %s" % (
+                self.course, self.flow_id, self.page_id, self.time, self.result)
+
+    if six.PY3:
+        __str__ = __unicode__
+
+    @property
+    def total_time(self):
+        # type: () -> float
+        return sum(
+                t for t in [
+                    self.queue_time, self.create_time, self.start_time,
+                    self.ready_time, self.exec_time, self.remove_time]
+                if t is not None)
+
+# }}}
+
+
+# {{{ flow analytics snapshot
+
+class FlowAnalyticsSnapshot(models.Model):
+    """The flow and page analytics of one flow, as computed from the flow
+    content at one commit, stored so that the analytics views need not
+    go through all page visits of the flow on every view.
+
+    Refreshed by :func:`course.analytics.refresh_flow_analytics_snapshot`,
+    which only recounts the flow sessions modified since
+    :attr:`modification_watermark`, and rebuilds the snapshot from scratch
+    periodically.
+    """
+
+    course = models.ForeignKey(Course,
+            verbose_name=_('Course'), on_delete=models.CASCADE)
+    flow_id = models.CharField(max_length=200,
+            verbose_name=_('Flow ID'))
+    commit_sha = models.CharField(max_length=200,
+            verbose_name=_('Commit SHA'))
+
+    modification_watermark = models.DateTimeField(null=True, blank=True,
+            help_text=_("Flow sessions modified since this time are "
+                "recounted by the next refresh."),
+            verbose_name=_('Modification watermark'))
+    rebuild_time = models.DateTimeField(null=True, blank=True,
+            help_text=_("The time at which the snapshot was last rebuilt "
+                "from scratch."),
+            verbose_name=_('Rebuild time'))
+    refresh_time = models.DateTimeField(null=True, blank=True,
+            verbose_name=_('Refresh time'))
+
+    state = JSONField(default=dict,
+            help_text=_("The counted answers of each flow session, as "
+                "needed to update the snapshot."),
+            verbose_name=_('State'))
+    data = JSONField(default=dict,
+            help_text=_("The statistics shown by the analytics views."),
+            verbose_name=_('Data'))
+
+    class Meta:
+        verbose_name = _("Flow analytics snapshot")
+        verbose_name_plural = _("Flow analytics snapshots")
+        unique_together = (("course", "flow_id", "commit_sha"),)
+
+    def __unicode__(self):
+        return "%s: %s at %s" % (self.course, self.flow_id, self.commit_sha)
+
+    if six.PY3:
+        __str__ = __unicode__
+
+# }}}
+
+
 # {{{ XMPP log
 
 class InstantMessage(models.Model):
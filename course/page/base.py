@@ -44,7 +44,7 @@ from django.conf import settings
 # {{{ mypy
 
 if False:
-    from typing import Text, Optional, Any, Tuple, Dict, Callable, FrozenSet  # noqa
+    from typing import Text, Optional, Any, Tuple, Dict, Callable, FrozenSet, List  # noqa
     from django import http  # noqa
     from course.models import (  # noqa
             Course,
@@ -185,10 +185,20 @@ class AnswerFeedback(object):
         is generated from :attr:`correctness`.
 
     .. attribute:: bulk_feedback
+
+    .. attribute:: is_deferred
+
+        *True* if the answer could not actually be graded at this time
+        (e.g. because the servers that run code were too busy), in which
+        case :attr:`correctness` is *None*. No grade should be stored for
+        deferred feedback, so that the answer is graded again later (e.g.
+        when the session is finished) and existing grades are kept. Not
+        stored.
     """
 
-    def __init__(self, correctness, feedback=None, bulk_feedback=None):
-        # type: (Optional[float], Optional[Text], Optional[Text]) -> None
+    def __init__(self, correctness, feedback=None, bulk_feedback=None,
+            is_deferred=False):
+        # type: (Optional[float], Optional[Text], Optional[Text], bool) -> None
 
         if correctness is not None:
             # allow for extra credit
@@ -201,6 +211,7 @@ class AnswerFeedback(object):
         self.correctness = correctness
         self.feedback = feedback
         self.bulk_feedback = bulk_feedback
+        self.is_deferred = is_deferred
 
     def as_json(self):
         # type: () -> Tuple[Dict[Text, Any], Dict[Text, Any]]
@@ -289,6 +300,7 @@ class PageBase(object):
     .. rubric:: Grading/Feedback
 
     .. automethod:: grade
+    .. automethod:: grade_multiple
     .. automethod:: correct_answer
     .. automethod:: normalized_answer
     .. automethod:: normalized_bytes_answer
@@ -651,6 +663,31 @@ class PageBase(object):
 
         raise NotImplementedError()
 
+    def grade_multiple(
+            self,
+            page_contexts,  # type: List[PageContext]
+            page_data_list,  # type: List[Any]
+            answer_data_list,  # type: List[Any]
+            grade_data_list,  # type: List[Any]
+            ):
+        # type: (...) -> List[Optional[AnswerFeedback]]
+        """Grade a number of answers to this page at once. Each argument is
+        a list (all of the same length) of the corresponding argument
+        of :meth:`grade`.
+
+        Subclasses may override this if grading many answers together is
+        cheaper than grading each of them separately.
+
+        :return: a list of what :meth:`grade` would have returned for each
+            answer.
+        """
+
+        return [
+                self.grade(page_context, page_data, answer_data, grade_data)
+                for page_context, page_data, answer_data, grade_data in zip(
+                    page_contexts, page_data_list, answer_data_list,
+                    grade_data_list)]
+
     def correct_answer(
             self,
             page_context,  # type: PageContext
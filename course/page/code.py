@@ -24,11 +24,15 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import os
+import threading
+from contextlib import contextmanager
+
 import six
 
 from course.validation import ValidationError
 import django.forms as forms
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured
 from django.utils.html import escape
 from django.utils.translation import ugettext as _
 from django.utils import translation
@@ -43,6 +47,13 @@ from course.page.base import (
         get_editor_interaction_mode)
 from course.constants import flow_permission
 
+# {{{ mypy
+
+if False:
+    from typing import Any, Dict, Text, Tuple  # noqa
+
+# }}}
+
 # DEBUGGING SWITCH:
 # True for 'spawn containers' (normal operation)
 # False for 'just connect to localhost:RUNPY_PORT' for runpy'
@@ -77,18 +88,310 @@ class PythonCodeForm(StyledForm):
 
 RUNPY_PORT = 9941
 
+# Number of answers sent to one container by
+# :meth:`PythonCodeQuestion.grade_multiple`
+RUNPY_BATCH_SIZE = 50
+
 
 class InvalidPingResponse(RuntimeError):
     pass
 
 
-def request_python_run(run_req, run_timeout, image=None):
-    import json
-    from six.moves import http_client
+DOCKER_TIMEOUT = 15
+
+# Time allowed for a container's life beyond the run itself
+RUNPY_LEASE_OVERHEAD = 3*DOCKER_TIMEOUT
+
+_DOCKER_CLIENTS = {}  # type: Dict[Tuple[int, Text], Any]
+_DOCKER_CLIENTS_LOCK = threading.Lock()
+
+
+def get_docker_client():
+    """Return a Docker API client shared among all threads of this process.
+
+    The client keeps its connections to the Docker daemon alive, so that
+    runs do not each pay for a new connection (and, with
+    ``RELATE_DOCKER_TLS_CONFIG``, a new TLS handshake). Clients are not
+    shared across :func:`os.fork`, since the child would inherit the
+    parent's sockets.
+    """
+
     import docker
+
+    docker_url = getattr(settings, "RELATE_DOCKER_URL",
+            "unix://var/run/docker.sock")
+
+    key = (os.getpid(), docker_url)
+
+    with _DOCKER_CLIENTS_LOCK:
+        try:
+            return _DOCKER_CLIENTS[key]
+        except KeyError:
+            pass
+
+        docker_tls = getattr(settings, "RELATE_DOCKER_TLS_CONFIG",
+                None)
+        docker_cnx = docker.Client(
+                base_url=docker_url,
+                tls=docker_tls,
+                timeout=DOCKER_TIMEOUT,
+                version="1.19")
+
+        _DOCKER_CLIENTS[key] = docker_cnx
+        return docker_cnx
+
+
+def _set_connection_timeout(connection, timeout):
+    connection.timeout = timeout
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+
+
+# {{{ admission control
+
+# Runs are admitted through the default cache, so that the limits below
+# hold across all web and task workers sharing that cache (e.g. memcached).
+# With a per-process cache, they only hold per process.
+#
+# - RELATE_RUNPY_MAX_CONCURRENT_RUNS: the number of runs (or batches) that
+#   may be in flight at once. If unset or None, runs are not limited.
+# - RELATE_RUNPY_MAX_QUEUE_LENGTH: the number of runs that may wait for
+#   a slot. Runs beyond this are turned away immediately.
+# - RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS: how long a run may wait for a slot.
+# - RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION: how many runs of a single
+#   participation may be waiting or in flight at once, so that one
+#   participant cannot fill up the queue.
+#
+# Runs that are turned away get a result of ``queued``.
+
+RUNPY_ADMISSION_CACHE_KEY_PREFIX = "relate-runpy-admission"
+
+# Lifetime of the admission counters. This bounds the effect of workers
+# that die without decrementing them.
+RUNPY_ADMISSION_COUNTER_TIMEOUT = 15*60
+
+
+def _get_admission_cache():
+    try:
+        import django.core.cache as cache
+    except ImproperlyConfigured:
+        return None
+
+    return cache.caches["default"]
+
+
+def _cache_incr(cache, key, delta):
+    cache.add(key, 0, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+    try:
+        value = cache.incr(key, delta)
+    except ValueError:
+        # expired between add and incr
+        cache.add(key, delta, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+        return delta
+
+    # incr does not extend the lifetime of the counter. Re-arm it, so that
+    # counters only expire once they have been left alone for
+    # RUNPY_ADMISSION_COUNTER_TIMEOUT, not while runs are in flight.
+    if hasattr(cache, "touch"):
+        cache.touch(key, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+    else:
+        # Not atomic: a concurrent change may (rarely) be lost. The
+        # timeout bounds the effect of that.
+        cache.set(key, value, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+
+    return value
+
+
+def _get_slot_keys(max_concurrent):
+    return [
+            "%s:slot:%d" % (RUNPY_ADMISSION_CACHE_KEY_PREFIX, i)
+            for i in range(max_concurrent)]
+
+
+@contextmanager
+def runpy_admission(lease_seconds, participation_id=None, timings=None,
+        wait=False):
+    """A context manager that waits for one of the
+    ``RELATE_RUNPY_MAX_CONCURRENT_RUNS`` slots for code runs to become free,
+    holds it while the context is active and releases it on exit.
+
+    :arg lease_seconds: an upper bound on the time the slot will be held.
+        Slots held for longer (e.g. by a worker that died) are considered
+        free again.
+    :arg participation_id: the ID of the participation on whose behalf the
+        run is done, or *None*.
+    :arg timings: if not *None*, a dictionary that receives the time spent
+        waiting for a slot under the key ``queue``.
+    :arg wait: if *True*, the run is never turned away. It is not subject
+        to the queue length and per-participation limits (though it counts
+        towards them) and waits for a slot for as long as it takes. This
+        is meant for runs on behalf of staff (such as regrading) that have
+        no one to resubmit them.
+    :returns: (through ``with ... as``) *True* if the run may proceed,
+        *False* if it was turned away and should be reported as ``queued``.
+    """
+
+    max_concurrent = getattr(settings, "RELATE_RUNPY_MAX_CONCURRENT_RUNS", None)
+
+    cache = None
+    if max_concurrent is not None:
+        cache = _get_admission_cache()
+
+    if cache is None:
+        yield True
+        return
+
+    max_queue_length = getattr(settings, "RELATE_RUNPY_MAX_QUEUE_LENGTH", 100)
+    max_wait = getattr(settings, "RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS", 30)
+    max_per_participation = getattr(
+            settings, "RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION", 2)
+
+    import random
+    from uuid import uuid4
+    from time import time, sleep
+
+    prefix = RUNPY_ADMISSION_CACHE_KEY_PREFIX
+    queue_key = prefix + ":queue"
+
+    participation_key = None
+    in_queue = False
+    slot_key = None
+    token = uuid4().hex
+
+    start_time = time()
+
+    try:
+        if participation_id is not None:
+            participation_key = "%s:participation:%d" % (
+                    prefix, participation_id)
+            if (_cache_incr(cache, participation_key, 1)
+                    > max_per_participation
+                    and not wait):
+                yield False
+                return
+
+        in_queue = True
+        if (_cache_incr(cache, queue_key, 1) > max_queue_length
+                and not wait):
+            yield False
+            return
+
+        # {{{ wait for a free slot
+
+        slot_keys = _get_slot_keys(max_concurrent)
+        retry_delay = 0.01
+
+        while True:
+            held = cache.get_many(slot_keys)
+            free_keys = [key for key in slot_keys if key not in held]
+            random.shuffle(free_keys)
+
+            for key in free_keys:
+                if cache.add(key, token, lease_seconds):
+                    slot_key = key
+                    break
+
+            if slot_key is not None:
+                break
+
+            if wait:
+                remaining = retry_delay
+            else:
+                remaining = max_wait - (time() - start_time)
+                if remaining <= 0:
+                    break
+
+            sleep(min(retry_delay, remaining))
+            retry_delay = min(2*retry_delay, 0.5)
+
+        # }}}
+
+        _cache_incr(cache, queue_key, -1)
+        in_queue = False
+
+        wait_time = time() - start_time
+        if timings is not None:
+            timings["queue"] = wait_time
+
+        if slot_key is None:
+            yield False
+        else:
+            _cache_incr(cache, prefix + ":admitted", 1)
+            _cache_incr(cache, prefix + ":wait-ms", int(1000*wait_time))
+            yield True
+
+    finally:
+        if slot_key is None:
+            _cache_incr(cache, prefix + ":turned-away", 1)
+
+        if in_queue:
+            _cache_incr(cache, queue_key, -1)
+
+        if slot_key is not None and cache.get(slot_key) == token:
+            cache.delete(slot_key)
+
+        if participation_key is not None:
+            _cache_incr(cache, participation_key, -1)
+
+
+def get_runpy_admission_stats():
+    """
+    :returns: *None* if runs are not limited, or a dictionary with the
+        number of runs currently ``running`` and ``waiting``, the numbers of
+        runs ``admitted`` and ``turned_away`` and the ``mean_wait`` in
+        seconds of admitted runs. The latter three cover roughly the last
+        :data:`RUNPY_ADMISSION_COUNTER_TIMEOUT` seconds.
+    """
+
+    max_concurrent = getattr(settings, "RELATE_RUNPY_MAX_CONCURRENT_RUNS", None)
+    if max_concurrent is None:
+        return None
+
+    cache = _get_admission_cache()
+    if cache is None:
+        return None
+
+    prefix = RUNPY_ADMISSION_CACHE_KEY_PREFIX
+    counters = cache.get_many([
+        prefix + ":queue", prefix + ":admitted", prefix + ":turned-away",
+        prefix + ":wait-ms"])
+
+    admitted = counters.get(prefix + ":admitted", 0)
+    wait_ms = counters.get(prefix + ":wait-ms", 0)
+
+    return {
+            "max_concurrent": max_concurrent,
+            "running": len(cache.get_many(_get_slot_keys(max_concurrent))),
+            "waiting": max(counters.get(prefix + ":queue", 0), 0),
+            "admitted": admitted,
+            "turned_away": counters.get(prefix + ":turned-away", 0),
+            "mean_wait": wait_ms / 1000 / admitted if admitted else None,
+            }
+
+# }}}
+
+
+def _run_in_runpy_container(run_func, image=None, timings=None):
+    """Start a runpy container (or, if :data:`SPAWN_CONTAINERS_FOR_RUNPY` is
+    *False*, use the one listening on :data:`RUNPY_PORT` on localhost), wait
+    until it responds to a ping and call
+    ``run_func(connection, connect_host_ip, debug_print)``, where
+    *connection* is the :class:`http.client.HTTPConnection` that
+    carried the ping. If the container supports keep-alive, further requests
+    on it reuse the same socket.
+
+    :arg timings: if not *None*, a dictionary that receives the wall time
+        in seconds spent in each of the phases ``create``, ``start``,
+        ``ready``, ``exec`` and ``remove``.
+    :returns: the return value of *run_func*, or an ``uncaught_error``
+        response if the container did not come up in time.
+    """
+
+    from six.moves import http_client
     import socket
     import errno
     from docker.errors import APIError as DockerAPIError
+    from time import time, sleep
 
     debug = False
     if debug:
@@ -98,18 +401,15 @@ def request_python_run(run_req, run_timeout, image=None):
         def debug_print(s):
             pass
 
-    docker_timeout = 15
+    if timings is None:
+        timings = {}
+
+    docker_timeout = DOCKER_TIMEOUT
+
+    phase_start_time = time()
 
     if SPAWN_CONTAINERS_FOR_RUNPY:
-        docker_url = getattr(settings, "RELATE_DOCKER_URL",
-                "unix://var/run/docker.sock")
-        docker_tls = getattr(settings, "RELATE_DOCKER_TLS_CONFIG",
-                None)
-        docker_cnx = docker.Client(
-                base_url=docker_url,
-                tls=docker_tls,
-                timeout=docker_timeout,
-                version="1.19")
+        docker_cnx = get_docker_client()
 
         if image is None:
             image = settings.RELATE_DOCKER_RUNPY_IMAGE
@@ -132,11 +432,16 @@ def request_python_run(run_req, run_timeout, image=None):
     else:
         container_id = None
 
+    timings["create"] = time() - phase_start_time
+
     connect_host_ip = 'localhost'
+    connection = None
 
     try:
         # FIXME: Prohibit networking
 
+        phase_start_time = time()
+
         if container_id is not None:
             docker_cnx.start(container_id)
 
@@ -152,16 +457,27 @@ def request_python_run(run_req, run_timeout, image=None):
         else:
             port = RUNPY_PORT
 
-        from time import time, sleep
-        start_time = time()
+        timings["start"] = time() - phase_start_time
+
+        start_time = phase_start_time = time()
 
         # {{{ ping until response received
 
+        # Each attempt blocks in connect() for as long as the deadline
+        # allows. Docker's port proxy may accept connections before runpy
+        # listens, so readiness is only established by a successful ping.
+        # Between failed attempts, back off exponentially, starting small,
+        # so that a container that comes up quickly is not kept waiting.
+
         from traceback import format_exc
 
+        retry_state = {"delay": 0.005}
+
         def check_timeout():
-                if time() - start_time < docker_timeout:
-                    sleep(0.1)
+                remaining = docker_timeout - (time() - start_time)
+                if remaining > 0:
+                    sleep(min(retry_state["delay"], remaining))
+                    retry_state["delay"] = min(2*retry_state["delay"], 0.2)
                     # and retry
                 else:
                     return {
@@ -173,7 +489,11 @@ def request_python_run(run_req, run_timeout, image=None):
 
         while True:
             try:
-                connection = http_client.HTTPConnection(connect_host_ip, port)
+                if connection is not None:
+                    connection.close()
+
+                connection = http_client.HTTPConnection(connect_host_ip, port,
+                        timeout=max(docker_timeout - (time() - start_time), 0.1))
 
                 connection.request('GET', '/ping')
 
@@ -185,7 +505,8 @@ def request_python_run(run_req, run_timeout, image=None):
 
                 break
 
-            except (http_client.BadStatusLine, InvalidPingResponse):
+            except (http_client.BadStatusLine, InvalidPingResponse,
+                    socket.timeout):
                 ct_res = check_timeout()
                 if ct_res is not None:
                     return ct_res
@@ -203,10 +524,60 @@ def request_python_run(run_req, run_timeout, image=None):
 
         debug_print("PING SUCCESSFUL")
 
+        timings["ready"] = time() - phase_start_time
+
+        phase_start_time = time()
+        try:
+            return run_func(connection, connect_host_ip, debug_print)
+        finally:
+            timings["exec"] = time() - phase_start_time
+
+    finally:
+        phase_start_time = time()
+
+        if connection is not None:
+            connection.close()
+
+        if container_id is not None:
+            if debug:
+                debug_print("-----------BEGIN DOCKER LOGS for %s" % container_id)
+                debug_print(docker_cnx.logs(container_id))
+                debug_print("-----------END DOCKER LOGS for %s" % container_id)
+
+            try:
+                docker_cnx.remove_container(container_id, force=True)
+            except DockerAPIError:
+                # Oh well. No need to bother the students with this nonsense.
+                pass
+
+        timings["remove"] = time() - phase_start_time
+
+
+def request_python_run(run_req, run_timeout, image=None, participation_id=None,
+        wait=False):
+    """
+    :arg participation_id: used for fair admission of runs, see
+        :func:`runpy_admission`.
+    :arg wait: whether the run waits for admission rather than being
+        turned away, see :func:`runpy_admission`.
+    :returns: a :class:`course.page.code_runpy_backend.Response` as a
+        dictionary, with the additional keys ``exec_host``, the address of
+        the host on which the code ran, ``image``, the Docker image used for
+        the run, ``response_size``, the size in bytes of the container's
+        response, and ``timings``, a dictionary mapping the phases
+        ``queue`` (if runs are limited), ``create``, ``start``, ``ready``,
+        ``exec`` and ``remove`` of the run to the number of seconds spent
+        in each. If the run was not admitted, the ``result``
+        is ``queued``.
+    """
+
+    import json
+    import socket
+
+    def run(connection, connect_host_ip, debug_print):
         try:
             # Add a second to accommodate 'wire' delays
-            connection = http_client.HTTPConnection(connect_host_ip, port,
-                    timeout=1 + run_timeout)
+            _set_connection_timeout(connection, 1 + run_timeout)
 
             headers = {'Content-type': 'application/json'}
 
@@ -221,18 +592,19 @@ def request_python_run(run_req, run_timeout, image=None):
 
             http_response = connection.getresponse()
             debug_print("GETR")
-            response_data = http_response.read().decode("utf-8")
+            response_data = http_response.read()
             debug_print("READR")
 
             end_time = time()
 
-            result = json.loads(response_data)
+            result = json.loads(response_data.decode("utf-8"))
 
             result["feedback"] = (result.get("feedback", [])
                     + ["Execution time: %.1f s -- Time limit: %.1f s"
                         % (end_time - start_time, run_timeout)])
 
             result["exec_host"] = connect_host_ip
+            result["response_size"] = len(response_data)
 
             return result
 
@@ -241,17 +613,131 @@ def request_python_run(run_req, run_timeout, image=None):
                     "result": "timeout",
                     "exec_host": connect_host_ip,
                     }
-    finally:
-        if container_id is not None:
-            debug_print("-----------BEGIN DOCKER LOGS for %s" % container_id)
-            debug_print(docker_cnx.logs(container_id))
-            debug_print("-----------END DOCKER LOGS for %s" % container_id)
 
-            try:
-                docker_cnx.remove_container(container_id, force=True)
-            except DockerAPIError:
-                # Oh well. No need to bother the students with this nonsense.
-                pass
+    if image is None:
+        image = getattr(settings, "RELATE_DOCKER_RUNPY_IMAGE", None)
+
+    timings = {}
+    with runpy_admission(RUNPY_LEASE_OVERHEAD + run_timeout,
+            participation_id=participation_id, timings=timings,
+            wait=wait) as admitted:
+        if admitted:
+            result = _run_in_runpy_container(run, image=image, timings=timings)
+        else:
+            result = {"result": "queued"}
+
+    result["image"] = image
+    result["timings"] = timings
+
+    return result
+
+
+def request_python_run_batch(run_req, user_codes, run_timeout, image=None):
+    """Run each entry of *user_codes* as the user code of *run_req* (which
+    should have no ``user_code`` of its own), using a single container
+    and the batch protocol described in
+    :mod:`course.page.code_runpy_backend`.
+
+    :returns: a list with one response per entry of *user_codes*, with
+        the same additional keys as in :func:`request_python_run` plus
+        ``batch_size``. The ``exec`` timing is that of the individual
+        entry, all other timings are shared by the batch. Entries
+        for which the container did not deliver a response are *None*.
+        Batches are only run on behalf of staff, so they wait for
+        admission (see :func:`runpy_admission`) rather than being
+        turned away.
+    """
+
+    import json
+    from six.moves import http_client
+    import socket
+
+    def run(connection, connect_host_ip, debug_print):
+        results = [None] * len(user_codes)
+
+        try:
+            # Allow for process startup in addition to the 'wire' delays
+            _set_connection_timeout(connection, 2 + run_timeout)
+
+            headers = {'Content-type': 'application/json'}
+
+            batch_req = dict(run_req)
+            batch_req["user_codes"] = user_codes
+            batch_req["timeout"] = run_timeout
+            json_batch_req = json.dumps(batch_req).encode("utf-8")
+
+            from time import time
+            start_time = time()
+
+            debug_print("BEFPOST")
+            connection.request('POST', '/run-python-batch', json_batch_req,
+                    headers)
+            debug_print("AFTPOST")
+
+            http_response = connection.getresponse()
+            debug_print("GETR")
+
+            if http_response.status != 200:
+                # Possibly an older image without batch support. Leave
+                # everything as None, to be run individually.
+                return results
+
+            for i in range(len(user_codes)):
+                line = http_response.readline()
+                if not line:
+                    break
+
+                end_time = time()
+
+                result = json.loads(line.decode("utf-8"))
+
+                result["feedback"] = (result.get("feedback", [])
+                        + ["Execution time: %.1f s -- Time limit: %.1f s"
+                            % (end_time - start_time, run_timeout)])
+
+                result["exec_host"] = connect_host_ip
+                result["response_size"] = len(line)
+                result["exec_time"] = end_time - start_time
+
+                results[i] = result
+                start_time = end_time
+
+            debug_print("READR")
+
+        except (socket.timeout, http_client.HTTPException, socket.error):
+            # Whatever did not arrive is left as None for the caller
+            # to deal with.
+            pass
+
+        return results
+
+    if image is None:
+        image = getattr(settings, "RELATE_DOCKER_RUNPY_IMAGE", None)
+
+    timings = {}
+    with runpy_admission(
+            RUNPY_LEASE_OVERHEAD + len(user_codes) * (1 + run_timeout),
+            timings=timings, wait=True) as admitted:
+        if admitted:
+            result = _run_in_runpy_container(run, image=image, timings=timings)
+        else:
+            result = {"result": "queued"}
+
+    if isinstance(result, dict):
+        # container failed to start or run was not admitted
+        result = [dict(result) for user_code in user_codes]
+
+    for item_result in result:
+        if item_result is not None:
+            item_result["image"] = image
+            item_result["timings"] = dict(timings)
+            if "exec_time" in item_result:
+                # The container phases are shared, but execution
+                # was timed for each item.
+                item_result["timings"]["exec"] = item_result.pop("exec_time")
+            item_result["batch_size"] = len(user_codes)
+
+    return result
 
 
 def is_nuisance_failure(result):
@@ -283,17 +769,101 @@ def is_nuisance_failure(result):
     return False
 
 
-def request_python_run_with_retries(run_req, run_timeout, image=None, retry_count=3):
+def request_python_run_with_retries(run_req, run_timeout, image=None, retry_count=3,
+        participation_id=None, wait=False):
+    """Like :func:`request_python_run`, but repeats runs that failed for
+    spurious reasons (see :func:`is_nuisance_failure`) up to *retry_count*
+    times. The number of repetitions is returned as ``retry_count`` in
+    the result.
+    """
+    retries = 0
     while True:
-        result = request_python_run(run_req, run_timeout, image=image)
+        result = request_python_run(run_req, run_timeout, image=image,
+                participation_id=participation_id, wait=wait)
 
-        if retry_count and is_nuisance_failure(result):
-            retry_count -= 1
+        if retries < retry_count and is_nuisance_failure(result):
+            retries += 1
             continue
 
+        result["retry_count"] = retries
         return result
 
 
+def request_python_run_batch_with_retries(run_req, user_codes, run_timeout,
+        image=None, retry_count=3, participation_ids=None):
+    """Like :func:`request_python_run_batch`, but runs that failed for
+    spurious reasons (see :func:`is_nuisance_failure`) or produced no
+    response are retried individually using
+    :func:`request_python_run_with_retries`. Like the batch, these
+    retries wait for admission rather than being turned away.
+
+    :arg participation_ids: if not *None*, a list of the IDs of the
+        participations (or *None*) on whose behalf each entry of
+        *user_codes* is run, used for admission of the retries.
+    """
+
+    if participation_ids is None:
+        participation_ids = [None] * len(user_codes)
+
+    results = request_python_run_batch(run_req, user_codes, run_timeout,
+            image=image)
+
+    for i, (user_code, participation_id, result) in enumerate(
+            zip(user_codes, participation_ids, results)):
+        if result is None or (retry_count and is_nuisance_failure(result)):
+            item_run_req = dict(run_req)
+            item_run_req["user_code"] = user_code
+
+            results[i] = request_python_run_with_retries(item_run_req,
+                    run_timeout, image=image, retry_count=retry_count,
+                    participation_id=participation_id, wait=True)
+            if result is not None:
+                results[i]["retry_count"] += 1
+
+    return results
+
+
+def make_run_failure_response():
+    from traceback import format_exc
+    return {
+            "result": "uncaught_error",
+            "message": "Error connecting to container",
+            "traceback": "".join(format_exc()),
+            }
+
+
+def make_code_run(page_context, page_id, response_dict):
+    """
+    :returns: an unsaved :class:`course.models.CodeRun` recording the
+        outcome and timings of the run that produced *response_dict*.
+    """
+
+    from course.models import CodeRun
+
+    timings = response_dict.get("timings", {})
+    flow_session = page_context.flow_session
+
+    return CodeRun(
+            course=page_context.course,
+            flow_id=flow_session.flow_id if flow_session is not None else None,
+            page_id=page_id,
+            participation_id=(
+                flow_session.participation_id
+                if flow_session is not None else None),
+            image=response_dict.get("image"),
+            exec_host=response_dict.get("exec_host"),
+            result=response_dict["result"],
+            response_size=response_dict.get("response_size"),
+            retry_count=response_dict.get("retry_count", 0),
+            batch_size=response_dict.get("batch_size", 1),
+            queue_time=timings.get("queue"),
+            create_time=timings.get("create"),
+            start_time=timings.get("start"),
+            ready_time=timings.get("ready"),
+            exec_time=timings.get("exec"),
+            remove_time=timings.get("remove"))
+
+
 class PythonCodeQuestion(PageBaseWithTitle, PageBaseWithValue):
     """
     An auto-graded question allowing an answer consisting of Python code.
@@ -593,16 +1163,14 @@ class PythonCodeQuestion(PageBaseWithTitle, PageBaseWithValue):
         from .code_runpy_backend import substitute_correct_code_into_test_code
         return substitute_correct_code_into_test_code(test_code, correct_code)
 
-    def grade(self, page_context, page_data, answer_data, grade_data):
-        if answer_data is None:
-            return AnswerFeedback(correctness=0,
-                    feedback=_("No answer provided."))
-
-        user_code = answer_data["answer"]
-
-        # {{{ request run
+    def get_run_request(self, page_context):
+        """
+        :returns: the part of the :class:`course.page.code_runpy_backend.Request`
+            that is shared among all answers to this page, i.e. everything but
+            the ``user_code``.
+        """
 
-        run_req = {"compile_only": False, "user_code": user_code}
+        run_req = {"compile_only": False}
 
         def transfer_attr(name):
             if hasattr(self.page_desc, name):
@@ -628,19 +1196,101 @@ class PythonCodeQuestion(PageBaseWithTitle, PageBaseWithValue):
                                     page_context.repo, data_file,
                                     page_context.commit_sha).data).decode()
 
+        return run_req
+
+    def grade(self, page_context, page_data, answer_data, grade_data):
+        if answer_data is None:
+            return AnswerFeedback(correctness=0,
+                    feedback=_("No answer provided."))
+
+        user_code = answer_data["answer"]
+
+        # {{{ request run
+
+        run_req = self.get_run_request(page_context)
+        run_req["user_code"] = user_code
+
+        participation_id = None
+        if page_context.flow_session is not None:
+            participation_id = page_context.flow_session.participation_id
+
         try:
             response_dict = request_python_run_with_retries(run_req,
-                    run_timeout=self.page_desc.timeout)
+                    run_timeout=self.page_desc.timeout,
+                    participation_id=participation_id)
         except Exception:
-            from traceback import format_exc
-            response_dict = {
-                    "result": "uncaught_error",
-                    "message": "Error connecting to container",
-                    "traceback": "".join(format_exc()),
-                    }
+            response_dict = make_run_failure_response()
+
+        make_code_run(page_context, self.page_desc.id, response_dict).save()
 
         # }}}
 
+        return self.grade_run_response(page_context, page_data, answer_data,
+                grade_data, response_dict)
+
+    def grade_multiple(self, page_contexts, page_data_list, answer_data_list,
+            grade_data_list):
+        answered_indices = [
+                i for i, answer_data in enumerate(answer_data_list)
+                if answer_data is not None]
+
+        response_dicts = {}
+
+        if answered_indices:
+            # All answers are to the same page at the same revision, so the
+            # shared part of the request is the same for all of them.
+            run_req = self.get_run_request(page_contexts[answered_indices[0]])
+
+            for chunk_start in range(0, len(answered_indices), RUNPY_BATCH_SIZE):
+                chunk = answered_indices[
+                        chunk_start:chunk_start + RUNPY_BATCH_SIZE]
+
+                try:
+                    chunk_responses = request_python_run_batch_with_retries(
+                            run_req,
+                            [answer_data_list[i]["answer"] for i in chunk],
+                            run_timeout=self.page_desc.timeout,
+                            participation_ids=[
+                                page_contexts[i].flow_session.participation_id
+                                if page_contexts[i].flow_session is not None
+                                else None
+                                for i in chunk])
+                except Exception:
+                    chunk_responses = [
+                            make_run_failure_response() for i in chunk]
+
+                response_dicts.update(zip(chunk, chunk_responses))
+
+                from course.models import CodeRun
+                CodeRun.objects.bulk_create([
+                    make_code_run(page_contexts[i], self.page_desc.id,
+                        response_dicts[i])
+                    for i in chunk])
+
+        result = []
+        for i, (page_context, page_data, answer_data, grade_data) in enumerate(
+                zip(page_contexts, page_data_list, answer_data_list,
+                    grade_data_list)):
+            if i in response_dicts:
+                result.append(self.grade_run_response(
+                    page_context, page_data, answer_data, grade_data,
+                    response_dicts[i]))
+            else:
+                result.append(self.grade(
+                    page_context, page_data, answer_data, grade_data))
+
+        return result
+
+    def grade_run_response(self, page_context, page_data, answer_data,
+            grade_data, response_dict):
+        """
+        :arg response_dict: the :class:`course.page.code_runpy_backend.Response`
+            obtained by running the code in *answer_data*.
+        :returns: an :class:`course.page.base.AnswerFeedback`.
+        """
+
+        user_code = answer_data["answer"]
+
         feedback_bits = []
 
         # {{{ send email if the grading code broke
@@ -756,6 +1406,17 @@ class PythonCodeQuestion(PageBaseWithTitle, PageBaseWithValue):
 
         if response.result == "success":
             pass
+        elif response.result == "queued":
+            feedback_bits.append("".join([
+                "<p>",
+                _(
+                    "The servers that run code are very busy right now, "
+                    "so your code could not be run. Your answer has been "
+                    "saved. Please submit it again in a little while. "
+                    "If that is not possible, course staff can have it "
+                    "graded later."
+                    ),
+                "</p>"]))
         elif response.result in [
                 "uncaught_error",
                 "setup_compile_error",
@@ -930,7 +1591,8 @@ class PythonCodeQuestion(PageBaseWithTitle, PageBaseWithValue):
         return AnswerFeedback(
                 correctness=correctness,
                 feedback="\n".join(feedback_bits),
-                bulk_feedback="\n".join(bulk_feedback_bits))
+                bulk_feedback="\n".join(bulk_feedback_bits),
+                is_deferred=response.result == "queued")
 
     def correct_answer(self, page_context, page_data, answer_data, grade_data):
         result = ""
@@ -1090,16 +1752,13 @@ class PythonCodeQuestionWithHumanTextFeedback(
     def human_feedback_point_value(self, page_context, page_data):
         return self.page_desc.value * self.human_feedback_percentage / 100
 
-    def grade(self, page_context, page_data, answer_data, grade_data):
-        if answer_data is None:
-            return AnswerFeedback(correctness=0,
-                    feedback=_("No answer provided."))
-
+    def grade_run_response(self, page_context, page_data, answer_data,
+            grade_data, response_dict):
         if grade_data is not None and not grade_data["released"]:
             grade_data = None
 
-        code_feedback = PythonCodeQuestion.grade(self, page_context,
-                page_data, answer_data, grade_data)
+        code_feedback = PythonCodeQuestion.grade_run_response(self, page_context,
+                page_data, answer_data, grade_data, response_dict)
 
         human_points = self.human_feedback_point_value(page_context, page_data)
         code_points = self.page_desc.value - human_points
@@ -1162,7 +1821,8 @@ class PythonCodeQuestionWithHumanTextFeedback(
         return AnswerFeedback(
                 correctness=correctness,
                 feedback=feedback,
-                bulk_feedback=code_feedback.bulk_feedback)
+                bulk_feedback=code_feedback.bulk_feedback,
+                is_deferred=correctness is None and code_feedback.is_deferred)
 
 # }}}
 
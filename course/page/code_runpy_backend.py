@@ -122,6 +122,33 @@ PROTOCOL
         A list of strings.
 
         Present on ``success`` if :attr:`Request.compile_only` is *False*.
+
+BATCH PROTOCOL
+==============
+
+A :class:`BatchRequest` is sent as a ``POST`` to ``/run-python-batch``.
+Each entry of :attr:`BatchRequest.user_codes` is run in its own child
+process, so that no state carries over from one piece of user code to the
+next.
+
+.. class:: BatchRequest
+
+    Has all the attributes of :class:`Request` except for
+    :attr:`Request.user_code`, shared among all runs, and additionally:
+
+    .. attribute:: user_codes
+
+        A list of strings, each of which is used as the
+        :attr:`Request.user_code` of one run.
+
+    .. attribute:: timeout
+
+        The number of seconds each run is allowed to take.
+
+The reply is streamed as one line of JSON per entry of
+:attr:`BatchRequest.user_codes`, in order, each a :class:`Response`,
+written as soon as the corresponding run finishes. A run that exceeds
+:attr:`BatchRequest.timeout` is reported with a result of ``timeout``.
 """
 
 
@@ -24,7 +24,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.db import transaction
 from django.dispatch import receiver
 
@@ -32,6 +32,9 @@ from accounts.models import User
 from course.models import (
         Course, Participation, participation_status,
         ParticipationPreapproval,
+        GradeChange, GradingOpportunity, FlowSession, InstantFlowRequest,
+        ParticipationRole, ParticipationRolePermission, ParticipationPermission,
+        ParticipationTag,
         )
 
 if False:
@@ -109,4 +112,103 @@ def may_preapprove_role(course, user):
 
 # }}}
 
+
+# {{{ Drop cached grade summaries when what they summarize changes
+
+@receiver(post_save, sender=GradeChange)
+@receiver(post_delete, sender=GradeChange)
+def invalidate_grade_change_summary(sender, instance, raw=False, **kwargs):
+    # type: (Any, GradeChange, bool, **Any) -> None
+
+    from course.grades import invalidate_opportunity_grade_summary
+    invalidate_opportunity_grade_summary(instance.opportunity_id)
+
+
+@receiver(post_save, sender=GradingOpportunity)
+def invalidate_grading_opportunity_summary(sender, instance, **kwargs):
+    # type: (Any, GradingOpportunity, **Any) -> None
+
+    # Grade state machines refer to the opportunity (e.g. its due time).
+    from course.grades import invalidate_opportunity_grade_summary
+    invalidate_opportunity_grade_summary(instance.id)
+
+
+@receiver(post_save, sender=FlowSession)
+@receiver(post_delete, sender=FlowSession)
+def invalidate_flow_session_summary(sender, instance, raw=False, **kwargs):
+    # type: (Any, FlowSession, bool, **Any) -> None
+
+    from course.grades import invalidate_flow_session_summary
+    invalidate_flow_session_summary(instance.course_id, instance.flow_id)
+
+# }}}
+
+
+# {{{ Drop cached instant flow requests when they change
+
+@receiver(post_save, sender=InstantFlowRequest)
+@receiver(post_delete, sender=InstantFlowRequest)
+def invalidate_instant_flow_requests(sender, instance, raw=False, **kwargs):
+    # type: (Any, InstantFlowRequest, bool, **Any) -> None
+
+    from course.utils import invalidate_instant_flow_requests
+    invalidate_instant_flow_requests(instance.course_id)
+
+# }}}
+
+
+# {{{ Drop cached participations when they or their roles/tags/permissions change
+
+@receiver(post_save, sender=Course)
+def invalidate_course_participations(sender, instance, raw=False, **kwargs):
+    # type: (Any, Course, bool, **Any) -> None
+
+    from course.enrollment import invalidate_participation_cache
+    invalidate_participation_cache(instance.id)
+
+
+@receiver(post_save, sender=Participation)
+@receiver(post_delete, sender=Participation)
+@receiver(post_save, sender=ParticipationRole)
+@receiver(post_delete, sender=ParticipationRole)
+@receiver(post_save, sender=ParticipationTag)
+@receiver(post_delete, sender=ParticipationTag)
+@receiver(m2m_changed, sender=Participation.roles.through)
+@receiver(m2m_changed, sender=Participation.tags.through)
+def invalidate_participations(sender, instance, raw=False, **kwargs):
+    # type: (Any, Union[Participation, ParticipationRole, ParticipationTag], bool, **Any) -> None  # noqa
+
+    # For m2m_changed, *instance* may be on either side of the relation, both
+    # of which have a course.
+    from course.enrollment import invalidate_participation_cache
+    invalidate_participation_cache(instance.course_id)
+
+
+@receiver(post_save, sender=ParticipationRolePermission)
+@receiver(post_delete, sender=ParticipationRolePermission)
+def invalidate_role_permission_participations(sender, instance, raw=False,
+        **kwargs):
+    # type: (Any, ParticipationRolePermission, bool, **Any) -> None
+
+    from course.enrollment import invalidate_participation_cache
+    for course_id in (ParticipationRole.objects
+            .filter(id=instance.role_id)
+            .values_list("course_id", flat=True)):
+        invalidate_participation_cache(course_id)
+
+
+@receiver(post_save, sender=ParticipationPermission)
+@receiver(post_delete, sender=ParticipationPermission)
+def invalidate_permission_participations(sender, instance, raw=False,
+        **kwargs):
+    # type: (Any, ParticipationPermission, bool, **Any) -> None
+
+    from course.enrollment import invalidate_participation_cache
+    for course_id in (Participation.objects
+            .filter(id=instance.participation_id)
+            .values_list("course_id", flat=True)):
+        invalidate_participation_cache(course_id)
+
+# }}}
+
 # vim: foldmethod=marker
@@ -24,6 +24,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import six
 from celery import shared_task
 
 from django.utils.translation import ugettext as _
@@ -31,6 +32,13 @@ from django.utils.translation import ugettext as _
 from course.models import (Course, FlowSession)
 from course.content import get_course_repo
 
+if False:
+    from typing import List, Any  # noqa
+
+
+# Number of sessions whose answers are graded together when regrading
+REGRADE_CHUNK_SIZE = 50
+
 
 @shared_task(bind=True)
 def expire_in_progress_sessions(self, course_id, flow_id, rule_tag, now_datetime,
@@ -151,21 +159,187 @@ def regrade_flow_sessions(self, course_id, flow_id, access_rules_tag, inprog_val
     if inprog_value is not None:
         sessions = sessions.filter(in_progress=inprog_value)
 
-    nsessions = sessions.count()
+    sessions = list(sessions)
+    nsessions = len(sessions)
     count = 0
 
-    from course.flow import regrade_session
-    for session in sessions:
-        regrade_session(repo, course, session)
-        count += 1
+    from course.flow import regrade_session, precompute_regrade_feedback
 
-        self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': nsessions})
+    # Grade answers in chunks of sessions, so that pages that can grade many
+    # answers at once (such as code questions) get to do so, while keeping
+    # the amount of feedback held in memory bounded.
+    for chunk_start in range(0, nsessions, REGRADE_CHUNK_SIZE):
+        session_chunk = sessions[chunk_start:chunk_start + REGRADE_CHUNK_SIZE]
+
+        precomputed_feedback = precompute_regrade_feedback(
+                repo, course, session_chunk)
+
+        for session in session_chunk:
+            regrade_session(repo, course, session,
+                    precomputed_feedback=precomputed_feedback)
+            count += 1
+
+            self.update_state(
+                    state='PROGRESS',
+                    meta={'current': count, 'total': nsessions})
 
     repo.close()
 
     return {"message": _("%d sessions regraded.") % count}
 
 
+@shared_task(bind=True)
+def import_grades_from_csv(self, course_id, opportunity_id, attempt_id,
+        file_contents, attr_type, attr_column, points_column, feedback_column,
+        max_points, creator_id, grade_time, has_header):
+    from six import StringIO
+    from django.contrib.auth import get_user_model
+    from django.db import transaction
+    from course.models import GradingOpportunity
+    from course.grades import csv_to_grade_changes, save_imported_grade_changes
+
+    course = Course.objects.get(id=course_id)
+
+    log_lines = []  # type: List[Any]
+    total_count, grade_changes = csv_to_grade_changes(
+            log_lines=log_lines,
+            course=course,
+            grading_opportunity=GradingOpportunity.objects.get(
+                id=opportunity_id, course=course),
+            attempt_id=attempt_id,
+            file_contents=StringIO(file_contents),
+            attr_type=attr_type,
+            attr_column=attr_column,
+            points_column=points_column,
+            feedback_column=feedback_column,
+            max_points=max_points,
+            creator=get_user_model().objects.get(id=creator_id),
+            grade_time=grade_time,
+            has_header=has_header)
+
+    def report_progress(current, total):
+        self.update_state(
+                state='PROGRESS',
+                meta={'current': current, 'total': total})
+
+    with transaction.atomic():
+        save_imported_grade_changes(grade_changes, report_progress)
+
+    message = (
+            _("%(total)d grades found, %(imported)d imported.")
+            % {"total": total_count, "imported": len(grade_changes)})
+    if log_lines:
+        message = " ".join([message] + [six.text_type(line) for line in log_lines])
+
+    return {"message": message}
+
+
+@shared_task(bind=True)
+def build_submissions_archive(self, course_id, flow_id, group_id, page_id,
+        commit_sha, which_attempt, restrict_to_rules_tag, non_in_progress_only,
+        include_feedback, extra_file_name, extra_file_contents, requester_id):
+    import os
+    from zipfile import ZipFile
+    from django.utils.timezone import now
+    from course.grades import (
+            get_submission_archive_visits, write_submissions_archive)
+    from course.utils import (
+            get_task_download_path, remove_expired_task_downloads)
+
+    course = Course.objects.get(id=course_id)
+    repo = get_course_repo(course)
+
+    remove_expired_task_downloads()
+
+    visits = get_submission_archive_visits(course, flow_id, group_id, page_id,
+            restrict_to_rules_tag=restrict_to_rules_tag,
+            non_in_progress_only=non_in_progress_only)
+
+    def report_progress(current, total):
+        self.update_state(
+                state='PROGRESS',
+                meta={'current': current, 'total': total})
+
+    download_path = get_task_download_path(self.request.id)
+    try:
+        with ZipFile(download_path, "w") as subm_zip:
+            count = write_submissions_archive(subm_zip, course, repo,
+                    commit_sha, flow_id, visits, which_attempt, include_feedback,
+                    progress_callback=report_progress)
+
+            if extra_file_name is not None:
+                subm_zip.writestr(extra_file_name, extra_file_contents)
+    except Exception:
+        if os.path.exists(download_path):
+            os.remove(download_path)
+        raise
+    finally:
+        repo.close()
+
+    return {
+            "message": _("%d submissions archived.") % count,
+            "requester_id": requester_id,
+            "download_name": "submissions_%s_%s_%s_%s_%s.zip" % (
+                course.identifier, flow_id, group_id, page_id,
+                now().date().strftime("%Y-%m-%d")),
+            "download_content_type": "application/zip",
+            }
+
+
+# Snapshots of commits other than the active one that have not been viewed
+# (and hence refreshed) for this long are deleted.
+STALE_SNAPSHOT_MAX_AGE = 24*60*60
+
+
+@shared_task(bind=True)
+def refresh_flow_analytics_snapshots(self):
+    """Run periodically by the Celery scheduler, see
+    ``CELERYBEAT_SCHEDULE``.
+    """
+
+    from django.core.exceptions import ObjectDoesNotExist
+    from django.db.models import F
+    from datetime import timedelta
+    from django.utils.timezone import now
+    from course.analytics import refresh_flow_analytics_snapshot
+    from course.models import FlowAnalyticsSnapshot
+
+    (FlowAnalyticsSnapshot.objects
+            .exclude(commit_sha=F("course__active_git_commit_sha"))
+            .filter(refresh_time__lt=(
+                now() - timedelta(seconds=STALE_SNAPSHOT_MAX_AGE)))
+            .delete())
+
+    snapshots = (FlowAnalyticsSnapshot.objects
+            .filter(commit_sha=F("course__active_git_commit_sha"))
+            .order_by("course_id", "flow_id")
+            .values_list("id", "course_id", "flow_id"))
+
+    count = 0
+    course = None
+    repo = None
+
+    try:
+        for snapshot_id, course_id, flow_id in snapshots:
+            if course is None or course.id != course_id:
+                if repo is not None:
+                    repo.close()
+                course = Course.objects.get(id=course_id)
+                repo = get_course_repo(course)
+
+            try:
+                refresh_flow_analytics_snapshot(course, repo,
+                        course.active_git_commit_sha.encode(), flow_id)
+            except ObjectDoesNotExist:
+                # The flow no longer exists.
+                FlowAnalyticsSnapshot.objects.filter(id=snapshot_id).delete()
+            else:
+                count += 1
+    finally:
+        if repo is not None:
+            repo.close()
+
+    return {"message": _("%d flow analytics snapshots refreshed.") % count}
+
+
 # vim: foldmethod=marker
@@ -26,13 +26,14 @@ THE SOFTWARE.
 
 from typing import cast
 
+import os
 import six
 import datetime  # noqa
 
 from django.shortcuts import (  # noqa
         render, get_object_or_404)
 from django import http
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured
 from django.utils import translation
 from django.utils.translation import (
         ugettext as _, pgettext_lazy)
@@ -68,6 +69,7 @@ if False:
             ExamTicket,
             FlowSession,
             FlowPageData,
+            InstantFlowRequest,
             )
 
 # }}}
@@ -223,7 +225,7 @@ def _eval_participation_tags_conditions(
             # if_has_participation_tags_any or if_has_participation_tags_all
             # is not empty.
             return False
-        ptag_set = set(participation.tags.all().values_list("name", flat=True))
+        ptag_set = participation.tag_names()
         if not ptag_set:
             return False
         if (participation_tags_any_set
@@ -842,24 +844,105 @@ class ParticipationPermissionWrapper(object):
         raise TypeError("ParticipationPermissionWrapper is not iterable.")
 
 
+# {{{ instant flow requests
+
+# Cached instant flow requests of a course are dropped whenever one of them
+# is saved or deleted, and expire once one starts or ends. This only bounds
+# the staleness resulting from changes that bypass model signals.
+INSTANT_FLOW_REQUESTS_CACHE_TIMEOUT = 60 * 60
+
+
+def _get_instant_flow_requests_cache():
+    from relate.utils import is_cache_shared
+    if not is_cache_shared():
+        return None
+
+    try:
+        import django.core.cache as cache
+    except ImproperlyConfigured:
+        return None
+
+    return cache.caches["default"]
+
+
+def _get_instant_flow_requests_cache_key(course_id):
+    # type: (int) -> Text
+    return "relate-instant-flow-requests:%d" % course_id
+
+
+def invalidate_instant_flow_requests(course_id):
+    # type: (int) -> None
+    cache = _get_instant_flow_requests_cache()
+    if cache is None:
+        return
+
+    cache_key = _get_instant_flow_requests_cache_key(course_id)
+
+    # Deleting again once the transaction commits keeps requests that
+    # retrieve the instant flow requests in the meantime from caching stale
+    # data.
+    cache.delete(cache_key)
+    from django.db import transaction
+    transaction.on_commit(lambda: cache.delete(cache_key))
+
+
+def get_active_instant_flow_requests(course, now_datetime, use_cache=True):
+    # type: (Course, datetime.datetime, bool) -> List[InstantFlowRequest]
+
+    """
+    :returns: the instant flow requests of *course* that are active at
+        *now_datetime*, ordered by start time. If *use_cache* is true,
+        *now_datetime* must be the current time.
+    """
+
+    cache = _get_instant_flow_requests_cache() if use_cache else None
+    cache_key = _get_instant_flow_requests_cache_key(course.id)
+    if cache is not None:
+        result = cache.get(cache_key)
+        if result is not None:
+            return result
+
+    from course.models import InstantFlowRequest  # noqa
+    current_and_upcoming = list(InstantFlowRequest.objects
+            .filter(
+                course=course,
+                end_time__gte=now_datetime,
+                cancelled=False)
+            .order_by("start_time"))
+
+    result = [ifr for ifr in current_and_upcoming
+            if ifr.start_time <= now_datetime]
+
+    if cache is not None:
+        # until the next instant flow request starts or ends
+        timeout = INSTANT_FLOW_REQUESTS_CACHE_TIMEOUT
+        for ifr in current_and_upcoming:
+            for boundary in [ifr.start_time, ifr.end_time]:
+                if boundary > now_datetime:
+                    timeout = min(timeout,
+                            (boundary - now_datetime).total_seconds())
+
+        import math
+        cache.set(cache_key, result, max(1, int(math.ceil(timeout))))
+
+    return result
+
+# }}}
+
+
 def render_course_page(pctx, template_name, args,
         allow_instant_flow_requests=True):
     # type: (CoursePageContext, Text, Dict[Text, Any], bool) -> http.HttpResponse
 
     args = args.copy()
 
-    from course.views import get_now_or_fake_time
+    from course.views import get_now_or_fake_time, get_fake_time
     now_datetime = get_now_or_fake_time(pctx.request)
 
     if allow_instant_flow_requests:
-        from course.models import InstantFlowRequest
-        instant_flow_requests = list((InstantFlowRequest.objects
-                .filter(
-                    course=pctx.course,
-                    start_time__lte=now_datetime,
-                    end_time__gte=now_datetime,
-                    cancelled=False)
-                .order_by("start_time")))
+        instant_flow_requests = get_active_instant_flow_requests(
+                pctx.course, now_datetime,
+                use_cache=get_fake_time(pctx.request) is None)
     else:
         instant_flow_requests = []
 
@@ -1047,6 +1130,124 @@ def get_facilities_config(request=None):
         return facilities
 
 
+class FacilityIndex(object):
+    """Finds the facilities whose ``ip_ranges`` contain an IP address, with
+    the address ranges of a facilities configuration (as returned by
+    :func:`get_facilities_config`) converted once into sorted, disjoint
+    intervals of integer addresses that are searched by bisection.
+    """
+
+    # Number of remote addresses whose facilities are remembered
+    max_cached_addresses = 4096
+
+    def __init__(self, facilities):
+        # type: (Dict[Text, Dict[Text, Any]]) -> None
+        import ipaddress
+
+        self.exams_only_facilities = frozenset(
+                name for name, props in six.iteritems(facilities)
+                if props.get("exams_only", False))
+
+        # {ip version: [(address, +1 or -1, facility name)]}, marking where
+        # the address ranges of facilities begin and end
+        version_to_events = {}  # type: Dict[int, List[Tuple[int, int, Text]]]
+        for name, props in six.iteritems(facilities):
+            for ir in props.get("ip_ranges", []):
+                network = ipaddress.ip_network(six.text_type(ir))
+                events = version_to_events.setdefault(network.version, [])
+                events.append((int(network.network_address), 1, name))
+                events.append((int(network.broadcast_address) + 1, -1, name))
+
+        # {ip version: (interval starts, facilities of each interval)}
+        self.version_to_intervals = {}  # type: Dict[int, Tuple[List[int], List[FrozenSet[Text]]]]  # noqa
+        for version, events in six.iteritems(version_to_events):
+            events.sort()
+
+            starts = []  # type: List[int]
+            interval_facilities = []  # type: List[FrozenSet[Text]]
+            name_to_count = {}  # type: Dict[Text, int]
+            for address, delta, name in events:
+                name_to_count[name] = name_to_count.get(name, 0) + delta
+                if not name_to_count[name]:
+                    del name_to_count[name]
+
+                if starts and starts[-1] == address:
+                    interval_facilities[-1] = frozenset(name_to_count)
+                else:
+                    starts.append(address)
+                    interval_facilities.append(frozenset(name_to_count))
+
+            self.version_to_intervals[version] = (starts, interval_facilities)
+
+        self.address_to_facilities = {}  # type: Dict[Text, FrozenSet[Text]]
+
+    def get_facilities(self, remote_address):
+        # type: (Text) -> FrozenSet[Text]
+        try:
+            return self.address_to_facilities[remote_address]
+        except KeyError:
+            pass
+
+        import ipaddress
+        address = ipaddress.ip_address(six.text_type(remote_address))
+
+        facilities = frozenset()  # type: FrozenSet[Text]
+        if address.version in self.version_to_intervals:
+            from bisect import bisect_right
+            starts, interval_facilities = \
+                    self.version_to_intervals[address.version]
+            i = bisect_right(starts, int(address)) - 1
+            if i >= 0:
+                facilities = interval_facilities[i]
+
+        if len(self.address_to_facilities) >= self.max_cached_addresses:
+            self.address_to_facilities.clear()
+        self.address_to_facilities[remote_address] = facilities
+
+        return facilities
+
+
+# For how long (in seconds) the index built from what a callable
+# RELATE_FACILITIES returned is used before calling it again
+FACILITY_INDEX_CALLABLE_TIMEOUT = 60
+
+# (RELATE_FACILITIES, index, expiry time or None)
+_facility_index_cache = None  # type: Optional[Tuple[Any, FacilityIndex, Optional[float]]]  # noqa
+
+
+def get_facility_index(request=None):
+    # type: (Optional[http.HttpRequest]) -> FacilityIndex
+    from django.conf import settings
+    from time import time
+    from course.views import get_fake_time
+
+    global _facility_index_cache
+
+    facilities = getattr(settings, "RELATE_FACILITIES", None)
+    from_callable = callable(facilities)
+
+    # A callable's result at a fake time is neither taken from nor stored in
+    # the cache.
+    use_cache = not (from_callable and get_fake_time(request) is not None)
+
+    cached = _facility_index_cache
+    if use_cache and cached is not None:
+        cached_facilities, index, expiry = cached
+        if (cached_facilities is facilities
+                and (expiry is None or time() < expiry)):
+            return index
+
+    index = FacilityIndex(get_facilities_config(request) or {})
+
+    if use_cache:
+        _facility_index_cache = (
+                facilities, index,
+                time() + FACILITY_INDEX_CALLABLE_TIMEOUT
+                if from_callable else None)
+
+    return index
+
+
 class FacilityFindingMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
@@ -1055,21 +1256,12 @@ class FacilityFindingMiddleware(object):
         pretend_facilities = request.session.get("relate_pretend_facilities")
 
         if pretend_facilities is not None:
-            facilities = pretend_facilities
+            facilities = frozenset(pretend_facilities)
         else:
-            import ipaddress
-            remote_address = ipaddress.ip_address(
-                    six.text_type(request.META['REMOTE_ADDR']))
+            facilities = get_facility_index(request).get_facilities(
+                    request.META['REMOTE_ADDR'])
 
-            facilities = set()
-
-            for name, props in six.iteritems(get_facilities_config(request)):
-                ip_ranges = props.get("ip_ranges", [])
-                for ir in ip_ranges:
-                    if remote_address in ipaddress.ip_network(six.text_type(ir)):
-                        facilities.add(name)
-
-        request.relate_facilities = frozenset(facilities)
+        request.relate_facilities = facilities
 
         return self.get_response(request)
 
@@ -1116,6 +1308,117 @@ def csv_data_importable(file_contents, column_idx_list, header_count):
     return True, ""
 
 
+class _CSVRowEcho(object):
+    """A file-like object that hands back what is written to it, so that
+    a CSV writer can produce one row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def make_streaming_csv_response(rows, filename):
+    # type: (Iterable[List[Any]], Text) -> http.StreamingHttpResponse
+
+    """
+    :arg rows: an iterable of rows (lists of values) to be written as CSV,
+        consumed only as the response is sent.
+    :returns: a :class:`django.http.StreamingHttpResponse` offering the
+        CSV as a download named *filename*.
+    """
+
+    if six.PY2:
+        import unicodecsv as csv
+    else:
+        import csv
+
+    writer = csv.writer(_CSVRowEcho())
+
+    def generate_csv():
+        for row in rows:
+            line = writer.writerow(row)
+            if not isinstance(line, bytes):
+                line = line.encode("utf-8")
+            yield line
+
+    response = http.StreamingHttpResponse(
+            generate_csv(),
+            content_type="text/plain; charset=utf-8")
+    response['Content-Disposition'] = (
+            'attachment; filename="%s"' % filename)
+    return response
+
+
+# {{{ files produced by background tasks
+
+# Files produced by background tasks are removed after this many seconds
+TASK_DOWNLOAD_MAX_AGE = 24 * 60 * 60
+
+
+def get_task_download_dir():
+    # type: () -> Text
+
+    from django.conf import settings
+    download_dir = getattr(settings, "RELATE_TASK_DOWNLOAD_DIR", None)
+    if download_dir is None:
+        import tempfile
+        download_dir = os.path.join(
+                tempfile.gettempdir(), "relate-task-downloads")
+
+    if not os.path.isdir(download_dir):
+        try:
+            os.makedirs(download_dir)
+        except OSError:
+            # created concurrently by another worker
+            if not os.path.isdir(download_dir):
+                raise
+
+    return download_dir
+
+
+def get_task_download_path(task_id):
+    # type: (Text) -> Text
+
+    """
+    :returns: the path of the file in which the background task *task_id*
+        stores the file it produces for download.
+    """
+
+    return os.path.join(get_task_download_dir(), "%s.download" % task_id)
+
+
+def remove_expired_task_downloads(max_age=TASK_DOWNLOAD_MAX_AGE):
+    # type: (int) -> int
+
+    """Remove files produced by background tasks that are older than
+    *max_age* seconds.
+
+    :returns: the number of files removed.
+    """
+
+    import time
+    download_dir = get_task_download_dir()
+    expiry_time = time.time() - max_age
+
+    count = 0
+    for name in os.listdir(download_dir):
+        if not name.endswith(".download"):
+            continue
+
+        path = os.path.join(download_dir, name)
+        try:
+            if os.path.getmtime(path) < expiry_time:
+                os.remove(path)
+                count += 1
+        except OSError:
+            # removed concurrently by another worker
+            pass
+
+    return count
+
+# }}}
+
+
 def will_use_masked_profile_for_email(recipient_email):
     # type: (Union[Text, List[Text]]) -> bool
     if not recipient_email:
@@ -641,6 +641,10 @@ def manage_instant_flow_requests(pctx):
                             cancelled=False)
                         .order_by("start_time")
                         .update(cancelled=True))
+
+                # The update bypasses the signal handler doing this.
+                from course.utils import invalidate_instant_flow_requests
+                invalidate_instant_flow_requests(pctx.course.id)
             else:
                 raise SuspiciousOperation(_("invalid operation"))
 
@@ -1325,11 +1329,18 @@ def monitor_task(request, task_id):
                 _("%(current)d out of %(total)d items processed.")
                 % {"current": current, "total": total})
 
+    download_url = None
+
     if async_res.state == "SUCCESS":
         if (isinstance(async_res.result, dict)
                 and "message" in async_res.result):
             progress_statement = async_res.result["message"]
 
+        if (isinstance(async_res.result, dict)
+                and "download_name" in async_res.result):
+            from django.urls import reverse
+            download_url = reverse("relate-download_task_result", args=(task_id,))
+
     traceback = None
     if request.user.is_staff and async_res.state == "FAILURE":
         traceback = async_res.traceback
@@ -1338,9 +1349,39 @@ def monitor_task(request, task_id):
         "state": async_res.state,
         "progress_percent": progress_percent,
         "progress_statement": progress_statement,
+        "download_url": download_url,
         "traceback": traceback,
         })
 
+
+@login_required
+def download_task_result(request, task_id):
+    from celery.result import AsyncResult
+    async_res = AsyncResult(task_id)
+
+    if (async_res.state != "SUCCESS"
+            or not isinstance(async_res.result, dict)
+            or "download_name" not in async_res.result):
+        raise http.Http404()
+
+    result = async_res.result
+    if (result["requester_id"] != request.user.id
+            and not request.user.is_superuser):
+        raise PermissionDenied(_("may not download the result of this task"))
+
+    from course.utils import get_task_download_path
+    try:
+        download_file = open(get_task_download_path(task_id), "rb")
+    except IOError:
+        raise http.Http404(_("The result of this task has expired."))
+
+    response = http.FileResponse(
+            download_file,
+            content_type=result["download_content_type"])
+    response['Content-Disposition'] = (
+            'attachment; filename="%s"' % result["download_name"])
+    return response
+
 # }}}
 
 
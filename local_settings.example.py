@@ -45,6 +45,13 @@ from django.conf.global_settings import gettext_noop  # noqa
 # Btw, do not be tempted to use 'MemcachedCache'--it's unmaintained and
 # broken in Python 33, as of 2016-08-01.
 #
+# Data that RELATE drops from the cache when it changes (such as the grade
+# summaries shown per grading opportunity, the active instant flow requests
+# of a course or the participations of users along with their roles and
+# permissions) is only cached if the cache is shared among all processes,
+# i.e. if it is not a 'LocMemCache' or a 'DummyCache'. Otherwise, other
+# processes would keep serving stale data.
+#
 # CACHES = {
 #     'default': {
 #         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
@@ -319,6 +326,37 @@ RELATE_DOCKER_TLS_CONFIG = None
 #     ca_cert=os.path.join(pki_base_dir, "ca.pem"),
 #     verify=True)
 
+# Limit the number of code runs in flight at once, across all workers, so
+# that a burst of submissions does not overload the Docker host. This needs
+# a cache shared among workers (see CACHES above) to take effect across
+# them. None means no limit.
+RELATE_RUNPY_MAX_CONCURRENT_RUNS = None
+
+# When runs are limited, at most this many runs wait for a free slot,
+# each for at most RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS, and at most
+# RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION runs of the same participant
+# wait or run at once. Runs that are turned away are reported to the
+# participant as queued instead of being graded.
+# RELATE_RUNPY_MAX_QUEUE_LENGTH = 100
+# RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS = 30
+# RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION = 2
+
+# }}}
+
+# {{{ background task downloads
+
+# Directory in which background tasks (such as the one building the
+# "download all submissions" archive) store the files they produce until
+# they are downloaded. It must be shared between the Celery workers and
+# the web server. Files are removed after a day. None means a directory
+# within the system's temporary directory.
+# RELATE_TASK_DOWNLOAD_DIR = "/var/lib/relate/task-downloads"
+
+# Interval (in seconds) at which the Celery scheduler ("celery beat")
+# refreshes the stored flow analytics. Analytics that have not been
+# refreshed for twice this interval are refreshed when they are viewed.
+# RELATE_FLOW_ANALYTICS_REFRESH_INTERVAL = 5*60
+
 # }}}
 
 # {{{ maintenance and announcements
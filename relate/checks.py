@@ -48,6 +48,10 @@ RELATE_FACILITIES = "RELATE_FACILITIES"
 RELATE_MAINTENANCE_MODE_EXCEPTIONS = "RELATE_MAINTENANCE_MODE_EXCEPTIONS"
 RELATE_SESSION_RESTART_COOLDOWN_SECONDS = "RELATE_SESSION_RESTART_COOLDOWN_SECONDS"
 RELATE_TICKET_MINUTES_VALID_AFTER_USE = "RELATE_TICKET_MINUTES_VALID_AFTER_USE"
+RELATE_RUNPY_MAX_CONCURRENT_RUNS = "RELATE_RUNPY_MAX_CONCURRENT_RUNS"
+RELATE_RUNPY_MAX_QUEUE_LENGTH = "RELATE_RUNPY_MAX_QUEUE_LENGTH"
+RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS = "RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS"
+RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION = "RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION"
 GIT_ROOT = "GIT_ROOT"
 RELATE_STARTUP_CHECKS = "RELATE_STARTUP_CHECKS"
 RELATE_STARTUP_CHECKS_EXTRA = "RELATE_STARTUP_CHECKS_EXTRA"
@@ -312,6 +316,40 @@ def check_relate_settings(app_configs, **kwargs):
 
     # }}}
 
+    # {{{ check code run admission settings
+
+    # A limit of zero concurrent runs (or runs per participation) would
+    # turn away every run.
+    for runpy_admission_setting, types, min_value in [
+            (RELATE_RUNPY_MAX_CONCURRENT_RUNS, (int,), 1),
+            (RELATE_RUNPY_MAX_QUEUE_LENGTH, (int,), 0),
+            (RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS, (int, float), 0),
+            (RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION, (int,), 1),
+            ]:
+        value = getattr(settings, runpy_admission_setting, None)
+        if value is None:
+            continue
+
+        if not isinstance(value, types) or isinstance(value, bool):
+            errors.append(RelateCriticalCheckMessage(
+                msg=(INSTANCE_ERROR_PATTERN
+                     % {"location": runpy_admission_setting,
+                        "types": " or ".join(tp.__name__ for tp in types)}),
+                id="relate_runpy_admission.E001")
+            )
+        elif value < min_value:
+            errors.append(RelateCriticalCheckMessage(
+                msg=(
+                    "%(location)s must be at least %(min_value)s, "
+                    "got %(value)s instead"
+                    % {"location": runpy_admission_setting,
+                       "min_value": min_value,
+                       "value": value}),
+                id="relate_runpy_admission.E002")
+            )
+
+    # }}}
+
     # {{{ check GIT_ROOT
     git_root = getattr(settings, GIT_ROOT, None)
     if git_root is None:
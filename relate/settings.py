@@ -290,6 +290,16 @@ if "CELERY_RESULT_BACKEND" not in globals():
     else:
         CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 
+if "CELERYBEAT_SCHEDULE" not in globals():
+    from datetime import timedelta
+    CELERYBEAT_SCHEDULE = {
+        "refresh-flow-analytics-snapshots": {
+            "task": "course.tasks.refresh_flow_analytics_snapshots",
+            "schedule": timedelta(seconds=globals().get(
+                "RELATE_FLOW_ANALYTICS_REFRESH_INTERVAL", 5*60)),
+            },
+        }
+
 # }}}
 
 LOCALE_PATHS = (
@@ -97,6 +97,11 @@ urlpatterns = [
         "$",
         course.views.monitor_task,
         name="relate-monitor_task"),
+    url(r"^download-task-result"
+        "/(?P<task_id>[-0-9a-f]+)"
+        "$",
+        course.views.download_task_result,
+        name="relate-download_task_result"),
 
     # {{{ troubleshooting
 
@@ -187,6 +192,11 @@ urlpatterns = [
         "/grading/overview/$",
         course.grades.view_gradebook,
         name="relate-view_gradebook"),
+    url(r"^course"
+        "/" + COURSE_ID_REGEX +
+        "/grading/overview/data/$",
+        course.grades.view_gradebook_data,
+        name="relate-view_gradebook_data"),
     url(r"^course"
         "/" + COURSE_ID_REGEX +
         "/grading/overview/csv/$",
@@ -506,6 +516,14 @@ urlpatterns = [
         "/$",
         course.analytics.page_analytics,
         name="relate-page_analytics"),
+    url(r"^course"
+        "/" + COURSE_ID_REGEX +
+        "/flow-analytics"
+        "/" + FLOW_ID_REGEX +
+        "/code-runs"
+        "/$",
+        course.analytics.code_run_analytics,
+        name="relate-code_run_analytics"),
 
     # }}}
 
@@ -548,6 +566,12 @@ urlpatterns = [
         course.api.get_flow_session_content,
         name="relate-course_get_flow_session_content"),
 
+    url(r"^course"
+        "/" + COURSE_ID_REGEX +
+        "/api/v1/get-flow-sessions-content$",
+        course.api.get_flow_sessions_content,
+        name="relate-course_get_flow_sessions_content"),
+
     url(r'^admin/', admin.site.urls),
 ]
 
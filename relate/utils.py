@@ -171,6 +171,22 @@ def get_site_name():
     return getattr(settings, "RELATE_SITE_NAME", "RELATE")
 
 
+def is_cache_shared(alias="default"):
+    # type: (Text) -> bool
+
+    """
+    :returns: *True* if the cache *alias* is shared among processes, i.e.
+        if it is neither a per-process local-memory cache nor a dummy cache.
+        Data that gets invalidated (rather than just timing out) may only
+        be cached in a shared cache, since the invalidation would otherwise
+        only reach the cache of the process doing it.
+    """
+
+    from django.conf import settings
+    backend = settings.CACHES.get(alias, {}).get("BACKEND", "")
+    return "LocMem" not in backend and "Dummy" not in backend
+
+
 def render_email_template(template_name, context=None, request=None, using=None):
     # type: (Text, Optional[Dict], Optional[HttpRequest], Optional[bool]) -> Text
     if context is None:
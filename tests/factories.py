@@ -110,3 +110,15 @@ class GradingOpportunityFactory(factory.django.DjangoModelFactory):
     name = get_default_gopp_name()
     flow_id = DEFAULT_FLOW_ID
     aggregation_strategy = DEFAULT_GRADE_AGGREGATION_STRATEGY
+
+
+class GradeChangeFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = models.GradeChange
+
+    opportunity = factory.SubFactory(GradingOpportunityFactory)
+    participation = factory.SubFactory(ParticipationFactory)
+    state = constants.grade_state_change_types.graded
+    points = 5
+    max_points = 10
+    grade_time = factory.LazyFunction(now)
@@ -0,0 +1,390 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from django.test import TestCase, mock
+from django.utils.timezone import now, timedelta
+
+from relate.utils import dict_to_struct
+from course.models import (
+        FlowSession, FlowPageData, FlowPageVisit, FlowPageVisitGrade,
+        FlowAnalyticsSnapshot)
+from course.constants import participation_status
+
+from course.analytics import _count_session_answers
+
+from . import factories
+from .test_grades import create_repo_less_course
+
+
+class FlowAnalyticsSnapshotTest(TestCase):
+    # test course.analytics.refresh_flow_analytics_snapshot
+
+    def setUp(self):  # noqa
+        super(FlowAnalyticsSnapshotTest, self).setUp()
+        self.course = create_repo_less_course()
+        self.flow_desc = dict_to_struct({
+            "groups": [dict_to_struct({
+                "id": "main",
+                "pages": [
+                    dict_to_struct({"id": "q1"}),
+                    dict_to_struct({"id": "q2"}),
+                    dict_to_struct({"id": "unvisited"}),
+                    ]})],
+            })
+
+        self.page = mock.MagicMock()
+        self.page.expects_answer.return_value = True
+        self.page.title.return_value = "Title"
+        self.page.body.return_value = "Body"
+        self.page.normalized_answer.side_effect = (
+                lambda page_context, page_data, answer: answer["answer"])
+
+        self.time = now() - timedelta(days=1)
+        self.participations = []
+        for i in range(3):
+            participation = factories.ParticipationFactory(
+                    course=self.course, status=participation_status.active)
+            self.participations.append(participation)
+            session = factories.FlowSessionFactory(
+                    course=self.course, participation=participation,
+                    start_time=self.time, completion_time=self.time,
+                    points=i, max_points=2)
+
+            for page_ordinal, page_id in enumerate(["q1", "q2"]):
+                page_data = FlowPageData.objects.create(
+                        flow_session=session, page_ordinal=page_ordinal,
+                        page_type="TextQuestion", group_id="main",
+                        page_id=page_id, data={})
+
+                # A wrong answer first, then (except for the last
+                # participant) a correct one.
+                attempts = [("wrong", 0), ("right", 1)][:2 if i < 2 else 1]
+                for answer, correctness in attempts:
+                    self.time += timedelta(minutes=1)
+                    visit = FlowPageVisit.objects.create(
+                            flow_session=session, page_data=page_data,
+                            visit_time=self.time, answer={"answer": answer},
+                            is_submitted_answer=True)
+                    FlowPageVisitGrade.objects.create(
+                            visit=visit, max_points=1, correctness=correctness,
+                            grade_time=self.time)
+
+    def refresh(self):
+        from course.analytics import refresh_flow_analytics_snapshot
+
+        with mock.patch("course.analytics.get_flow_desc",
+                return_value=self.flow_desc), \
+                mock.patch("course.analytics.is_page_multiple_submit",
+                    side_effect=lambda flow_desc, page_desc: (
+                        page_desc.id == "q2")), \
+                mock.patch("course.utils.PageInstanceCache.get_page",
+                    return_value=self.page):
+            return refresh_flow_analytics_snapshot(
+                    self.course, mock.MagicMock(), b"sha",
+                    factories.DEFAULT_FLOW_ID)
+
+    def get_stats(self, snapshot, restrict_to_first_attempt):
+        from course.analytics import make_page_answer_stats_list
+
+        pctx = mock.MagicMock()
+        pctx.course_identifier = self.course.identifier
+
+        stats_list = make_page_answer_stats_list(
+                pctx, snapshot, restrict_to_first_attempt)
+
+        return dict(
+                (stats.page_id, (stats.total_count,
+                    round(stats.average_correctness_percent)))
+                for stats in stats_list)
+
+    def test_stats(self):
+        snapshot = self.refresh()
+
+        self.assertEqual(self.get_stats(snapshot, False), {
+            # all attempts
+            "q1": (5, 40),
+            # last attempt of each session
+            "q2": (3, 67),
+            })
+        self.assertEqual(self.get_stats(snapshot, True), {
+            "q1": (3, 0),
+            "q2": (3, 0),
+            })
+
+        # Titles are only computed once per page.
+        self.assertEqual(self.page.title.call_count, 2)
+        page_data = snapshot.data["pages"]["main/q1"]
+        self.assertEqual(
+                sorted(
+                    [page_data["normalized_answers"][digest], correctness,
+                        count]
+                    for digest, correctness, count in page_data["all"]["answers"]),
+                [["right", 1, 2], ["wrong", 0, 3]])
+
+    @mock.patch("course.analytics.FLOW_ANALYTICS_SAFETY_LAG", 0)
+    def test_incremental_refresh(self):
+        snapshot = self.refresh()
+        self.assertEqual(self.page.normalized_answer.call_count, 10)
+
+        # nothing new: no sessions are recounted (and the normalized
+        # answers were stored)
+        self.page.normalized_answer.reset_mock()
+        with mock.patch("course.analytics._count_session_answers") \
+                as mock_count:
+            snapshot = self.refresh()
+        self.assertEqual(mock_count.call_count, 0)
+
+        # the last participant submits a correct answer to q2 ...
+        page_data = FlowPageData.objects.get(
+                flow_session__participation=self.participations[-1],
+                page_id="q2")
+        visit = FlowPageVisit(
+                flow_session=page_data.flow_session, page_data=page_data,
+                visit_time=self.time + timedelta(minutes=1),
+                answer={"answer": "right"}, is_submitted_answer=True)
+        visit.store_normalized_answer(self.page, None)
+        visit.save()
+        self.page.normalized_answer.reset_mock()
+        FlowPageVisitGrade.objects.create(
+                visit=visit, max_points=1, correctness=1,
+                grade_time=self.time)
+
+        # ... and an earlier answer to q1 gets regraded
+        FlowPageVisitGrade.objects.create(
+                visit=FlowPageVisit.objects.filter(
+                    page_data__page_id="q1").earliest("visit_time"),
+                max_points=1, correctness=1,
+                grade_time=self.time)
+
+        with mock.patch("course.analytics._count_session_answers",
+                wraps=_count_session_answers) as mock_count:
+            snapshot = self.refresh()
+        self.assertEqual(len(mock_count.call_args[0][-1]), 2)
+        self.assertEqual(self.page.normalized_answer.call_count, 0)
+        self.assertEqual(self.get_stats(snapshot, False), {
+            "q1": (5, 60),
+            "q2": (3, 100),
+            })
+        self.assertEqual(self.get_stats(snapshot, True), {
+            "q1": (3, 33),
+            "q2": (3, 0),
+            })
+
+    def test_submitted_late_commit_and_deletion(self):
+        snapshot = self.refresh()
+
+        # An answer that was saved, but not submitted, ...
+        page_data = FlowPageData.objects.get(
+                flow_session__participation=self.participations[-1],
+                page_id="q1")
+        visit = FlowPageVisit.objects.create(
+                flow_session=page_data.flow_session, page_data=page_data,
+                visit_time=self.time + timedelta(minutes=1),
+                answer={"answer": "right"}, is_submitted_answer=False)
+        self.refresh()
+
+        # ... gets submitted when the session is finished, in a transaction
+        # that only commits after the next refresh started.
+        visit.is_submitted_answer = True
+        visit.save()
+        FlowSession.objects.filter(id=page_data.flow_session_id).update(
+                modification_time=snapshot.refresh_time)
+
+        snapshot = self.refresh()
+        self.assertEqual(self.get_stats(snapshot, False)["q1"], (6, 40))
+
+        # Deleted sessions are no longer counted.
+        page_data.flow_session.delete()
+        snapshot = self.refresh()
+        self.assertEqual(self.get_stats(snapshot, False), {
+            "q1": (4, 50),
+            "q2": (2, 100),
+            })
+
+    def test_periodic_rebuild(self):
+        from course.analytics import FLOW_ANALYTICS_REBUILD_INTERVAL
+
+        snapshot = self.refresh()
+        rebuild_time = snapshot.rebuild_time
+
+        snapshot = self.refresh()
+        self.assertEqual(snapshot.rebuild_time, rebuild_time)
+
+        FlowAnalyticsSnapshot.objects.update(
+                rebuild_time=rebuild_time - timedelta(
+                    seconds=FLOW_ANALYTICS_REBUILD_INTERVAL + 1))
+        with mock.patch("course.analytics._count_session_answers",
+                wraps=_count_session_answers) as mock_count:
+            snapshot = self.refresh()
+        self.assertEqual(len(mock_count.call_args[0][-1]), 3)
+        self.assertGreater(snapshot.rebuild_time, rebuild_time)
+
+    def test_backfill_normalized_answers(self):
+        from collections import Counter
+        from django.core.management import call_command
+        from six import StringIO
+
+        FlowPageVisit.objects.filter(
+                page_data__page_id="q2",
+                answer__contains="wrong").update(answer=None)
+
+        modification_times = list(FlowSession.objects
+                .order_by("id").values_list("modification_time", flat=True))
+
+        with mock.patch("course.content.get_course_repo"), \
+                mock.patch("course.utils.PageInstanceCache.get_page",
+                    return_value=self.page):
+            call_command("backfill_normalized_answers",
+                    self.course.identifier, stdout=StringIO())
+
+        self.assertEqual(
+                Counter(FlowPageVisit.objects.values_list(
+                    "page_data__page_id", "normalized_answer")),
+                Counter({("q1", "wrong"): 3, ("q1", "right"): 2,
+                    ("q2", None): 3, ("q2", "right"): 2}))
+        self.assertFalse(FlowPageVisit.objects.filter(
+            normalized_answer_digest__isnull=True).exists())
+
+        # Sessions are not marked as modified.
+        self.assertEqual(
+                list(FlowSession.objects
+                    .order_by("id").values_list("modification_time", flat=True)),
+                modification_times)
+
+        # Stored normalized answers are used by the analytics.
+        self.page.normalized_answer.reset_mock()
+        self.refresh()
+        self.assertEqual(self.page.normalized_answer.call_count, 0)
+
+    def test_unnormalizable_answer(self):
+        def normalized_answer(page_context, page_data, answer):
+            if answer["answer"] == "wrong":
+                raise ValueError("page type changed")
+            return answer["answer"]
+
+        self.page.normalized_answer.side_effect = normalized_answer
+
+        snapshot = self.refresh()
+        self.assertEqual(self.get_stats(snapshot, False)["q1"], (5, 40))
+
+        page_data = snapshot.data["pages"]["main/q1"]
+        self.assertEqual(
+                sorted(
+                    [page_data["normalized_answers"][digest], count]
+                    for digest, correctness, count in page_data["all"]["answers"]),
+                [["(could not be normalized)", 3], ["right", 2]])
+
+    def test_refresh_task(self):
+        from course.tasks import refresh_flow_analytics_snapshots
+
+        self.refresh()
+        self.course.active_git_commit_sha = "sha"
+        self.course.save()
+
+        FlowAnalyticsSnapshot.objects.create(
+                course=self.course, flow_id=factories.DEFAULT_FLOW_ID,
+                commit_sha="stale", refresh_time=now() - timedelta(days=2))
+
+        with mock.patch("course.tasks.get_course_repo"), \
+                mock.patch(
+                    "course.analytics.refresh_flow_analytics_snapshot"
+                ) as mock_refresh:
+            refresh_flow_analytics_snapshots()
+
+        self.assertEqual(mock_refresh.call_count, 1)
+        self.assertEqual(
+                list(FlowAnalyticsSnapshot.objects.values_list(
+                    "commit_sha", flat=True)),
+                ["sha"])
+
+
+class HistogramTest(TestCase):
+    # test course.analytics.Histogram
+
+    def get_bins(self, hist):
+        return [(bin_info.title, bin_info.raw_weight)
+                for bin_info in hist.get_bin_info_list()]
+
+    def test_add_data_points(self):
+        from course.analytics import Histogram
+
+        values = [5, 15, 15, 99, 100, 120, -1, None]
+
+        hist = Histogram(num_min_value=0, num_max_value=100)
+        for value in values:
+            hist.add_data_point(value)
+
+        array_hist = Histogram(num_min_value=0, num_max_value=100)
+        array_hist.add_data_points(
+                [float("nan") if value is None else value
+                    for value in values])
+
+        self.assertEqual(self.get_bins(array_hist), self.get_bins(hist))
+        self.assertEqual(array_hist.total_weight(), len(values))
+        self.assertEqual(self.get_bins(array_hist)[:2],
+                [("0.0", 1), ("10.0", 2)])
+
+    def test_log_bins(self):
+        from course.analytics import Histogram
+
+        hist = Histogram(num_bin_count=3, num_log_bins=True)
+        hist.add_data_points([1, 10, 100, 1000])
+
+        self.assertEqual(
+                [(round(float(title)), weight)
+                    for title, weight in self.get_bins(hist)],
+                [(1, 1), (10, 1), (100, 2)])
+
+    def test_session_histograms(self):
+        from course.analytics import make_grade_histogram, make_time_histogram
+
+        course = create_repo_less_course()
+        start_time = now() - timedelta(days=1)
+        for in_progress, minutes, points in [
+                (False, 10, 5), (False, 100, 10), (True, None, None)]:
+            participation = factories.ParticipationFactory(
+                    course=course, status=participation_status.active)
+            factories.FlowSessionFactory(
+                    course=course, participation=participation,
+                    in_progress=in_progress, start_time=start_time,
+                    completion_time=(
+                        start_time + timedelta(minutes=minutes)
+                        if minutes is not None else None),
+                    points=points, max_points=10)
+
+        with self.assertNumQueries(1):
+            hist = make_grade_histogram(course, factories.DEFAULT_FLOW_ID)
+        bins = self.get_bins(hist)
+        self.assertEqual(bins[5:],
+                [("50.0", 1), ("60.0", 0), ("70.0", 0), ("80.0", 0),
+                    ("90.0", 1), ("<in progress>", 1)])
+        self.assertEqual(hist.total_weight(), 3)
+
+        with self.assertNumQueries(1):
+            hist = make_time_histogram(course, factories.DEFAULT_FLOW_ID)
+        bins = self.get_bins(hist)
+        self.assertEqual(
+                [weight for title, weight in bins],
+                [1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1])
+        self.assertIn("10.0", bins[0][0])
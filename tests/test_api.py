@@ -0,0 +1,298 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import json
+
+from django.contrib.auth.hashers import make_password
+from django.test import TestCase, mock
+from django.urls import reverse
+from django.utils.timezone import now, timedelta
+
+from course.constants import participation_status
+from course.models import (
+        AuthenticationToken, FlowSession, ParticipationRole, FlowPageData,
+        FlowPageVisit)
+
+from . import factories
+from .test_grades import create_repo_less_course
+
+
+class FlowSessionsAPITest(TestCase):
+    def setUp(self):  # noqa
+        super(FlowSessionsAPITest, self).setUp()
+        self.course = create_repo_less_course()
+
+        instructor = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+        instructor.roles.set([ParticipationRole.objects.get(
+            course=self.course, identifier="instructor")])
+
+        token = AuthenticationToken.objects.create(
+                user=instructor.user, participation=instructor,
+                description="test", token_hash=make_password("secret"))
+        self.auth_header = "Token %d_secret" % token.id
+
+        self.sessions = [
+                factories.FlowSessionFactory(
+                    course=self.course,
+                    participation=factories.ParticipationFactory(
+                        course=self.course,
+                        status=participation_status.active))
+                for i in range(5)]
+
+    def get_flow_sessions(self, url_name="relate-course_get_flow_session",
+            **args):
+        args.setdefault("flow_id", factories.DEFAULT_FLOW_ID)
+        return self.client.get(
+                reverse(url_name, args=(self.course.identifier,)),
+                args, HTTP_AUTHORIZATION=self.auth_header)
+
+    def get_session_ids(self, response):
+        return [sess["id"] for sess in json.loads(response.content.decode())]
+
+    def test_pagination(self):
+        response = self.get_flow_sessions()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+                self.get_session_ids(response),
+                [sess.id for sess in self.sessions])
+        self.assertFalse(response.has_header("Link"))
+
+        session_ids = []
+        response = self.get_flow_sessions(page_size=2)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            page_ids = self.get_session_ids(response)
+            self.assertLessEqual(len(page_ids), 2)
+            session_ids.extend(page_ids)
+
+            if not response.has_header("Link"):
+                break
+
+            next_url = response["Link"].split(">")[0][1:]
+            response = self.client.get(
+                    next_url, HTTP_AUTHORIZATION=self.auth_header)
+
+        self.assertEqual(session_ids, [sess.id for sess in self.sessions])
+
+        response = self.get_flow_sessions(page_size=0)
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson(self):
+        response = self.get_flow_sessions(format="ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+                [json.loads(line)["id"] for line in lines],
+                [sess.id for sess in self.sessions])
+
+    def test_modified_since(self):
+        since = now()
+        FlowSession.objects.filter(
+                id__in=[sess.id for sess in self.sessions]).update(
+                        modification_time=since - timedelta(days=1))
+        self.sessions[3].save()
+
+        response = self.get_flow_sessions(modified_since=since.isoformat())
+        self.assertEqual(self.get_session_ids(response), [self.sessions[3].id])
+
+        response = self.get_flow_sessions(modified_since="yesterday")
+        self.assertEqual(response.status_code, 400)
+
+    def add_answers(self, sessions):
+        for sess in sessions:
+            sess.page_count = 2
+            sess.save()
+            for page_ordinal in range(2):
+                page_data = FlowPageData.objects.create(
+                        flow_session=sess, page_ordinal=page_ordinal,
+                        page_type="TextQuestion", group_id="main",
+                        page_id="q%d" % page_ordinal, data={})
+                FlowPageVisit.objects.create(
+                        flow_session=sess, page_data=page_data,
+                        answer={"answer": "a%d" % page_ordinal},
+                        is_submitted_answer=True)
+
+    def get_contents(self, normalized_bytes_answer=None, **args):
+        def default_normalized_bytes_answer(page_context, page_data, answer):
+            return ".txt", answer["answer"].encode()
+
+        page = mock.MagicMock()
+        page.page_desc.type = "TextQuestion"
+        page.normalized_bytes_answer.side_effect = (
+                normalized_bytes_answer or default_normalized_bytes_answer)
+
+        with mock.patch("course.content.get_course_repo"), \
+                mock.patch(
+                    "course.utils.PageInstanceCache.get_flow_desc_from_cache"), \
+                mock.patch("course.utils.PageInstanceCache.get_page",
+                    return_value=page):
+            response = self.get_flow_sessions(
+                    "relate-course_get_flow_sessions_content", **args)
+            self.assertEqual(response.status_code, 200)
+            return [
+                    json.loads(line)
+                    for line in b"".join(response.streaming_content)
+                    .decode().splitlines()]
+
+    def test_content(self):
+        self.add_answers(self.sessions)
+
+        contents = self.get_contents()
+        self.assertEqual(
+                [content["session"]["id"] for content in contents],
+                [sess.id for sess in self.sessions])
+        self.assertEqual(
+                [page["answer"]["answer"] for page in contents[0]["pages"]],
+                ["a0", "a1"])
+
+        # The page data and answers of all sessions are retrieved together.
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.get_contents()
+        query_count = len(ctx)
+
+        more_sessions = [
+                factories.FlowSessionFactory(
+                    course=self.course,
+                    participation=factories.ParticipationFactory(
+                        course=self.course,
+                        status=participation_status.active))
+                for i in range(5)]
+        self.add_answers(more_sessions)
+        with self.assertNumQueries(query_count):
+            self.assertEqual(len(self.get_contents()), 10)
+
+    def test_content_of_broken_pages(self):
+        self.add_answers(self.sessions[:2])
+
+        # The first session's second page changed its type.
+        FlowPageData.objects.filter(
+                flow_session=self.sessions[0], page_ordinal=1).update(
+                        page_type="ChoiceQuestion")
+
+        # The second session's first answer cannot be normalized.
+        def normalized_bytes_answer(page_context, page_data, answer):
+            if answer["answer"] == "a0" and (
+                    page_context.flow_session.id == self.sessions[1].id):
+                raise ValueError("broken")
+            return ".txt", answer["answer"].encode()
+
+        with mock.patch("course.api.logger") as mock_logger:
+            contents = self.get_contents(
+                    normalized_bytes_answer=normalized_bytes_answer)
+        self.assertEqual(mock_logger.exception.call_count, 1)
+        self.assertEqual(len(contents), len(self.sessions))
+        self.assertEqual(
+                [[page["answer"]["answer"] for page in content["pages"]]
+                    for content in contents[:2]],
+                [["a0", None], [None, "a1"]])
+        self.assertEqual(
+                contents[1]["pages"][0]["answer"]["answer_data"],
+                {"answer": "a0"})
+
+    def test_single_session_content_raises(self):
+        from course.api import flow_session_pages_to_json
+        from course.flow import assemble_answer_visits, get_all_page_data
+        self.add_answers(self.sessions[:1])
+
+        page = mock.MagicMock()
+        page.normalized_bytes_answer.side_effect = ValueError("broken")
+
+        with self.assertRaises(ValueError):
+            flow_session_pages_to_json(
+                    mock.MagicMock(), lambda page_data: page,
+                    get_all_page_data(self.sessions[0]),
+                    assemble_answer_visits(self.sessions[0]))
+
+    def count_queries(self, **args):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.get_flow_sessions(**args)
+        return len(ctx)
+
+    def test_no_queries_per_session(self):
+        # The first request also sets up the API user's session.
+        self.get_flow_sessions()
+        query_count = self.count_queries()
+
+        for i in range(5):
+            factories.FlowSessionFactory(
+                    course=self.course,
+                    participation=factories.ParticipationFactory(
+                        course=self.course,
+                        status=participation_status.active))
+
+        self.assertEqual(self.count_queries(), query_count)
+
+
+class APITokenTest(TestCase):
+    def setUp(self):  # noqa
+        super(APITokenTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+        self.course = create_repo_less_course()
+        instructor = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+        instructor.roles.set([ParticipationRole.objects.get(
+            course=self.course, identifier="instructor")])
+
+        self.token = AuthenticationToken.objects.create(
+                user=instructor.user, participation=instructor,
+                description="test", token_hash=make_password("secret"))
+
+    def get_flow_sessions(self, secret="secret"):
+        return self.client.get(
+                reverse("relate-course_get_flow_session",
+                    args=(self.course.identifier,)),
+                {"flow_id": factories.DEFAULT_FLOW_ID},
+                HTTP_AUTHORIZATION="Token %d_%s" % (self.token.id, secret))
+
+    def test_verified_token_cache(self):
+        from django.contrib.auth import hashers
+        with mock.patch("django.contrib.auth.hashers.check_password",
+                side_effect=hashers.check_password) as mock_check_password:
+            for i in range(3):
+                self.assertEqual(self.get_flow_sessions().status_code, 200)
+            self.assertEqual(mock_check_password.call_count, 1)
+
+            self.assertEqual(
+                    self.get_flow_sessions(secret="wrong").status_code, 403)
+
+        self.token.revocation_time = now()
+        self.token.save()
+        self.assertEqual(self.get_flow_sessions().status_code, 403)
+
+    def test_expired_token(self):
+        self.assertEqual(self.get_flow_sessions().status_code, 200)
+
+        self.token.valid_until = now() - timedelta(minutes=1)
+        self.token.save()
+        self.assertEqual(self.get_flow_sessions().status_code, 403)
@@ -434,6 +434,35 @@ class CheckRelateTicketMinutesValidAfterUse(CheckRelateSettingsBase):
             ["relate_ticket_minutes_valid_after_use.E002"])
 
 
+class CheckRelateRunpyAdmission(CheckRelateSettingsBase):
+    msg_id_prefix = "relate_runpy_admission"
+
+    @override_settings(RELATE_RUNPY_MAX_CONCURRENT_RUNS=10,
+                       RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS=2.5)
+    def test_valid_relate_runpy_admission(self):
+        self.assertCheckMessages([])
+
+    @override_settings(RELATE_RUNPY_MAX_CONCURRENT_RUNS="10")
+    def test_invalid_relate_runpy_max_concurrent_runs_str(self):
+        self.assertCheckMessages(["relate_runpy_admission.E001"])
+
+    @override_settings(RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS=[10])
+    def test_invalid_relate_runpy_max_queue_wait_seconds_list(self):
+        self.assertCheckMessages(["relate_runpy_admission.E001"])
+
+    @override_settings(RELATE_RUNPY_MAX_QUEUE_LENGTH=-1)
+    def test_invalid_relate_runpy_max_queue_length_negative(self):
+        self.assertCheckMessages(["relate_runpy_admission.E002"])
+
+    @override_settings(RELATE_RUNPY_MAX_CONCURRENT_RUNS=0)
+    def test_invalid_relate_runpy_max_concurrent_runs_zero(self):
+        self.assertCheckMessages(["relate_runpy_admission.E002"])
+
+    @override_settings(RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION=0)
+    def test_invalid_relate_runpy_max_runs_per_participation_zero(self):
+        self.assertCheckMessages(["relate_runpy_admission.E002"])
+
+
 def side_effect_os_path_is_dir(*args, **kwargs):
     if args[0].startswith("dir"):
         return True
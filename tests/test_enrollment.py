@@ -1251,4 +1251,95 @@ class EnrollmentDecisionEmailConnectionsTest(
     # }}}
 
 
+class ParticipationCacheTest(TestCase):
+    # test the participation cache of
+    # course.enrollment.get_participation_for_request
+
+    def setUp(self):  # noqa
+        super(ParticipationCacheTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+        patcher = mock.patch("relate.utils.is_cache_shared", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        from . import factories
+        from .test_grades import create_repo_less_course
+        self.course = create_repo_less_course()
+        self.participation = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+
+        self.request = mock.MagicMock()
+        self.request.user = self.participation.user
+
+    def get_participation(self):
+        from course.enrollment import get_participation_for_request
+        participation = get_participation_for_request(
+                self.request, self.course)
+        return (
+                participation.role_identifiers(),
+                participation.tag_names(),
+                participation.has_permission("view_gradebook"))
+
+    def test_cache(self):
+        self.assertEqual(
+                self.get_participation(),
+                (["student"], frozenset(), False))
+
+        with self.assertNumQueries(0):
+            self.get_participation()
+
+        # dropped when the roles change ...
+        instructor = ParticipationRole.objects.get(
+                course=self.course, identifier="instructor")
+        self.participation.roles.add(instructor)
+        self.assertEqual(
+                self.get_participation(),
+                (["instructor", "student"], frozenset(), True))
+
+        # ... when the tags change ...
+        from course.models import ParticipationTag
+        self.participation.tags.add(ParticipationTag.objects.create(
+            course=self.course, name="online"))
+        self.assertEqual(
+                self.get_participation()[1], frozenset(["online"]))
+
+        # ... and when the permissions of a role change
+        instructor.permissions.filter(permission="view_gradebook").delete()
+        self.assertFalse(self.get_participation()[2])
+
+        with self.assertNumQueries(0):
+            self.get_participation()
+
+    def test_unshared_cache(self):
+        # invalidation would only reach the local process
+        with mock.patch("relate.utils.is_cache_shared", return_value=False):
+            self.get_participation()
+
+            instructor = ParticipationRole.objects.get(
+                    course=self.course, identifier="instructor")
+            # not going through the model signals
+            Participation.roles.through.objects.create(
+                    participation=self.participation,
+                    participationrole=instructor)
+            self.assertEqual(
+                    self.get_participation()[0], ["instructor", "student"])
+
+    def test_unenrolled(self):
+        from course.enrollment import (
+                get_participation_permissions,
+                get_participation_role_identifiers)
+
+        self.assertEqual(
+                list(get_participation_role_identifiers(self.course, None)),
+                ["unenrolled"])
+        permissions = get_participation_permissions(self.course, None)
+
+        with self.assertNumQueries(0):
+            get_participation_role_identifiers(self.course, None)
+            self.assertEqual(
+                    get_participation_permissions(self.course, None),
+                    permissions)
+
 # vim: foldmethod=marker
@@ -0,0 +1,92 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import TestCase, RequestFactory
+from django.urls import resolve, reverse
+
+from course.constants import participation_status
+from course.exam import ExamLockdownMiddleware
+
+from . import factories
+from .test_grades import create_repo_less_course
+
+
+class ExamLockdownMiddlewareTest(TestCase):
+    def setUp(self):  # noqa
+        super(ExamLockdownMiddlewareTest, self).setUp()
+        self.course = create_repo_less_course()
+        self.flow_session = factories.FlowSessionFactory(
+                course=self.course,
+                participation=factories.ParticipationFactory(
+                    course=self.course, status=participation_status.active))
+
+        self.session = SessionStore()
+        self.session["relate_session_locked_to_exam_flow_session_pk"] = \
+                self.flow_session.pk
+        self.middleware = ExamLockdownMiddleware(lambda request: None)
+
+    def process(self, url_name, **kwargs):
+        kwargs["course_identifier"] = self.course.identifier
+        request = RequestFactory().get(reverse(url_name, kwargs=kwargs))
+        request.session = self.session
+        request._messages = FallbackStorage(request)
+
+        self.middleware(request)
+        self.assertTrue(request.relate_exam_lockdown)
+
+        request.resolver_match = resolve(request.path)
+        return self.middleware.process_view(
+                request, request.resolver_match.func,
+                request.resolver_match.args, request.resolver_match.kwargs)
+
+    def assertAllowed(self, url_name, **kwargs):  # noqa
+        self.assertIsNone(self.process(url_name, **kwargs))
+
+    def assertRedirected(self, url_name, **kwargs):  # noqa
+        response = self.process(url_name, **kwargs)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+                response.url,
+                reverse("relate-view_start_flow",
+                    args=(self.course.identifier, self.flow_session.flow_id)))
+
+    def test_lockdown(self):
+        # The flow session is only retrieved on the first request.
+        with self.assertNumQueries(1):
+            self.assertAllowed("relate-get_current_repo_file", path="a.png")
+        with self.assertNumQueries(0):
+            self.assertAllowed("relate-get_current_repo_file", path="b.png")
+
+            self.assertAllowed("relate-view_flow_page",
+                    flow_session_id=self.flow_session.pk, page_ordinal=0)
+            self.assertAllowed("relate-view_start_flow",
+                    flow_id=self.flow_session.flow_id)
+
+            self.assertRedirected("relate-view_flow_page",
+                    flow_session_id=self.flow_session.pk + 1, page_ordinal=0)
+            self.assertRedirected("relate-view_start_flow", flow_id="other")
+            self.assertRedirected("relate-course_page")
@@ -23,13 +23,19 @@ THE SOFTWARE.
 """
 
 from django.urls import reverse
+from django.core.management import call_command, CommandError
+from django.utils.timezone import now, timedelta
+from six import StringIO
 from .base_test_mixins import SingleCoursePageTestMixin
+from . import factories
 
-from django.test import TestCase
+from django.test import TestCase, mock
+from django.test.utils import override_settings
 from course.models import (
     Participation, GradingOpportunity, FlowSession,
-    FlowRuleException, GradeChange
+    FlowRuleException, GradeChange, CurrentGradeState
 )
+from course.constants import grade_state_change_types, participation_status
 
 
 class GradeTestMixin(SingleCoursePageTestMixin):
@@ -89,6 +95,17 @@ class GradeTestMixin(SingleCoursePageTestMixin):
                                   args=[self.course.identifier]))
         self.assertEqual(resp.status_code, 200)
 
+    def test_view_gradebook_data(self):
+        resp = self.c.get(reverse("relate-view_gradebook_data",
+                                  args=[self.course.identifier]),
+                          {"draw": 3, "start": 0, "length": 10,
+                              "order[0][column]": 1, "order[0][dir]": "desc",
+                              "columns[1][name]": "name"})
+        self.assertEqual(resp.status_code, 200)
+        result = resp.json()
+        self.assertEqual(result["draw"], 3)
+        self.assertEqual(len(result["data"]), result["recordsFiltered"])
+
     def test_view_export_gradebook_csv(self):
         resp = self.c.get(reverse("relate-export_gradebook_csv",
                                   args=[self.course.identifier]))
@@ -198,12 +215,28 @@ class GradeTestMixin(SingleCoursePageTestMixin):
                 'extra_file': [''], 'download': ['Download'],
                 'page_id': ['intro/welcome'],
                 'non_in_progress_only': ['on']}
-        resp = self.c.post(reverse("relate-download_all_submissions",
-                                            kwargs=params), data)
-        self.assertEqual(resp.status_code, 200)
-        prefix, zip_file = resp["Content-Disposition"].split('=')
-        self.assertEqual(prefix, "attachment; filename")
-        zip_file_name = zip_file.replace('"', '').split('_')
+        with mock.patch("course.tasks.build_submissions_archive.delay") \
+                as mock_delay:
+            mock_delay.return_value.id = "0123-abcd"
+            resp = self.c.post(reverse("relate-download_all_submissions",
+                                                kwargs=params), data)
+        self.assertRedirects(resp,
+                reverse("relate-monitor_task", args=["0123-abcd"]),
+                fetch_redirect_response=False)
+
+        # The archive is built by a background task.
+        import shutil
+        import tempfile
+        from course.tasks import build_submissions_archive
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+
+        args, kwargs = mock_delay.call_args
+        with override_settings(RELATE_TASK_DOWNLOAD_DIR=download_dir):
+            with mock.patch("celery.app.task.Task.update_state"):
+                result = build_submissions_archive(*args, **kwargs)
+
+        zip_file_name = result["download_name"].split('_')
         self.assertEqual(zip_file_name[0], "submissions")
         self.assertEqual(zip_file_name[1], self.course.identifier)
         self.assertEqual(zip_file_name[2], self.flow_id)
@@ -488,3 +521,684 @@ class GradeThreeQuizTakerTest(GradeTestMixin, TestCase):
         cls.n_participations = 3
 
         cls.c.force_login(cls.instructor_participation.user)
+
+
+def create_repo_less_course():
+    return factories.CourseFactory(
+            name="Test course", number="CS123", time_period="Fall 2017",
+            git_source="git://example.com/test-course",
+            from_email="inform@example.com",
+            notify_email="notify@example.com",
+            active_git_commit_sha="some_sha")
+
+
+class CurrentGradeStateTest(TestCase):
+    def setUp(self):  # noqa
+        super(CurrentGradeStateTest, self).setUp()
+        course = create_repo_less_course()
+        self.gopp = factories.GradingOpportunityFactory(course=course)
+        self.participation = factories.ParticipationFactory(
+                course=course, status=participation_status.active)
+        self.time = now() - timedelta(days=1)
+
+    def add_grade_change(self, **kwargs):
+        self.time += timedelta(minutes=1)
+        return factories.GradeChangeFactory(
+                opportunity=self.gopp, participation=self.participation,
+                grade_time=self.time, **kwargs)
+
+    def get_gradebook_state_machine(self):
+        from course.grades import get_grade_table
+        participations, grading_opps, grade_table = get_grade_table(
+                self.gopp.course)
+        return grade_table[participations.index(self.participation)][
+                grading_opps.index(self.gopp)].grade_state_machine
+
+    def test_updated_on_grade_change(self):
+        self.add_grade_change(points=5)
+        self.assertEqual(
+                self.get_gradebook_state_machine().stringify_state(), "50.0%")
+
+        self.add_grade_change(attempt_id="second", points=8)
+        cgstate = CurrentGradeState.objects.get(
+                participation=self.participation, opportunity=self.gopp)
+        self.assertEqual(cgstate.state, grade_state_change_types.graded)
+        self.assertEqual(len(cgstate.valid_percentages), 2)
+        self.assertEqual(
+                self.get_gradebook_state_machine().stringify_state(),
+                "80.0% (/2)")
+
+        gchange = self.add_grade_change(state=grade_state_change_types.exempt)
+        self.assertEqual(
+                self.get_gradebook_state_machine()
+                .stringify_machine_readable_state(), "EXEMPT")
+
+        gchange.delete()
+        self.assertEqual(
+                self.get_gradebook_state_machine().stringify_state(),
+                "80.0% (/2)")
+
+    def test_grade_table_rows(self):
+        from course.grades import iter_grade_table_rows
+        other_participation = factories.ParticipationFactory(
+                course=self.gopp.course, status=participation_status.active)
+        self.add_grade_change(points=5)
+
+        rows = list(iter_grade_table_rows(self.gopp.course, [self.gopp]))
+        self.assertEqual(
+                [(participation, [
+                    grade_info.grade_state_machine
+                    .stringify_machine_readable_state()
+                    for grade_info in grade_row])
+                    for participation, grade_row in rows],
+                [(self.participation, ["50.000"]),
+                    (other_participation, ["NONE"])])
+
+    def test_grade_without_points(self):
+        self.add_grade_change(attempt_id=None, points=None)
+        self.add_grade_change(attempt_id="second", points=8)
+
+        cgstate = CurrentGradeState.objects.get()
+        self.assertEqual(cgstate.valid_percentages, [None, "80"])
+
+        machine = cgstate.get_grade_state_machine()
+        self.assertEqual(machine.valid_percentages, [None, 80])
+        self.assertFalse(hasattr(machine, "attempt_id_to_gchange"))
+
+    def test_invalid_history_is_replayed(self):
+        self.add_grade_change(state=grade_state_change_types.unavailable)
+        self.add_grade_change(points=5)
+
+        self.assertFalse(CurrentGradeState.objects.exists())
+        with self.assertRaises(ValueError):
+            self.get_gradebook_state_machine()
+
+    def test_rebuild_and_check_command(self):
+        self.add_grade_change(points=5)
+        self.add_grade_change(
+                state=grade_state_change_types.extension,
+                due_time=self.time + timedelta(days=3))
+        expected = CurrentGradeState.objects.get()
+        self.assertTrue(expected.has_extension)
+
+        call_command("rebuild_current_grade_states", "--check",
+                stdout=StringIO())
+
+        CurrentGradeState.objects.update(state=None)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_current_grade_states", "--check",
+                    stdout=StringIO())
+
+        call_command("rebuild_current_grade_states", stdout=StringIO())
+        self.assertTrue(CurrentGradeState.objects.get().has_same_state(expected))
+
+    def test_filled_by_migration(self):
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module("course.migrations.0113_currentgradestate")
+
+        self.add_grade_change(points=5)
+        self.add_grade_change(attempt_id=None, points=None)
+        self.add_grade_change(
+                state=grade_state_change_types.extension,
+                due_time=self.time + timedelta(days=3))
+        expected = CurrentGradeState.objects.get()
+
+        CurrentGradeState.objects.all().delete()
+        migration.fill_current_grade_states(apps, None)
+        self.assertTrue(CurrentGradeState.objects.get().has_same_state(expected))
+
+
+class GradebookDataTest(TestCase):
+    def setUp(self):  # noqa
+        super(GradebookDataTest, self).setUp()
+        self.course = create_repo_less_course()
+        self.gopp = factories.GradingOpportunityFactory(course=self.course)
+
+        self.participations = []
+        for i, (last_name, points) in enumerate(
+                [("Crane", 5), ("adams", None), ("Baker", 8)]):
+            user = factories.UserFactory(
+                    username="user%d" % i, last_name=last_name)
+            participation = factories.ParticipationFactory(
+                    user=user, course=self.course,
+                    status=participation_status.active)
+            self.participations.append(participation)
+            if points is not None:
+                factories.GradeChangeFactory(
+                        opportunity=self.gopp, participation=participation,
+                        points=points)
+
+    def get_sorted_ids(self, sort_column, descending=False):
+        from course.grades import get_sorted_gradebook_participation_ids
+        return get_sorted_gradebook_participation_ids(
+                self.course, Participation.objects.filter(course=self.course),
+                sort_column, descending)
+
+    def test_sort(self):
+        crane, adams, baker = [p.id for p in self.participations]
+
+        self.assertEqual(self.get_sorted_ids("name"), [adams, baker, crane])
+        self.assertEqual(self.get_sorted_ids("username", descending=True),
+                [baker, adams, crane])
+        self.assertEqual(self.get_sorted_ids(str(self.gopp.id)),
+                [adams, crane, baker])
+        self.assertEqual(
+                self.get_sorted_ids(str(self.gopp.id), descending=True),
+                [baker, crane, adams])
+
+    def test_restricted_grade_table_rows(self):
+        from course.grades import iter_grade_table_rows
+        rows = list(iter_grade_table_rows(self.course, [self.gopp],
+                Participation.objects.filter(
+                    id__in=[p.id for p in self.participations[1:]])))
+        self.assertEqual(
+                [(participation, [
+                    grade_info.grade_state_machine
+                    .stringify_machine_readable_state()
+                    for grade_info in grade_row])
+                    for participation, grade_row in rows],
+                [(self.participations[1], ["NONE"]),
+                    (self.participations[2], ["80.000"])])
+
+
+class OpportunitySummaryTest(TestCase):
+    def setUp(self):  # noqa
+        super(OpportunitySummaryTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+        # The test cache is per-process, for which caching is disabled.
+        patcher = mock.patch("relate.utils.is_cache_shared", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.course = create_repo_less_course()
+        self.gopp = factories.GradingOpportunityFactory(course=self.course)
+        self.participation = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+
+    def test_grade_state_machines(self):
+        from course.grades import get_opportunity_grade_state_machines
+        factories.GradeChangeFactory(
+                opportunity=self.gopp, participation=self.participation,
+                points=5)
+
+        machines = get_opportunity_grade_state_machines(self.gopp)
+        self.assertEqual(
+                machines[self.participation.id].stringify_state(), "50.0%")
+
+        with self.assertNumQueries(0):
+            get_opportunity_grade_state_machines(self.gopp)
+
+        factories.GradeChangeFactory(
+                opportunity=self.gopp, participation=self.participation,
+                points=8)
+        machines = get_opportunity_grade_state_machines(self.gopp)
+        self.assertEqual(
+                machines[self.participation.id].stringify_state(), "80.0%")
+
+    def test_flow_session_summary(self):
+        from course.grades import get_flow_session_summary
+        fsession = factories.FlowSessionFactory(
+                course=self.course, participation=self.participation,
+                flow_id=self.gopp.flow_id, access_rules_tag="a")
+
+        summary = get_flow_session_summary(self.course, self.gopp.flow_id)
+        self.assertEqual(
+                summary.participation_id_to_sessions,
+                {self.participation.id: [fsession]})
+        self.assertEqual(summary.access_rules_tags, ["a"])
+
+        with self.assertNumQueries(0):
+            get_flow_session_summary(self.course, self.gopp.flow_id)
+
+        factories.FlowSessionFactory(
+                course=self.course, participation=self.participation,
+                flow_id=self.gopp.flow_id, access_rules_tag=None)
+        summary = get_flow_session_summary(self.course, self.gopp.flow_id)
+        self.assertEqual(
+                len(summary.participation_id_to_sessions[self.participation.id]),
+                2)
+        self.assertEqual(summary.access_rules_tags, [None, "a"])
+
+        # Only field values are cached, and the sessions are complete.
+        from django.core.cache import cache
+        from course.grades import _get_flow_sessions_cache_key
+        cached = cache.get(
+                _get_flow_sessions_cache_key(self.course.id, self.gopp.flow_id))
+        self.assertTrue(all(isinstance(values, tuple) for values in cached))
+
+        summary = get_flow_session_summary(self.course, self.gopp.flow_id)
+        cached_fsession = (
+                summary.participation_id_to_sessions[self.participation.id][0])
+        self.assertEqual(cached_fsession, fsession)
+        self.assertEqual(cached_fsession.access_rules_tag, "a")
+        self.assertEqual(cached_fsession.user_id, fsession.user_id)
+
+    def test_not_cached_in_unshared_cache(self):
+        from course.grades import get_flow_session_summary
+        with mock.patch("relate.utils.is_cache_shared", return_value=False):
+            get_flow_session_summary(self.course, self.gopp.flow_id)
+            with self.assertNumQueries(1):
+                get_flow_session_summary(self.course, self.gopp.flow_id)
+
+
+class GradeMatrixTest(TestCase):
+    def setUp(self):  # noqa
+        super(GradeMatrixTest, self).setUp()
+        self.course = create_repo_less_course()
+        self.participations = [
+                factories.ParticipationFactory(
+                    course=self.course, status=participation_status.active)
+                for i in range(3)]
+        self.time = now() - timedelta(days=1)
+
+    def add_grade_change(self, gopp, participation, **kwargs):
+        self.time += timedelta(minutes=1)
+        return factories.GradeChangeFactory(
+                opportunity=gopp, participation=participation,
+                grade_time=self.time, **kwargs)
+
+    def test_matches_grade_state_machine(self):
+        from course.constants import grade_aggregation_strategy as gas
+        from course.grades import GradeMatrix
+        from course.models import GradeStateMachine
+
+        gopps = [
+                factories.GradingOpportunityFactory(
+                    course=self.course, identifier=strategy,
+                    aggregation_strategy=strategy)
+                for strategy in [
+                    gas.max_grade, gas.avg_grade, gas.min_grade,
+                    gas.use_earliest, gas.use_latest]]
+
+        for gopp in gopps:
+            p0, p1, p2 = self.participations
+            for attempt_id, points in [("a", 3), ("b", 9), ("c", 6)]:
+                self.add_grade_change(gopp, p0, attempt_id=attempt_id,
+                        points=points)
+            self.add_grade_change(gopp, p0, attempt_id="a", points=4)
+
+            self.add_grade_change(gopp, p1, points=7)
+            self.add_grade_change(gopp, p1,
+                    state=grade_state_change_types.exempt)
+
+        # p2 has no grades, and p0's history for the last opportunity
+        # is unmaterialized and must be replayed.
+        CurrentGradeState.objects.filter(
+                participation=self.participations[0],
+                opportunity=gopps[-1]).delete()
+
+        grade_matrix = GradeMatrix(gopps, Participation.objects.filter(
+            course=self.course))
+
+        self.assertEqual(
+                list(grade_matrix.participation_ids),
+                sorted(p.id for p in self.participations[:2]))
+
+        for i, participation_id in enumerate(grade_matrix.participation_ids):
+            for j, gopp in enumerate(gopps):
+                expected = GradeStateMachine().consume(
+                        GradeChange.objects
+                        .filter(participation_id=participation_id,
+                            opportunity=gopp)
+                        .order_by("grade_time")).percentage()
+                if expected is None:
+                    self.assertNotEqual(
+                            grade_matrix.percentages[i, j],
+                            grade_matrix.percentages[i, j])
+                else:
+                    self.assertAlmostEqual(
+                            grade_matrix.percentages[i, j], float(expected))
+
+        self.assertEqual(list(grade_matrix.counts), [1] * 5)
+        self.assertAlmostEqual(grade_matrix.averages[0], 90)
+        self.assertAlmostEqual(grade_matrix.averages[1], (40+90+60)/3)
+
+    def test_grades_without_points_and_unknown_strategy(self):
+        from course.constants import grade_aggregation_strategy as gas
+        from course.grades import GradeMatrix
+
+        gopps = [
+                factories.GradingOpportunityFactory(
+                    course=self.course, identifier=strategy,
+                    aggregation_strategy=strategy)
+                for strategy in [
+                    gas.max_grade, gas.avg_grade, gas.min_grade,
+                    gas.use_earliest, gas.use_latest, "unknown"]]
+
+        participation = self.participations[0]
+        for gopp in gopps:
+            self.add_grade_change(gopp, participation, attempt_id=None,
+                    points=None)
+            self.add_grade_change(gopp, participation, attempt_id="a",
+                    points=5)
+
+        grade_matrix = GradeMatrix(gopps, Participation.objects.filter(
+            course=self.course))
+
+        percentages = list(grade_matrix.percentages[0])
+        self.assertEqual(percentages[:3], [50, 50, 50])
+        self.assertNotEqual(percentages[3], percentages[3])
+        self.assertEqual(percentages[4], 50)
+        self.assertNotEqual(percentages[5], percentages[5])
+
+
+class ImportGradesTest(TestCase):
+    def setUp(self):  # noqa
+        super(ImportGradesTest, self).setUp()
+        self.course = create_repo_less_course()
+        self.gopp = factories.GradingOpportunityFactory(course=self.course)
+        self.participations = []
+        for i in range(5):
+            user = factories.UserFactory(
+                    email="student%d@example.com" % i,
+                    institutional_id="inst%d" % i)
+            self.participations.append(factories.ParticipationFactory(
+                    user=user, course=self.course,
+                    status=participation_status.active))
+
+    def csv_to_grade_changes(self, data, attr_type="email_or_id"):
+        from course.grades import csv_to_grade_changes
+        log_lines = []
+        total_count, grade_changes = csv_to_grade_changes(
+                log_lines=log_lines,
+                course=self.course, grading_opportunity=self.gopp,
+                attempt_id="main", file_contents=StringIO(data),
+                attr_type=attr_type, attr_column=1, points_column=2,
+                feedback_column=None, max_points=10, creator=None,
+                grade_time=now(), has_header=False)
+        return total_count, grade_changes, log_lines
+
+    def test_import(self):
+        from course.grades import save_imported_grade_changes
+
+        data = "".join(
+                "student%d,%d\n" % (i, i) for i in range(4)) + "nobody,3\n"
+
+        # one query each for participants and previous grades
+        with self.assertNumQueries(2):
+            total_count, grade_changes, log_lines = \
+                    self.csv_to_grade_changes(data)
+
+        self.assertEqual(total_count, 4)
+        self.assertEqual(
+                [gchange.participation for gchange in grade_changes],
+                self.participations[:4])
+        self.assertEqual(len(log_lines), 1)
+
+        save_imported_grade_changes(grade_changes)
+        self.assertEqual(GradeChange.objects.count(), 4)
+        self.assertEqual(
+                CurrentGradeState.objects.get(
+                    participation=self.participations[3]).valid_percentages,
+                ["30"])
+
+        # unchanged grades are not imported again
+        data = "inst2,2\ninst3,4\n"
+        total_count, grade_changes, log_lines = \
+                self.csv_to_grade_changes(data, attr_type="inst_id")
+        self.assertEqual(total_count, 2)
+        self.assertEqual(
+                [gchange.participation for gchange in grade_changes],
+                [self.participations[3]])
+
+    def test_ambiguous_participant(self):
+        user = factories.UserFactory(email="student1@other.example.com")
+        factories.ParticipationFactory(
+                user=user, course=self.course,
+                status=participation_status.active)
+
+        total_count, grade_changes, log_lines = \
+                self.csv_to_grade_changes(
+                        "student1,1\nstudent1@example.com,1\n")
+        self.assertEqual(
+                [gchange.participation for gchange in grade_changes],
+                [self.participations[1]])
+        self.assertIn("more than one", str(log_lines[0]))
+
+    def test_import_task(self):
+        from course.tasks import import_grades_from_csv
+
+        with mock.patch("celery.app.task.Task.update_state") as update_state:
+            result = import_grades_from_csv(
+                    self.course.id, self.gopp.id, attempt_id="main",
+                    file_contents="student0,5\nnobody,1\n",
+                    attr_type="email_or_id", attr_column=1, points_column=2,
+                    feedback_column=None, max_points=10,
+                    creator_id=self.participations[0].user.id,
+                    grade_time=now(), has_header=False)
+
+        self.assertTrue(update_state.called)
+        self.assertIn("1 imported", result["message"])
+        self.assertIn("nobody", result["message"])
+        self.assertEqual(
+                CurrentGradeState.objects.get().participation,
+                self.participations[0])
+
+
+class SubmissionsArchiveTest(TestCase):
+    def setUp(self):  # noqa
+        super(SubmissionsArchiveTest, self).setUp()
+        from course.models import (
+                FlowPageData, FlowPageVisit, FlowPageVisitGrade)
+
+        self.course = create_repo_less_course()
+        self.sessions = []
+        start_time = now() - timedelta(days=1)
+        for i in range(2):
+            user = factories.UserFactory(username="student%d" % i)
+            participation = factories.ParticipationFactory(
+                    user=user, course=self.course,
+                    status=participation_status.active)
+            session = factories.FlowSessionFactory(
+                    course=self.course, participation=participation)
+            self.sessions.append(session)
+
+            page_data = FlowPageData.objects.create(
+                    flow_session=session, page_ordinal=0, page_type="TextQuestion",
+                    group_id="main", page_id="q1", data={})
+            for j, answer in enumerate(["a%d" % i, None, "b%d" % i]):
+                visit = FlowPageVisit.objects.create(
+                        flow_session=session, page_data=page_data,
+                        visit_time=start_time + timedelta(minutes=10*j+i),
+                        answer=None if answer is None else {"answer": answer},
+                        is_submitted_answer=True)
+                FlowPageVisitGrade.objects.create(
+                        visit=visit, max_points=1, correctness=j/2)
+
+    def write_archive(self, which_attempt, include_feedback=False):
+        from io import BytesIO
+        from zipfile import ZipFile
+        from course.grades import (
+                get_submission_archive_visits, write_submissions_archive)
+
+        def normalized_bytes_answer(page_context, page_data, answer):
+            if answer is None:
+                return None
+            return (".txt", answer["answer"].encode())
+
+        page = mock.MagicMock()
+        page.normalized_bytes_answer.side_effect = normalized_bytes_answer
+
+        visits = get_submission_archive_visits(
+                self.course, "quiz-test", "main", "q1")
+        progress_callback = mock.MagicMock()
+
+        bio = BytesIO()
+        with mock.patch("course.utils.PageInstanceCache.get_page",
+                return_value=page):
+            with ZipFile(bio, "w") as subm_zip:
+                count = write_submissions_archive(
+                        subm_zip, self.course, None, b"sha", "quiz-test",
+                        visits, which_attempt, include_feedback,
+                        progress_callback=progress_callback)
+
+        progress_callback.assert_called_with(count, count)
+        # each answer written is normalized once, and no others
+        self.assertEqual(page.normalized_bytes_answer.call_count, count)
+
+        with ZipFile(BytesIO(bio.getvalue())) as subm_zip:
+            return count, dict(
+                    (name, subm_zip.read(name).decode())
+                    for name in subm_zip.namelist())
+
+    def test_which_attempt(self):
+        count, contents = self.write_archive("last")
+        self.assertEqual(count, 2)
+        self.assertEqual(contents, {
+            "student0.txt": "b0",
+            "student1.txt": "b1",
+            })
+
+        count, contents = self.write_archive("first")
+        self.assertEqual(contents, {
+            "student0.txt": "a0",
+            "student1.txt": "a1",
+            })
+
+        count, contents = self.write_archive("all")
+        self.assertEqual(sorted(contents), sorted(
+            "student%d-%d.txt" % (i, session.id)
+            for i, session in enumerate(self.sessions)))
+
+    def test_include_feedback(self):
+        count, contents = self.write_archive("last", include_feedback=True)
+        self.assertEqual(len(contents), 4)
+        self.assertIn("scores: 1.0", contents["student0-feedback.txt"])
+
+    def test_no_unbounded_queries(self):
+        # one query to select the visits, then one for each chunk of them and
+        # its grades
+        with self.assertNumQueries(3):
+            self.write_archive("last", include_feedback=True)
+
+
+class LatestGradeTest(TestCase):
+    # test FlowPageVisit.latest_grade and course.flow.assemble_page_grades
+
+    def setUp(self):  # noqa
+        super(LatestGradeTest, self).setUp()
+        from course.models import FlowPageData, FlowPageVisit
+
+        self.course = create_repo_less_course()
+        participation = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+        self.session = factories.FlowSessionFactory(
+                course=self.course, participation=participation,
+                page_count=2)
+
+        self.time = now() - timedelta(days=1)
+        self.visits = []
+        for page_ordinal in range(2):
+            page_data = FlowPageData.objects.create(
+                    flow_session=self.session, page_ordinal=page_ordinal,
+                    page_type="TextQuestion", group_id="main",
+                    page_id="q%d" % page_ordinal, data={})
+            self.visits.append(FlowPageVisit.objects.create(
+                    flow_session=self.session, page_data=page_data,
+                    visit_time=self.time, answer={"answer": "a"},
+                    is_submitted_answer=True))
+
+    def add_grade(self, visit, minutes, correctness):
+        from course.models import FlowPageVisitGrade
+        return FlowPageVisitGrade.objects.create(
+                visit=visit, max_points=1, correctness=correctness,
+                grade_time=self.time + timedelta(minutes=minutes))
+
+    def test_latest_grade(self):
+        visit = self.visits[0]
+        self.assertIsNone(visit.get_most_recent_grade())
+
+        first_grade = self.add_grade(visit, 2, 0.5)
+        # the visit the grade was created with is kept up to date
+        self.assertEqual(visit.get_most_recent_grade(), first_grade)
+        self.assertEqual(visit.latest_correctness, 0.5)
+
+        # an older grade does not replace the latest one
+        self.add_grade(visit, 1, 0)
+        visit.refresh_from_db()
+        self.assertEqual(visit.latest_grade, first_grade)
+
+        latest_grade = self.add_grade(visit, 3, 1)
+        visit.refresh_from_db()
+        self.assertEqual(visit.latest_grade, latest_grade)
+        self.assertEqual(visit.latest_correctness, 1)
+
+        latest_grade.delete()
+        visit.refresh_from_db()
+        self.assertEqual(visit.latest_grade, first_grade)
+        self.assertEqual(visit.latest_correctness, 0.5)
+
+    def test_assemble_page_grades(self):
+        from course.flow import assemble_page_grades
+
+        self.add_grade(self.visits[0], 1, 0)
+        latest_grade = self.add_grade(self.visits[0], 2, 1)
+
+        # one query for the visits and one for their grades
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                    assemble_page_grades([self.session]),
+                    [[latest_grade, None]])
+
+
+class LastActivityTest(TestCase):
+    # test FlowSession.last_activity_time
+
+    def setUp(self):  # noqa
+        super(LastActivityTest, self).setUp()
+        from course.models import FlowPageData
+
+        self.course = create_repo_less_course()
+        participation = factories.ParticipationFactory(
+                course=self.course, status=participation_status.active)
+        self.session = factories.FlowSessionFactory(
+                course=self.course, participation=participation,
+                page_count=1)
+        self.page_data = FlowPageData.objects.create(
+                flow_session=self.session, page_ordinal=0,
+                page_type="TextQuestion", group_id="main",
+                page_id="q0", data={})
+        self.time = now() - timedelta(days=1)
+
+    def add_visit(self, minutes, answer={"answer": "a"}, is_synthetic=False):
+        from course.models import FlowPageVisit
+        return FlowPageVisit.objects.create(
+                flow_session=self.session, page_data=self.page_data,
+                visit_time=self.time + timedelta(minutes=minutes),
+                answer=answer, is_synthetic=is_synthetic)
+
+    def get_last_activity(self):
+        self.session.refresh_from_db()
+        return self.session.last_activity()
+
+    def test_last_activity(self):
+        self.assertIsNone(self.get_last_activity())
+
+        # visits without answers and synthetic visits are not activity
+        self.add_visit(5, answer=None)
+        self.add_visit(6, is_synthetic=True)
+        self.assertIsNone(self.get_last_activity())
+
+        latest_visit = self.add_visit(2)
+        self.assertEqual(
+                self.get_last_activity(), self.time + timedelta(minutes=2))
+
+        # an older answer does not replace the latest one
+        self.add_visit(1)
+        self.assertEqual(
+                self.get_last_activity(), self.time + timedelta(minutes=2))
+
+        latest_visit.delete()
+        self.assertEqual(
+                self.get_last_activity(), self.time + timedelta(minutes=1))
+
+    def test_session_of_visit_updated(self):
+        from course.models import FlowPageVisit
+        visit = FlowPageVisit(
+                flow_session=self.session, page_data=self.page_data,
+                visit_time=self.time, answer={"answer": "a"})
+        visit.save()
+        self.assertEqual(self.session.last_activity(), self.time)
@@ -24,10 +24,12 @@ THE SOFTWARE.
 
 import os
 from base64 import b64encode
-from django.test import TestCase
-from django.urls import resolve
+from django.test import TestCase, SimpleTestCase, mock
+from django.test.utils import override_settings
+from django.urls import resolve, reverse
 from django.core import mail
-from course.models import FlowSession
+from django.conf import settings
+from course.models import FlowSession, CodeRun
 from .base_test_mixins import (
     SingleCoursePageTestMixin, FallBackStorageMessageTestMixin,
     SubprocessRunpyContainerMixin)
@@ -656,4 +658,161 @@ class SingleCourseQuizPageCodeQuestionTest(
                 resp, "The human grader assigned 2/2 points.")
         self.assertSessionScoreEqual(2)
 
+    def test_code_run_recorded(self):
+        page_id = "addition"
+        resp = self.post_answer_by_page_id(
+            page_id, {"answer": ['c = b + a\r']})
+        self.assertEqual(resp.status_code, 200)
+
+        code_run, = CodeRun.objects.filter(page_id=page_id)
+        self.assertEqual(code_run.flow_id, self.flow_id)
+        self.assertEqual(code_run.participation, self.student_participation)
+        self.assertEqual(code_run.result, "success")
+        self.assertEqual(code_run.retry_count, 0)
+        self.assertEqual(code_run.image,
+                getattr(settings, "RELATE_DOCKER_RUNPY_IMAGE", None))
+        self.assertGreater(code_run.response_size, 0)
+        self.assertIsNotNone(code_run.exec_time)
+
+        self.c.force_login(self.instructor_participation.user)
+        resp = self.c.get(reverse("relate-code_run_analytics",
+                                  args=[self.course.identifier, self.flow_id]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context["code_run_stats_list"][0].run_count, 1)
+
+
+class RunpyRequestTest(SubprocessRunpyContainerMixin, TestCase):
+    run_req = {
+        "compile_only": False,
+        "setup_code": "a = 2\nb = 3",
+        "names_for_user": ["a", "b"],
+        "names_from_user": ["c"],
+        "test_code": "feedback.set_points(1 if c == 5 else 0)",
+        }
+
+    def test_run_records_timings(self):
+        from course.page.code import request_python_run
+        result = request_python_run(
+            dict(self.run_req, user_code="c = a + b"), run_timeout=1)
+
+        self.assertEqual(result["result"], "success")
+        self.assertEqual(
+            set(result["timings"]),
+            set(["create", "start", "ready", "exec", "remove"]))
+        self.assertGreater(result["response_size"], 0)
+
+    def test_batch_results_in_order(self):
+        from course.page.code import request_python_run_batch
+        results = request_python_run_batch(
+            self.run_req,
+            ["c = a + b", "c = a - b", "c = ", "while True: pass"],
+            run_timeout=1)
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]["result"], "success")
+        self.assertEqual(results[0]["points"], 1)
+        self.assertEqual(results[1]["result"], "success")
+        self.assertEqual(results[1]["points"], 0)
+        self.assertEqual(results[2]["result"], "user_compile_error")
+        self.assertEqual(results[3]["result"], "timeout")
+        self.assertEqual([r["batch_size"] for r in results], [4] * 4)
+
+    def test_batch_runs_isolated(self):
+        from course.page.code import request_python_run_batch
+        results = request_python_run_batch(
+            dict(self.run_req,
+                 test_code="import math\n"
+                 "feedback.set_points(0 if hasattr(math, 'leak') else 1)"),
+            ["import math; math.leak = 1; c = 5", "c = 5"],
+            run_timeout=1)
+
+        self.assertEqual([r["points"] for r in results], [0, 1])
+
+
+@override_settings(
+    RELATE_RUNPY_MAX_CONCURRENT_RUNS=1,
+    RELATE_RUNPY_MAX_QUEUE_WAIT_SECONDS=0.1,
+    RELATE_RUNPY_MAX_RUNS_PER_PARTICIPATION=1)
+class RunpyAdmissionTest(SimpleTestCase):
+    def setUp(self):  # noqa
+        super(RunpyAdmissionTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_admit_up_to_limit(self):
+        from course.page.code import runpy_admission, get_runpy_admission_stats
+        with runpy_admission(10) as admitted:
+            self.assertTrue(admitted)
+            self.assertEqual(get_runpy_admission_stats()["running"], 1)
+
+            timings = {}
+            with runpy_admission(10, timings=timings) as admitted2:
+                self.assertFalse(admitted2)
+            self.assertGreaterEqual(timings["queue"], 0.1)
+
+        with runpy_admission(10) as admitted:
+            self.assertTrue(admitted)
+
+        stats = get_runpy_admission_stats()
+        self.assertEqual(stats["running"], 0)
+        self.assertEqual(stats["waiting"], 0)
+        self.assertEqual(stats["admitted"], 2)
+        self.assertEqual(stats["turned_away"], 1)
+
+    @override_settings(RELATE_RUNPY_MAX_CONCURRENT_RUNS=2)
+    def test_per_participation_limit(self):
+        from course.page.code import runpy_admission
+        with runpy_admission(10, participation_id=1) as admitted:
+            self.assertTrue(admitted)
+
+            with runpy_admission(10, participation_id=1) as admitted2:
+                self.assertFalse(admitted2)
+
+            with runpy_admission(10, participation_id=2) as admitted2:
+                self.assertTrue(admitted2)
+
+    @override_settings(RELATE_RUNPY_MAX_QUEUE_LENGTH=0)
+    def test_queue_full(self):
+        from course.page.code import request_python_run
+        result = request_python_run(
+                {"user_code": ""}, run_timeout=1, image="test-image")
+        self.assertEqual(result["result"], "queued")
+        self.assertEqual(result["image"], "test-image")
+
+    def test_counter_timeout_rearmed(self):
+        from django.core.cache import cache
+        from course.page.code import (
+                _cache_incr, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+
+        with mock.patch.object(cache, "set", wraps=cache.set) as mock_set:
+            self.assertEqual(_cache_incr(cache, "test-counter", 1), 1)
+            self.assertEqual(_cache_incr(cache, "test-counter", 1), 2)
+
+        mock_set.assert_called_with(
+                "test-counter", 2, RUNPY_ADMISSION_COUNTER_TIMEOUT)
+
+    @override_settings(
+            RELATE_RUNPY_MAX_QUEUE_LENGTH=0,
+            RELATE_RUNPY_MAX_CONCURRENT_RUNS=2)
+    def test_wait_is_never_turned_away(self):
+        from course.page.code import runpy_admission
+        with runpy_admission(10, participation_id=1, wait=True) as admitted:
+            self.assertTrue(admitted)
+
+            with runpy_admission(
+                    10, participation_id=1, wait=True) as admitted2:
+                self.assertTrue(admitted2)
+
+    @override_settings(RELATE_RUNPY_MAX_QUEUE_LENGTH=0)
+    def test_batch_retries_wait(self):
+        from course.page.code import request_python_run_batch_with_retries
+        with mock.patch("course.page.code.request_python_run_batch",
+                return_value=[None]), \
+                mock.patch("course.page.code._run_in_runpy_container",
+                    return_value={"result": "success"}):
+            results = request_python_run_batch_with_retries(
+                    {}, ["c = 1"], run_timeout=1, participation_ids=[1])
+
+        self.assertEqual(results[0]["result"], "success")
+
 # vim: fdm=marker
@@ -24,9 +24,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from django.test import SimpleTestCase, mock
+from django.test import SimpleTestCase, TestCase, mock
 from django.test.utils import override_settings
-from course.utils import get_course_specific_language_choices
+from course.utils import (
+    get_course_specific_language_choices, make_streaming_csv_response)
 
 
 class GetCourseSpecificLanguageChoicesTest(SimpleTestCase):
@@ -152,4 +153,193 @@ class GetCourseSpecificLanguageChoicesTest(SimpleTestCase):
                 # be found in django.conf.locale.LANG_INFO
                 self.assertIn("user_customized_lang_code", choices[0][1])
 
+
+class MakeStreamingCSVResponseTest(SimpleTestCase):
+    # test course.utils.make_streaming_csv_response
+
+    def test_rows_consumed_lazily(self):
+        consumed = []
+
+        def generate_rows():
+            for i in range(3):
+                consumed.append(i)
+                yield [i, u"n\u00e4me, %d" % i]
+
+        resp = make_streaming_csv_response(generate_rows(), "test.csv")
+        self.assertEqual(consumed, [])
+        self.assertIn('filename="test.csv"', resp["Content-Disposition"])
+
+        content = b"".join(resp.streaming_content)
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertEqual(
+            content.decode("utf-8").splitlines(),
+            [u'0,"n\u00e4me, 0"', u'1,"n\u00e4me, 1"', u'2,"n\u00e4me, 2"'])
+
+
+class TaskDownloadTest(SimpleTestCase):
+    # test course.utils.remove_expired_task_downloads
+
+    def test_remove_expired(self):
+        import os
+        import shutil
+        import tempfile
+        import time
+        from course.utils import (
+                get_task_download_path, remove_expired_task_downloads)
+
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+
+        with override_settings(RELATE_TASK_DOWNLOAD_DIR=download_dir):
+            for task_id in ["old", "new"]:
+                with open(get_task_download_path(task_id), "wb") as outf:
+                    outf.write(b"data")
+
+            old_path = get_task_download_path("old")
+            old_time = time.time() - 2 * 24 * 60 * 60
+            os.utime(old_path, (old_time, old_time))
+
+            self.assertEqual(remove_expired_task_downloads(), 1)
+            self.assertFalse(os.path.exists(old_path))
+            self.assertTrue(os.path.exists(get_task_download_path("new")))
+
+
+class FacilityIndexTest(SimpleTestCase):
+    # test course.utils.FacilityIndex and get_facility_index
+
+    facilities = {
+            "lab": {"ip_ranges": ["192.168.0.0/16", "10.0.0.0/8"]},
+            "lab_room": {
+                "ip_ranges": ["192.168.1.0/24", "2001:db8::/32"],
+                "exams_only": True},
+            "empty": {},
+            }
+
+    def test_get_facilities(self):
+        from course.utils import FacilityIndex
+        index = FacilityIndex(self.facilities)
+
+        self.assertEqual(index.exams_only_facilities, frozenset(["lab_room"]))
+
+        for address, facilities in [
+                ("192.168.1.5", {"lab", "lab_room"}),
+                ("192.168.1.255", {"lab", "lab_room"}),
+                ("192.168.2.0", {"lab"}),
+                ("192.168.0.0", {"lab"}),
+                ("192.167.255.255", set()),
+                ("10.255.255.255", {"lab"}),
+                ("11.0.0.0", set()),
+                ("1.2.3.4", set()),
+                ("2001:db8::1", {"lab_room"}),
+                ("::1", set()),
+                ]:
+            for i in range(2):
+                # the second time from the cache
+                self.assertEqual(
+                        index.get_facilities(address), facilities, address)
+
+    def test_get_facility_index(self):
+        from course.utils import (
+                get_facility_index, FACILITY_INDEX_CALLABLE_TIMEOUT)
+
+        with override_settings(RELATE_FACILITIES=self.facilities):
+            index = get_facility_index()
+            self.assertIs(get_facility_index(), index)
+
+        calls = []
+
+        def get_facilities(now_datetime):
+            calls.append(now_datetime)
+            return self.facilities
+
+        with override_settings(RELATE_FACILITIES=get_facilities):
+            index = get_facility_index()
+            self.assertIs(get_facility_index(), index)
+            self.assertEqual(len(calls), 1)
+
+            # called again once the index times out
+            import time
+            later = time.time() + 2 * FACILITY_INDEX_CALLABLE_TIMEOUT
+            with mock.patch("time.time", return_value=later):
+                self.assertIsNot(get_facility_index(), index)
+                get_facility_index()
+            self.assertEqual(len(calls), 2)
+
+
+class InstantFlowRequestCacheTest(TestCase):
+    # test course.utils.get_active_instant_flow_requests
+
+    def setUp(self):  # noqa
+        super(InstantFlowRequestCacheTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+
+        patcher = mock.patch("relate.utils.is_cache_shared", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        from .test_grades import create_repo_less_course
+        self.course = create_repo_less_course()
+
+    def add_request(self, start_minutes, end_minutes):
+        from django.utils.timezone import now, timedelta
+        from course.models import InstantFlowRequest
+        return InstantFlowRequest.objects.create(
+                course=self.course, flow_id="quiz",
+                start_time=now() + timedelta(minutes=start_minutes),
+                end_time=now() + timedelta(minutes=end_minutes))
+
+    def get_active(self):
+        from django.utils.timezone import now
+        from course.utils import get_active_instant_flow_requests
+        return get_active_instant_flow_requests(self.course, now())
+
+    def test_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_active(), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_active(), [])
+
+        # dropped when a request is saved
+        ifr = self.add_request(-5, 5)
+        self.assertEqual(self.get_active(), [ifr])
+
+        ifr.cancelled = True
+        ifr.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_active(), [])
+
+    def test_unshared_cache(self):
+        # invalidation would only reach the local process
+        with mock.patch("relate.utils.is_cache_shared", return_value=False):
+            self.get_active()
+            with self.assertNumQueries(1):
+                self.assertEqual(self.get_active(), [])
+
+    def test_timeout(self):
+        from course.utils import (
+                get_active_instant_flow_requests,
+                INSTANT_FLOW_REQUESTS_CACHE_TIMEOUT)
+
+        def get_timeout():
+            from django.utils.timezone import now
+            cache = mock.MagicMock()
+            cache.get.return_value = None
+            with mock.patch(
+                    "course.utils._get_instant_flow_requests_cache",
+                    return_value=cache):
+                get_active_instant_flow_requests(self.course, now())
+            (_, _, timeout), _ = cache.set.call_args
+            return timeout
+
+        self.assertEqual(get_timeout(), INSTANT_FLOW_REQUESTS_CACHE_TIMEOUT)
+
+        # until the active request ends
+        self.add_request(-5, 10)
+        self.assertAlmostEqual(get_timeout(), 10*60, delta=5)
+
+        # until the upcoming request starts
+        self.add_request(2, 20)
+        self.assertAlmostEqual(get_timeout(), 2*60, delta=5)
+
 # vim: foldmethod=marker